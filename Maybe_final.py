@@ -1,7 +1,26 @@
-import json
+import argparse
 import tkinter as tk
 from tkinter import messagebox, PhotoImage, Scrollbar, Listbox
-from datetime import datetime, time
+
+import metrics
+from client import connect_engine
+from dashboard_view import DashboardView
+from listing_view import ListingView
+from worker import EngineWorker
+
+IMAGES = {}
+
+
+def load_image(path):
+    # Each image is decoded once per process; every screen that shows it shares the same PhotoImage.
+    if path not in IMAGES:
+        try:
+            IMAGES[path] = PhotoImage(file=path)
+        except Exception as e:
+            print(f"Error loading image: {e}")
+            IMAGES[path] = None
+    return IMAGES[path]
+
 
 class TokenSystemGUI:
     def __init__(self, root):
@@ -9,122 +28,135 @@ class TokenSystemGUI:
         self.root.title("Token Trading System")
         self.root.geometry("800x800")
         self.data_file = "token_data.json"
-        self.default_halls = ["Zia Hall", "Hamid Hall", "Shahidul Hall", "Bongobandhu Hall", "Selim Hall"]
-        self.load_data()
+        self.worker = EngineWorker(self.root, lambda: connect_engine(data_file=self.data_file))
+        self.default_halls = self.worker.engine.halls
         self.current_user = None 
         self.admin_username = "admin" 
         self.admin_roll = "000000"  
         self.admin_mobile = "01111111111" 
+        self.screens = {}
+        self.current_screen = None
         self.create_login_screen()
 
-    def clear_screen(self):
-        for widget in self.root.winfo_children():
-            widget.destroy()
-
-    def load_data(self):
-        try:
-            with open(self.data_file, "r") as file:
-                data = json.load(file)
-                self.users = data.get("users", {})
-                self.halls = {hall: data.get("halls", {}).get(hall, []) for hall in self.default_halls}
-        except (FileNotFoundError, json.decoder.JSONDecodeError):
-            self.users = {}
-            self.halls = {hall: [] for hall in self.default_halls}
-        self.save_data()
-
-    def save_data(self):
-        with open(self.data_file, "w") as file:
-            json.dump({"users": self.users, "halls": self.halls}, file, indent=4)
+    def show_screen(self, name, build):
+        # Screens are built once and then hidden/shown, instead of destroying every widget on each click.
+        if self.current_screen is not None:
+            self.current_screen.pack_forget()
+        frame = self.screens.get(name)
+        if frame is None:
+            frame = tk.Frame(self.root)
+            build(frame)
+            self.screens[name] = frame
+        frame.pack(fill=tk.BOTH, expand=True)
+        self.current_screen = frame
+        return frame
 
     def create_login_screen(self):
-        self.clear_screen()
-        tk.Label(self.root, text="Welcome to Token Trading System", fg="white", bg="black",
+        self.show_screen("login", self.build_login_screen)
+
+    def build_login_screen(self, frame):
+        tk.Label(frame, text="Welcome to Token Trading System", fg="white", bg="black",
                  font=("Arial", 20, "bold"), padx=20, pady=10, borderwidth=5, relief=tk.RIDGE).pack(pady=10)
 
-        try:
-            self.photo = PhotoImage(file="RUET.png")
-            img_label = tk.Label(self.root, image=self.photo)
-            img_label.image = self.photo
-            img_label.pack(pady=10)
-        except Exception as e:
-            print(f"Error loading image: {e}")
+        # The logo is decoded after the window is first drawn, so the PNG never delays the login screen.
+        img_label = tk.Label(frame)
+        img_label.pack(pady=10)
+
+        def show_logo():
+            self.photo = load_image("RUET.png")
+            if self.photo is not None:
+                img_label.config(image=self.photo)
+
+        self.root.after_idle(show_logo)
 
-        tk.Label(self.root, text="Username:").pack()
-        self.username_entry = tk.Entry(self.root)
+        tk.Label(frame, text="Username:").pack()
+        self.username_entry = tk.Entry(frame)
         self.username_entry.pack()
 
-        tk.Label(self.root, text="Roll Number:").pack()
-        self.roll_entry = tk.Entry(self.root)
+        tk.Label(frame, text="Roll Number:").pack()
+        self.roll_entry = tk.Entry(frame)
         self.roll_entry.pack()
 
-        tk.Label(self.root, text="Mobile Number:").pack()
-        self.mobile_entry = tk.Entry(self.root)
+        tk.Label(frame, text="Mobile Number:").pack()
+        self.mobile_entry = tk.Entry(frame)
         self.mobile_entry.pack()
 
-        tk.Button(self.root, text="Login", command=self.login).pack(pady=10)
+        self.login_button = tk.Button(frame, text="Login", command=self.login)
+        self.login_button.pack(pady=10)
+
+    def show_error(self, error):
+        messagebox.showerror("Error", str(error))
 
     def login(self):
         username = self.username_entry.get().strip()
         roll = self.roll_entry.get().strip()
         mobile = self.mobile_entry.get().strip()
 
-        if not username or not roll or not mobile:
-            messagebox.showerror("Error", "All fields are required!")
-            return
+        def done(status):
+            if status == "welcome":
+                messagebox.showinfo("Login", f"Welcome back, {username}!")
+            else:
+                messagebox.showinfo("Success", f"User '{username}' registered successfully.")
 
-        if roll in [info["roll"] for info in self.users.values()] and username not in self.users:
-            messagebox.showerror("Error", "Roll number already registered with a different username!")
+            self.current_user = username
+            self.create_main_menu()
+
+        self.worker.submit(lambda engine: engine.login(username, roll, mobile), done, self.show_error, [self.login_button])
+
+    def create_main_menu(self):
+        self.show_screen("main_menu", self.build_main_menu)
+        self.remove_users_button.config(state=tk.DISABLED)
+        if self.current_user != self.admin_username:
             return
 
-        if username in self.users or any(info["roll"] == roll for info in self.users.values()):
-            messagebox.showinfo("Login", f"Welcome back, {username}!")
-        else:
-            self.users[username] = {"roll": roll, "mobile": mobile}
-            messagebox.showinfo("Success", f"User '{username}' registered successfully.")
-            self.save_data()
+        def done(user):
+            if user is not None and user["roll"] == self.admin_roll and user["mobile"] == self.admin_mobile:
+                self.remove_users_button.config(state=tk.NORMAL, command=self.remove_users)
 
-        self.current_user = username
-        self.create_main_menu()
+        username = self.current_user
+        self.worker.submit(lambda engine: engine.user(username), done, self.show_error)
 
-    def create_main_menu(self):
-        self.clear_screen()
-        tk.Label(self.root, text="Main Menu", font=("Arial", 16, "bold")).pack(pady=10)
-        tk.Button(self.root, text="Sell Tokens", command=self.create_sell_token_screen, bg="blue", fg="white", font=("Arial", 12)).pack(pady=5)
-        tk.Button(self.root, text="Display Available Tokens", command=self.display_tokens, bg="purple", fg="white", font=("Arial", 12)).pack(pady=5)
-        tk.Button(self.root, text="Buy Token", command=self.buy_token, bg="green", fg="white", font=("Arial", 12)).pack(pady=5)
-
-        if (self.current_user == self.admin_username and
-            self.users[self.current_user]["roll"] == self.admin_roll and
-            self.users[self.current_user]["mobile"] == self.admin_mobile):
-            self.remove_users_button = tk.Button(self.root, text="Remove Users", command=self.remove_users, bg="orange", fg="white", font=("Arial", 12))
-        else:
-            self.remove_users_button = tk.Button(self.root, text="Remove Users", state=tk.DISABLED, bg="orange", fg="white", font=("Arial", 12))
+    def build_main_menu(self, frame):
+        tk.Label(frame, text="Main Menu", font=("Arial", 16, "bold")).pack(pady=10)
+        tk.Button(frame, text="Sell Tokens", command=self.create_sell_token_screen, bg="blue", fg="white", font=("Arial", 12)).pack(pady=5)
+        tk.Button(frame, text="Display Available Tokens", command=self.display_tokens, bg="purple", fg="white", font=("Arial", 12)).pack(pady=5)
+        tk.Button(frame, text="Buy Token", command=self.buy_token, bg="green", fg="white", font=("Arial", 12)).pack(pady=5)
+        tk.Button(frame, text="Dashboard", command=self.show_dashboard, bg="teal", fg="white", font=("Arial", 12)).pack(pady=5)
+
+        self.remove_users_button = tk.Button(frame, text="Remove Users", state=tk.DISABLED, bg="orange", fg="white", font=("Arial", 12))
         self.remove_users_button.pack(pady=5)
 
-        tk.Button(self.root, text="Exit", command=self.root.quit, bg="red", fg="white", font=("Arial", 12)).pack(pady=5)
+        tk.Button(frame, text="Exit", command=self.root.quit, bg="red", fg="white", font=("Arial", 12)).pack(pady=5)
 
     def create_sell_token_screen(self):
-        self.clear_screen()
-        tk.Label(self.root, text="Sell Tokens", font=("Arial", 16, "bold")).pack(pady=10)
+        self.show_screen("sell", self.build_sell_token_screen)
 
-        tk.Label(self.root, text="Select Hall:").pack()
-        self.hall_var = tk.StringVar(self.root)
+    def build_sell_token_screen(self, frame):
+        tk.Label(frame, text="Sell Tokens", font=("Arial", 16, "bold")).pack(pady=10)
+
+        tk.Label(frame, text="Select Hall:").pack()
+        self.hall_var = tk.StringVar(frame)
         self.hall_var.set(self.default_halls[0])
-        self.hall_menu = tk.OptionMenu(self.root, self.hall_var, *self.default_halls)
+        self.hall_menu = tk.OptionMenu(frame, self.hall_var, *self.default_halls)
         self.hall_menu.pack()
 
-        tk.Label(self.root, text="Meal Type:").pack()
-        self.meal_type_var = tk.StringVar(self.root)
+        tk.Label(frame, text="Meal Type:").pack()
+        self.meal_type_var = tk.StringVar(frame)
         self.meal_type_var.set("Lunch")
-        self.meal_type_menu = tk.OptionMenu(self.root, self.meal_type_var, "Lunch", "Dinner")
+        self.meal_type_menu = tk.OptionMenu(frame, self.meal_type_var, "Lunch", "Dinner")
         self.meal_type_menu.pack()
 
-        tk.Label(self.root, text="Number of Tokens:").pack()
-        self.token_entry = tk.Entry(self.root)
+        tk.Label(frame, text="Number of Tokens:").pack()
+        self.token_entry = tk.Entry(frame)
         self.token_entry.pack()
 
-        tk.Button(self.root, text="Sell", command=self.sell_token, bg="green", fg="white", font=("Arial", 12)).pack(pady=10)
-        tk.Button(self.root, text="Back", command=self.create_main_menu, bg="red", fg="white", font=("Arial", 12)).pack(pady=5)
+        tk.Label(frame, text="Price per Token (blank for free):").pack()
+        self.price_entry = tk.Entry(frame)
+        self.price_entry.pack()
+
+        self.sell_button = tk.Button(frame, text="Sell", command=self.sell_token, bg="green", fg="white", font=("Arial", 12))
+        self.sell_button.pack(pady=10)
+        tk.Button(frame, text="Back", command=self.create_main_menu, bg="red", fg="white", font=("Arial", 12)).pack(pady=5)
 
     def sell_token(self):
         hall = self.hall_var.get()
@@ -136,68 +168,98 @@ class TokenSystemGUI:
             return
 
         tokens = int(tokens)
-        current_time = datetime.now().time()
-
-        if (meal_type == "Lunch" and current_time > time(14, 0)) or (meal_type == "Dinner" and current_time > time(22, 0)):
-            messagebox.showerror("Error", f"Cannot sell {meal_type} tokens after { '2 PM' if meal_type == 'Lunch' else '10 PM' }.")
-            return
+        price = self.price_entry.get().strip() or 0
+        username = self.current_user
+
+        def done(listing):
+            message = f"Successfully listed {tokens} tokens for {meal_type} at {hall}."
+            for buyer in listing["matched"]:
+                message += (
+                    f"\n\nMatched a waiting buyer: {buyer['username']}\n"
+                    f"Mobile Number: {buyer['mobile']}\n"
+                    f"Tokens Bought: {buyer['tokens_bought']} at {buyer['price']} each"
+                )
+            messagebox.showinfo("Success", message)
+            self.create_main_menu()
 
-        self.halls[hall].append({
-            "username": self.current_user,
-            "meal_type": meal_type,
-            "tokens": tokens,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        })
-        self.save_data()
-        messagebox.showinfo("Success", f"Successfully sold {tokens} tokens for {meal_type} at {hall}.")
-        self.create_main_menu()
+        self.worker.submit(lambda engine: engine.list_tokens(username, hall, meal_type, tokens, price=price),
+                           done, self.show_error, [self.sell_button])
 
     def display_tokens(self):
-        self.clear_screen()
-        tk.Label(self.root, text="Available Tokens", font=("Arial", 16, "bold")).pack(pady=10)
-
-        self.remove_expired_tokens()
-
-        for hall, tokens in self.halls.items():
-            tk.Label(self.root, text=hall, font=("Arial", 14, "bold")).pack()
-            for token in tokens:
-                tk.Label(self.root, text=f"Seller: {token['username']} | Meal: {token['meal_type']} | Tokens: {token['tokens']} | Time: {token['timestamp']}").pack()
-        tk.Button(self.root, text="Back", command=self.create_main_menu, bg="red", fg="white", font=("Arial", 12)).pack(pady=5)
-
-    def remove_expired_tokens(self):
-        current_time = datetime.now().time()
-        for hall in self.halls:
-            self.halls[hall] = [
-                token for token in self.halls[hall]
-                if not (
-                    (token['meal_type'] == "Lunch" and current_time > time(14, 10)) or
-                    (token['meal_type'] == "Dinner" and current_time > time(22, 10))
-                )
-            ]
-        self.save_data()
+        # The table is loaded once and then kept current by engine events; later visits only sweep expired tokens.
+        first_visit = "tokens" not in self.screens
+        self.show_screen("tokens", self.build_tokens_screen)
+        if first_visit:
+            self.reload_listings()
+        else:
+            self.worker.submit(self.remove_expired_tokens, None, self.show_error)
+
+    def reload_listings(self):
+        def job(engine):
+            self.remove_expired_tokens(engine)
+            return engine.snapshot()
+
+        self.worker.submit(job, self.listing_view.load, self.show_error)
+
+    def on_book_event(self, event):
+        if event["type"] in ("listed", "filled"):
+            self.listing_view.upsert(event["hall"], event["listing"])
+        elif event["type"] in ("expired", "removed"):
+            self.listing_view.delete(event["listing"]["id"])
+        elif event["type"] == "reset":
+            self.reload_listings()
+
+    def build_tokens_screen(self, frame):
+        tk.Label(frame, text="Available Tokens", font=("Arial", 16, "bold")).pack(pady=10)
+        self.listing_view = ListingView(frame, self.default_halls)
+        self.listing_view.pack(fill=tk.BOTH, expand=True)
+        self.worker.subscribe(self.on_book_event)
+        tk.Button(frame, text="Back", command=self.create_main_menu, bg="red", fg="white", font=("Arial", 12)).pack(pady=5)
+
+    def show_dashboard(self):
+        self.show_screen("dashboard", self.build_dashboard_screen)
+        username = self.current_user
+        self.worker.submit(lambda engine: engine.summary(username=username), self.dashboard_view.load, self.show_error)
+
+    def build_dashboard_screen(self, frame):
+        tk.Label(frame, text="Dashboard", font=("Arial", 16, "bold")).pack(pady=10)
+        self.dashboard_view = DashboardView(frame)
+        self.dashboard_view.pack(fill=tk.BOTH, expand=True)
+        tk.Button(frame, text="Refresh", command=self.show_dashboard, font=("Arial", 12)).pack(pady=5)
+        tk.Button(frame, text="Back", command=self.create_main_menu, bg="red", fg="white", font=("Arial", 12)).pack(pady=5)
+
+    def remove_expired_tokens(self, engine):
+        engine.expire()
 
     def buy_token(self):
-        self.clear_screen()
-        tk.Label(self.root, text="Buy Tokens", font=("Arial", 16, "bold")).pack(pady=10)
+        self.show_screen("buy", self.build_buy_token_screen)
 
-        tk.Label(self.root, text="Select Hall:").pack()
-        self.buy_hall_var = tk.StringVar(self.root)
+    def build_buy_token_screen(self, frame):
+        tk.Label(frame, text="Buy Tokens", font=("Arial", 16, "bold")).pack(pady=10)
+
+        tk.Label(frame, text="Select Hall:").pack()
+        self.buy_hall_var = tk.StringVar(frame)
         self.buy_hall_var.set(self.default_halls[0])
-        self.buy_hall_menu = tk.OptionMenu(self.root, self.buy_hall_var, *self.default_halls)
+        self.buy_hall_menu = tk.OptionMenu(frame, self.buy_hall_var, *self.default_halls)
         self.buy_hall_menu.pack()
 
-        tk.Label(self.root, text="Meal Type:").pack()
-        self.buy_meal_type_var = tk.StringVar(self.root)
+        tk.Label(frame, text="Meal Type:").pack()
+        self.buy_meal_type_var = tk.StringVar(frame)
         self.buy_meal_type_var.set("Lunch")
-        self.buy_meal_type_menu = tk.OptionMenu(self.root, self.buy_meal_type_var, "Lunch", "Dinner")
+        self.buy_meal_type_menu = tk.OptionMenu(frame, self.buy_meal_type_var, "Lunch", "Dinner")
         self.buy_meal_type_menu.pack()
 
-        tk.Label(self.root, text="Number of Tokens to Buy:").pack()
-        self.buy_token_entry = tk.Entry(self.root)
+        tk.Label(frame, text="Number of Tokens to Buy:").pack()
+        self.buy_token_entry = tk.Entry(frame)
         self.buy_token_entry.pack()
 
-        tk.Button(self.root, text="Buy", command=self.process_buy_token, bg="green", fg="white", font=("Arial", 12)).pack(pady=10)
-        tk.Button(self.root, text="Back", command=self.create_main_menu, bg="red", fg="white", font=("Arial", 12)).pack(pady=5)
+        tk.Label(frame, text="Max Price per Token (blank to buy at any price):").pack()
+        self.buy_price_entry = tk.Entry(frame)
+        self.buy_price_entry.pack()
+
+        self.buy_button = tk.Button(frame, text="Buy", command=self.process_buy_token, bg="green", fg="white", font=("Arial", 12))
+        self.buy_button.pack(pady=10)
+        tk.Button(frame, text="Back", command=self.create_main_menu, bg="red", fg="white", font=("Arial", 12)).pack(pady=5)
 
     def process_buy_token(self):
         hall = self.buy_hall_var.get()
@@ -209,81 +271,73 @@ class TokenSystemGUI:
             return
 
         tokens_to_buy = int(tokens_to_buy)
-        available_tokens = [token for token in self.halls[hall] if token['meal_type'] == meal_type]
-
-        if not available_tokens:
-            messagebox.showerror("Error", f"No tokens available for {meal_type} at {hall}.")
-            return
-
-        total_available = sum(token['tokens'] for token in available_tokens)
-        if tokens_to_buy > total_available:
-            messagebox.showerror("Error", f"Not enough tokens available. Only {total_available} tokens are available.")
-            return
-
-        sellers_info = []
-        for token in available_tokens:
-            if tokens_to_buy <= 0:
-                break
-            if token['tokens'] >= tokens_to_buy:
-                sellers_info.append({
-                    "username": token['username'],
-                    "mobile": self.users[token['username']]['mobile'],
-                    "tokens_sold": tokens_to_buy
-                })
-                token['tokens'] -= tokens_to_buy
-                tokens_to_buy = 0
-            else:
-                sellers_info.append({
-                    "username": token['username'],
-                    "mobile": self.users[token['username']]['mobile'],
-                    "tokens_sold": token['tokens']
-                })
-                tokens_to_buy -= token['tokens']
-                token['tokens'] = 0
+        max_price = self.buy_price_entry.get().strip()
+        username = self.current_user
+
+        def done(result):
+            # A market buy returns the sellers; a limit bid also says what is left resting on the book.
+            sellers_info, resting = (result["sellers"], result["bid"]) if isinstance(result, dict) else (result, None)
+            seller_info_message = ""
+            if sellers_info:
+                seller_info_message = "Tokens purchased successfully! Contact the seller(s) for further details:\n\n"
+                for seller in sellers_info:
+                    seller_info_message += (
+                        f"Seller Name: {seller['username']}\n"
+                        f"Mobile Number: {seller['mobile']}\n"
+                        f"Tokens Sold: {seller['tokens_sold']} at {seller['price']} each\n\n"
+                    )
+                seller_info_message += "Please contact the seller(s) to complete the transaction.\n\n"
+            if resting is not None:
+                seller_info_message += (
+                    f"Your bid for {resting['tokens']} tokens at up to {resting['price']} each is waiting "
+                    f"and will fill as soon as a seller lists at that price."
+                )
 
+            messagebox.showinfo("Success", seller_info_message.strip())
+            self.create_main_menu()
 
-        self.halls[hall] = [token for token in self.halls[hall] if token['tokens'] > 0]
+        if max_price:
+            job = lambda engine: engine.bid(username, hall, meal_type, tokens_to_buy, max_price)
+        else:
+            job = lambda engine: engine.buy(username, hall, meal_type, tokens_to_buy)
+        self.worker.submit(job, done, self.show_error, [self.buy_button])
 
-        self.save_data()
+    def remove_users(self):
+        self.show_screen("remove_users", self.build_remove_users_screen)
 
-        seller_info_message = "Tokens purchased successfully! Contact the seller(s) for further details:\n\n"
-        for seller in sellers_info:
-            seller_info_message += (
-                f"Seller Name: {seller['username']}\n"
-                f"Mobile Number: {seller['mobile']}\n"
-                f"Tokens Sold: {seller['tokens_sold']}\n\n"
-            )
-        seller_info_message += "Please contact the seller(s) to complete the transaction."
+        def done(usernames):
+            self.user_listbox.delete(0, tk.END)
+            for user in usernames:
+                self.user_listbox.insert(tk.END, user)
 
-        messagebox.showinfo("Success", seller_info_message)
-        self.create_main_menu()
+        self.worker.submit(lambda engine: engine.usernames(), done, self.show_error)
 
-    def remove_users(self):
-        self.clear_screen()
-        tk.Label(self.root, text="Remove Users", font=("Arial", 16, "bold")).pack(pady=10)
+    def build_remove_users_screen(self, frame):
+        tk.Label(frame, text="Remove Users", font=("Arial", 16, "bold")).pack(pady=10)
 
-        tk.Label(self.root, text="Select User to Remove:").pack()
-        self.user_listbox = Listbox(self.root)
-        for user in self.users:
-            self.user_listbox.insert(tk.END, user)
+        tk.Label(frame, text="Select User to Remove:").pack()
+        self.user_listbox = Listbox(frame)
         self.user_listbox.pack()
 
-        tk.Button(self.root, text="Remove Selected User", command=self.process_remove_user, bg="red", fg="white", font=("Arial", 12)).pack(pady=10)
-        tk.Button(self.root, text="Back", command=self.create_main_menu, bg="red", fg="white", font=("Arial", 12)).pack(pady=5)
+        self.remove_button = tk.Button(frame, text="Remove Selected User", command=self.process_remove_user, bg="red", fg="white", font=("Arial", 12))
+        self.remove_button.pack(pady=10)
+        tk.Button(frame, text="Back", command=self.create_main_menu, bg="red", fg="white", font=("Arial", 12)).pack(pady=5)
 
     def process_remove_user(self):
         selected_user = self.user_listbox.get(tk.ACTIVE)
         if selected_user:
-            del self.users[selected_user]
-            for hall in self.halls:
-                self.halls[hall] = [token for token in self.halls[hall] if token['username'] != selected_user]
-            self.save_data()
-            messagebox.showinfo("Success", f"User '{selected_user}' has been removed.")
-            self.create_main_menu()
+            def done(result):
+                messagebox.showinfo("Success", f"User '{selected_user}' has been removed.")
+                self.create_main_menu()
+
+            self.worker.submit(lambda engine: engine.remove_user(selected_user), done, self.show_error, [self.remove_button])
         else:
             messagebox.showerror("Error", "No user selected!")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Token Trading System")
+    metrics.add_arguments(parser)
+    metrics.configure(parser.parse_args())
     root = tk.Tk()
     app = TokenSystemGUI(root)
     root.mainloop()
\ No newline at end of file
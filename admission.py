@@ -0,0 +1,129 @@
+import asyncio
+import time
+from collections import deque
+
+from engine import TradeError
+from metrics import REGISTRY
+
+
+class Rejected(TradeError):
+    # Refused before it reached the engine: 429 for a rate limit, 503 when the server is too far behind.
+    def __init__(self, message, status=429, retry_after=1.0):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def retry_after(self):
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class AdmissionControl:
+    # Every request takes from its client address's bucket, and from a bucket for the user it names at that address.
+    # The address bucket holds back a client that changes the username on every request. Keying users by address
+    # as well means a client writing under someone else's name only uses up its own share. Writes also share one
+    # global bucket. Only used from the server's event loop, so there is no locking.
+    MAX_IDLE_BUCKETS = 10000
+
+    def __init__(self, user_rate=10.0, user_burst=30, global_rate=1000.0, global_burst=1000, peer_rate=100.0,
+                 peer_burst=200):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.peer_rate = peer_rate
+        self.peer_burst = peer_burst
+        self.buckets = {}
+        self.shared = TokenBucket(global_rate, global_burst) if global_rate else None
+
+    def _bucket(self, key, rate, burst, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.MAX_IDLE_BUCKETS:
+                self._prune(now)
+            bucket = self.buckets[key] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def admit(self, peer, username=None, write=True):
+        now = time.monotonic()
+        if self.peer_rate:
+            bucket = self._bucket(("peer", peer), self.peer_rate, self.peer_burst, now)
+            if not bucket.take(now):
+                REGISTRY.inc("server_rejections_total", reason="peer_rate")
+                raise Rejected("Too many requests from this address; slow down and try again.", 429,
+                               bucket.retry_after())
+        if self.user_rate and username is not None:
+            bucket = self._bucket(("user", peer, username), self.user_rate, self.user_burst, now)
+            if not bucket.take(now):
+                REGISTRY.inc("server_rejections_total", reason="user_rate")
+                raise Rejected("Too many requests; slow down and try again.", 429, bucket.retry_after())
+        if write and self.shared is not None and not self.shared.take(now):
+            REGISTRY.inc("server_rejections_total", reason="global_rate")
+            raise Rejected("The server is busy; try again shortly.", 503, self.shared.retry_after())
+
+    def _prune(self, now):
+        # A bucket that has refilled completely behaves exactly like a new one, so it can be dropped.
+        for key in [key for key, bucket in self.buckets.items() if bucket.full(now)]:
+            del self.buckets[key]
+
+
+class FairQueue:
+    # Pending writes for one writer task: a FIFO per hall, served round-robin, so a burst on one hall cannot hold up
+    # the others. It never blocks a producer; once capacity calls are waiting, put() refuses instead.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.halls = {}
+        self.turns = deque()
+        self.size = 0
+        self.ready = asyncio.Event()
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return not self.size
+
+    def put(self, hall, item):
+        if self.size >= self.capacity:
+            raise asyncio.QueueFull
+        pending = self.halls.get(hall)
+        if pending is None:
+            pending = self.halls[hall] = deque()
+            self.turns.append(hall)
+        pending.append(item)
+        self.size += 1
+        self.ready.set()
+
+    async def get(self):
+        while not self.size:
+            self.ready.clear()
+            await self.ready.wait()
+        hall = self.turns.popleft()
+        pending = self.halls[hall]
+        item = pending.popleft()
+        if pending:
+            self.turns.append(hall)
+        else:
+            del self.halls[hall]
+        self.size -= 1
+        return item
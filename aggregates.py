@@ -0,0 +1,172 @@
+import argparse
+from datetime import datetime
+
+from expiry import parse_timestamp
+from records import Names, epoch_day
+
+BUCKET_FIELDS = ("available", "listings", "filled", "volume", "expired")
+SELLER_FIELDS = ("available", "listings", "sold", "volume", "expired")
+# Only these survive a snapshot; available and listings are rebuilt from the open listings on load.
+CLOSED_BUCKET_FIELDS = ("filled", "volume", "expired")
+CLOSED_SELLER_FIELDS = ("sold", "volume", "expired")
+
+
+def listing_day(timestamp):
+    if len(timestamp) == 19 and timestamp[4] == "-":
+        return timestamp[:10]
+    parsed = parse_timestamp(timestamp)
+    return parsed.date().isoformat() if parsed is not None else ""
+
+
+class Aggregates:
+    # Running totals per (hall, meal, day) and per seller, kept up to date by the order book in O(1) per event.
+    # Sellers are keyed by their id in the book's Names table.
+    def __init__(self, names=None):
+        self.names = names if names is not None else Names()
+        self.buckets = {}
+        self.sellers = {}
+
+    def _rows(self, listing):
+        key = (listing.hall, listing.meal, epoch_day(listing.created))
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = dict.fromkeys(BUCKET_FIELDS, 0)
+        seller = self.sellers.get(listing.user)
+        if seller is None:
+            seller = self.sellers[listing.user] = dict.fromkeys(SELLER_FIELDS, 0)
+        return bucket, seller
+
+    def seller_row(self, name):
+        user = self.names.id(name)
+        seller = self.sellers.get(user)
+        if seller is None:
+            seller = self.sellers[user] = dict.fromkeys(SELLER_FIELDS, 0)
+        return seller
+
+    def listed(self, listing):
+        bucket, seller = self._rows(listing)
+        for row in (bucket, seller):
+            row["available"] += listing.tokens
+            row["listings"] += 1
+
+    def filled(self, listing, quantity, price):
+        # Called after the listing's own count has been reduced.
+        bucket, seller = self._rows(listing)
+        for row in (bucket, seller):
+            row["available"] -= quantity
+            row["volume"] += quantity * price
+            if listing.tokens == 0:
+                row["listings"] -= 1
+        bucket["filled"] += quantity
+        seller["sold"] += quantity
+
+    def removed(self, listing, expired=False):
+        bucket, seller = self._rows(listing)
+        for row in (bucket, seller):
+            row["available"] -= listing.tokens
+            row["listings"] -= 1
+        if expired:
+            bucket["expired"] += listing.tokens
+            seller["expired"] += listing.tokens
+
+    def summary(self, hall=None, day=None, username=None):
+        # Rows that net out to nothing (say, a removed user's listings) are left out.
+        buckets = [
+            dict(zip(("hall", "meal_type", "day"), key), **row)
+            for key, row in sorted(self.buckets.items())
+            if any(row.values()) and (hall is None or key[0] == hall) and (day is None or key[2] == day)
+        ]
+        sellers = [
+            dict(row, username=self.names[user])
+            for user, row in sorted(self.sellers.items(), key=lambda item: self.names[item[0]])
+            if any(row.values()) and (username is None or self.names[user] == username)
+        ]
+        return {"buckets": buckets, "sellers": sellers}
+
+    def to_json(self):
+        return {
+            "buckets": [list(key) + [row[field] for field in CLOSED_BUCKET_FIELDS]
+                        for key, row in self.buckets.items() if any(row[field] for field in CLOSED_BUCKET_FIELDS)],
+            "sellers": [[self.names[user]] + [row[field] for field in CLOSED_SELLER_FIELDS]
+                        for user, row in self.sellers.items() if any(row[field] for field in CLOSED_SELLER_FIELDS)],
+        }
+
+    def to_rows(self):
+        # Every field, open ones included, with sellers by id; the binary snapshot stores this so that its halls
+        # can stay undecoded until they are used.
+        return {
+            "buckets": [list(key) + [row[field] for field in BUCKET_FIELDS]
+                        for key, row in self.buckets.items() if any(row.values())],
+            "sellers": [[user] + [row[field] for field in SELLER_FIELDS]
+                        for user, row in self.sellers.items() if any(row.values())],
+        }
+
+    def load_rows(self, data):
+        for hall, meal, day, *values in data["buckets"]:
+            self.buckets[(hall, meal, day)] = dict(zip(BUCKET_FIELDS, values))
+        for user, *values in data["sellers"]:
+            self.sellers[user] = dict(zip(SELLER_FIELDS, values))
+
+    def load_closed(self, data):
+        for hall, meal, day, *values in (data or {}).get("buckets", []):
+            bucket = self.buckets.setdefault((hall, meal, day), dict.fromkeys(BUCKET_FIELDS, 0))
+            for field, value in zip(CLOSED_BUCKET_FIELDS, values):
+                bucket[field] += value
+        for name, *values in (data or {}).get("sellers", []):
+            seller = self.seller_row(name)
+            for field, value in zip(CLOSED_SELLER_FIELDS, values):
+                seller[field] += value
+
+
+def recompute(book, history):
+    # Rebuilds the totals from scratch: open listings from the book, closed ones from the trade history.
+    stats = Aggregates(book.names)
+    for hall in book.halls:
+        for listing in book.hall_listings(hall):
+            stats.listed(listing)
+    for event in history.events():
+        if event["seller"] is None:
+            continue
+        day = datetime.fromtimestamp(event["listed_at"]).date().isoformat()
+        bucket = stats.buckets.setdefault((event["hall"], event["meal"], day), dict.fromkeys(BUCKET_FIELDS, 0))
+        seller = stats.seller_row(event["seller"])
+        if event["kind"] == "fill":
+            bucket["filled"] += event["qty"]
+            bucket["volume"] += event["qty"] * event["price"]
+            seller["sold"] += event["qty"]
+            seller["volume"] += event["qty"] * event["price"]
+        else:
+            bucket["expired"] += event["qty"]
+            seller["expired"] += event["qty"]
+    return stats
+
+
+def differences(maintained, recomputed):
+    for name, left, right in (("bucket", maintained.buckets, recomputed.buckets),
+                              ("seller", maintained.sellers, recomputed.sellers)):
+        for key in sorted(left.keys() | right.keys(), key=str):
+            a = left.get(key, {})
+            b = right.get(key, {})
+            label = key if name == "bucket" else maintained.names[key]
+            for field in sorted(a.keys() | b.keys()):
+                if a.get(field, 0) != b.get(field, 0):
+                    yield name, label, field, a.get(field, 0), b.get(field, 0)
+
+
+def main():
+    from engine import TokenEngine
+
+    parser = argparse.ArgumentParser(description="Check the running hall and seller totals against the trade history")
+    parser.add_argument("--data", default="token_data.json")
+    args = parser.parse_args()
+
+    engine = TokenEngine(args.data)
+    mismatches = list(differences(engine.book.stats, recompute(engine.book, engine.history)))
+    engine.close()
+    for name, key, field, maintained, recomputed in mismatches:
+        print(f"{name} {key} {field}: maintained {maintained}, recomputed {recomputed}")
+    print(f"{len(mismatches)} mismatches.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,37 @@
-import json
+import argparse
+import time
 from datetime import datetime
 
+import metrics
+from client import connect_engine
+from engine import TradeError
+from expiry import CLI_CUTOFFS, CLI_SELL_CUTOFFS
+
+
 class TokenSystem:
     def __init__(self):
         self.data_file = "token_data.json"
-        self.default_halls = ["Zia Hall", "Hamid Hall", "Shahidul Hall", "Bongobandhu Hall", "Selim Hall"]
-        self.load_data()
-
-    def load_data(self):
-        try:
-            with open(self.data_file, "r") as file:
-                data = json.load(file)
-                self.users = data.get("users", {})
-                self.halls = {hall: data.get("halls", {}).get(hall, []) for hall in self.default_halls}
-        except (FileNotFoundError, json.decoder.JSONDecodeError):
-            self.users = {}
-            self.halls = {hall: [] for hall in self.default_halls}
-        self.save_data()
-
-    def save_data(self):
-        with open(self.data_file, "w") as file:
-            json.dump({"users": self.users, "halls": self.halls}, file, indent=4)
+        self.engine = connect_engine(data_file=self.data_file, cutoffs=CLI_CUTOFFS, sell_cutoffs=CLI_SELL_CUTOFFS)
+        self.default_halls = self.engine.halls
 
     def login(self, username, roll, mobile):
-        for user, info in self.users.items():
-            if info["roll"] == roll:
-                print(f"A user with roll number {roll} already exists as '{user}'. Please log in.")
-                return
+        try:
+            status = self.engine.login(username, roll, mobile)
+        except TradeError as e:
+            print(e)
+            return
 
-        if username in self.users:
+        if status == "welcome":
             print(f"Welcome back, {username}!")
         else:
-            self.users[username] = {"roll": roll, "mobile": mobile}
             print(f"User '{username}' registered successfully.")
-            self.save_data()
 
-    def sell_tokens(self, username, hall, token_count, meal_type):
-        if username not in self.users:
+    def sell_tokens(self, username, hall, token_count, meal_type, price=0):
+        if self.engine.user(username) is None:
             print(f"User '{username}' does not exist. Please log in first.")
             return
 
-        if hall not in self.halls:
+        if hall not in self.default_halls:
             print(f"Hall '{hall}' does not exist.")
             return
 
@@ -56,60 +47,30 @@ class TokenSystem:
         while True:
             user_time = input("Enter timestamp (DD/MM/YY hh:mm AM/PM): ").strip()
             try:
-                now = datetime.strptime(user_time, "%d/%m/%y %I:%M %p")  
-
-                if meal_type.lower() == "lunch" and now.hour >= 14:
-                    print("You cannot add lunch tokens after 2 PM.")
-                    return
-                elif meal_type.lower() == "dinner" and (now.hour > 22 or (now.hour == 22 and now.minute > 15)):
-                    print("You cannot add dinner tokens after 10:15 PM.")
-                    return
-
+                now = datetime.strptime(user_time, "%d/%m/%y %I:%M %p")
                 break
             except ValueError:
                 print("Invalid format! Please enter in DD/MM/YY hh:mm AM/PM format.")
 
-        timestamp = now.strftime("%d/%m/%y %I:%M %p")
-
-        seller_info = {
-            "username": username,
-            "roll": self.users[username]["roll"],
-            "mobile": self.users[username]["mobile"],
-            "tokens": token_count,
-            "meal_type": meal_type,
-            "timestamp": timestamp
-        }
-        self.halls[hall].append(seller_info)
-        print(f"{token_count} {meal_type} tokens added to {hall} by {username} at {timestamp}.")
-        self.save_data()
+        try:
+            listing = self.engine.list_tokens(username, hall, meal_type, token_count, at=now, price=price or 0)
+        except TradeError as e:
+            print(e)
+            return
+        print(f"{token_count} {listing['meal_type']} tokens added to {hall} by {username} at {listing['timestamp']}"
+              f" for {listing['price']} each.")
+        for buyer in listing["matched"]:
+            print(f"  Matched a resting bid: {buyer['tokens_bought']} tokens to {buyer['username']} at {buyer['price']}"
+                  f" (Roll: {buyer['roll']}, Mobile: {buyer['mobile']})")
 
     def display_hall_tokens(self):
-        now = datetime.now()
-        today_str = now.strftime("%d/%m/%y")
+        self.engine.expire()
+        book = self.engine.snapshot()
 
         print("\n--- Available Tokens in Halls ---")
-        for hall, sellers in self.halls.items():
+        for hall in self.default_halls:
             print(f"\n {hall}:")
-            valid_sellers = []
-
-            for seller in sellers:
-                try:
-                    token_time = datetime.strptime(seller["timestamp"], "%d/%m/%y %I:%M %p")  
-                except ValueError:
-                    continue
-
-                token_date_str = token_time.strftime("%d/%m/%y")
-
-                if token_date_str != today_str:
-                    continue
-
-                expiry_time = token_time.replace(hour=14, minute=0) if seller["meal_type"].lower() == "lunch" \
-                    else token_time.replace(hour=22, minute=30)
-
-                if now < expiry_time:
-                    valid_sellers.append(seller)
-
-            self.halls[hall] = valid_sellers
+            valid_sellers = book.get(hall, [])
 
             if not valid_sellers:
                 print("   No valid tokens available.")
@@ -117,35 +78,84 @@ class TokenSystem:
                 print("  ---------------------------------")
                 for i, seller in enumerate(valid_sellers, start=1):
                     print(
-                        f"  {i}. {seller['tokens']} {seller['meal_type']} tokens - Seller: {seller['username']} at {seller['timestamp']}")
+                        f"  {i}. {seller['tokens']} {seller['meal_type']} tokens at {seller.get('price', 0)} each"
+                        f" - Seller: {seller['username']} at {seller['timestamp']}")
                 print("  ---------------------------------")
+        return book
 
-        self.save_data()
-
-    def buy_tokens(self, buyer_username, hall, seller_index):
-        if buyer_username not in self.users:
+    def buy_tokens(self, buyer_username, hall, seller_index, book=None):
+        if self.engine.user(buyer_username) is None:
             print(f"User '{buyer_username}' does not exist. Please log in first.")
             return
 
-        if hall not in self.halls or not self.halls[hall]:
+        sellers = (book if book is not None else self.engine.snapshot(hall)).get(hall, [])
+        if not sellers:
             print(f"No available tokens in {hall}.")
             return
 
-        if not (1 <= seller_index <= len(self.halls[hall])):
+        seller_indexes = [seller_index] if isinstance(seller_index, int) else list(seller_index)
+        if not all(1 <= index <= len(sellers) for index in seller_indexes):
             print(f"Invalid seller selection for {hall}.")
             return
 
-        seller_info = self.halls[hall].pop(seller_index - 1)
-        print(f"Contact {seller_info['username']} for tokens:")
-        print(f"  Roll: {seller_info['roll']}")
-        print(f"  Mobile: {seller_info['mobile']}")
-        self.save_data()
+        orders = [{"hall": hall, "id": sellers[index - 1]["id"]} for index in seller_indexes]
+        try:
+            results = self.engine.buy_batch(buyer_username, orders)
+        except TradeError as e:
+            print(e)
+            return
+        for seller_info, in results:
+            print(f"Contact {seller_info['username']} for tokens:")
+            print(f"  Roll: {seller_info['roll']}")
+            print(f"  Mobile: {seller_info['mobile']}")
+
+    def place_bid(self, buyer_username, hall, meal_type, quantity, price):
+        try:
+            result = self.engine.bid(buyer_username, hall, meal_type, quantity, price)
+        except TradeError as e:
+            print(e)
+            return
+        for seller_info in result["sellers"]:
+            print(f"Bought {seller_info['tokens_sold']} tokens at {seller_info['price']} - contact {seller_info['username']}:")
+            print(f"  Roll: {seller_info['roll']}")
+            print(f"  Mobile: {seller_info['mobile']}")
+        if result["bid"] is not None:
+            print(f"Bid #{result['bid']['id']} for {result['bid']['tokens']} tokens at up to {result['bid']['price']} "
+                  f"is resting; it fills as soon as a matching ask is listed.")
+
+    def watch(self, hall=None, meal_type=None):
+        token = self.engine.subscribe(print_event, hall or None, meal_type or None)
+        print(f"Watching {hall or 'all halls'}. Press Ctrl+C to stop.")
+        try:
+            while True:
+                # For a local data file this picks up other processes' writes; a server pushes events instead.
+                self.engine.poll()
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.engine.unsubscribe(token)
 
     def reset_users(self):
-        self.users = {}
-        self.save_data()
+        self.engine.reset_users()
         print("All users have been erased.")
         
+def print_event(event):
+    listing = event.get("listing", {})
+    if event["type"] == "listed":
+        print(f"  + {event['hall']}: {listing['tokens']} {listing['meal_type']} tokens at {listing.get('price', 0)} "
+              f"from {listing['username']}")
+    elif event["type"] == "filled":
+        print(f"  - {event['hall']}: {event['quantity']} {listing['meal_type']} tokens sold by {listing['username']}, "
+              f"{listing['tokens']} left")
+    elif event["type"] in ("expired", "removed"):
+        print(f"  x {event['hall']}: {listing['tokens']} {listing['meal_type']} tokens from {listing['username']} {event['type']}")
+    elif event["type"] == "user_removed":
+        print(f"  User '{event['username']}' was removed.")
+    elif event["type"] == "reset":
+        print("  The book was reloaded; choose Display Available Tokens for a fresh view.")
+
+
 def main():
     system = TokenSystem()
 
@@ -155,8 +165,10 @@ def main():
         print("2. Sell Tokens")
         print("3. Display Available Tokens")
         print("4. Buy Tokens")
-        print("5. Reset Users")
-        print("6. Exit")
+        print("5. Place Bid")
+        print("6. Watch a Hall")
+        print("7. Reset Users")
+        print("8. Exit")
 
         choice = input("Enter your choice: ").strip()
 
@@ -167,25 +179,36 @@ def main():
             system.login(username, roll, mobile)
         elif choice == '2':
             username = input("Enter username: ").strip()
-            hall = input(
-                "Enter hall name (Zia Hall, Hamid Hall, Shahidul Hall, Bongobandhu Hall, Selim Hall): ").strip()
+            hall = input(f"Enter hall name ({', '.join(system.default_halls)}): ").strip()
             token_count = input("Enter number of tokens to sell: ").strip()
             meal_type = input("Enter meal type (Lunch/Dinner): ").strip()
-            system.sell_tokens(username, hall, token_count, meal_type)
+            price = input("Enter price per token (blank for free): ").strip()
+            system.sell_tokens(username, hall, token_count, meal_type, price)
         elif choice == '3':
             system.display_hall_tokens()
         elif choice == '4':
             buyer_username = input("Enter your username: ").strip()
             hall = input("Enter hall name: ").strip()
-            system.display_hall_tokens()
+            book = system.display_hall_tokens()
             try:
-                seller_index = int(input(f"Enter the seller index for {hall}: "))
-                system.buy_tokens(buyer_username, hall, seller_index)
+                seller_indexes = [int(index) for index in input(f"Enter the seller index(es) for {hall}, comma separated: ").split(",")]
+                system.buy_tokens(buyer_username, hall, seller_indexes, book)
             except ValueError:
                 print("Invalid input. Please enter a valid number.")
         elif choice == '5':
-            system.reset_users()
+            buyer_username = input("Enter your username: ").strip()
+            hall = input("Enter hall name: ").strip()
+            meal_type = input("Enter meal type (Lunch/Dinner): ").strip()
+            quantity = input("Enter number of tokens to buy: ").strip()
+            price = input("Enter the most you will pay per token: ").strip()
+            system.place_bid(buyer_username, hall, meal_type, quantity, price)
         elif choice == '6':
+            hall = input("Enter hall name (blank for all): ").strip()
+            meal_type = input("Enter meal type (Lunch/Dinner, blank for both): ").strip()
+            system.watch(hall, meal_type)
+        elif choice == '7':
+            system.reset_users()
+        elif choice == '8':
             print("Exiting the system. Goodbye!")
             break
         else:
@@ -193,4 +216,7 @@ def main():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Token Trading System command-line menu")
+    metrics.add_arguments(parser)
+    metrics.configure(parser.parse_args())
     main()
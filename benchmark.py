@@ -0,0 +1,439 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import queue as queues
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from admission import AdmissionControl
+from client import RemoteEngine
+from engine import DEFAULT_HALLS, TIMESTAMP_FORMAT, TokenEngine, TradeError
+from expiry import GUI_CUTOFFS
+from orderbook import OrderBook
+from records import Listing
+from server import TokenServer
+from snapshot import convert
+from sqlite_store import SqliteStore
+from users import UserDirectory
+
+BACKENDS = {"json": "token_data.json", "binary": "token_data.bin", "sqlite": "token_data.db"}
+MEALS = ("Lunch", "Dinner")
+MORNING = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
+# Share of each operation in the mixed workload; roughly what a lunch rush looks like.
+MIX = (("login", 0.15), ("list", 0.35), ("buy", 0.35), ("display", 0.05), ("expire", 0.10))
+SCRIPT_ADDRESS = ("127.0.0.2", 0)
+SCRIPT_NAMES = 1000
+HERE = os.path.dirname(os.path.abspath(__file__))
+STARTUP_RUNS = 10
+# Each entry is timed as a fresh interpreter from launch to exit. The GUI probe stops once the login screen is drawn.
+GUI_PROBE = (
+    "import tkinter as tk\n"
+    "from Maybe_final import TokenSystemGUI\n"
+    "root = tk.Tk()\n"
+    "app = TokenSystemGUI(root)\n"
+    "root.update()\n"
+    "app.worker.stop()\n"
+    "root.destroy()\n"
+)
+
+
+def populate(path, users, listings, seed):
+    rng = random.Random(seed)
+    timestamp = MORNING.strftime(TIMESTAMP_FORMAT)
+    user_rows = {f"user{i}": {"roll": f"{i:07d}", "mobile": f"01{i:09d}"} for i in range(users)}
+    halls = {hall: [] for hall in DEFAULT_HALLS}
+    for listing_id in range(1, listings + 1):
+        halls[rng.choice(DEFAULT_HALLS)].append({
+            "id": listing_id,
+            "username": f"user{rng.randrange(users)}",
+            "meal_type": rng.choice(MEALS),
+            "tokens": rng.randint(1, 5),
+            "timestamp": timestamp
+        })
+
+    if path.endswith(".db"):
+        store = SqliteStore(path)
+        with store.transaction():
+            for username, info in user_rows.items():
+                store.append("register", username=username, **info)
+            for hall, rows in halls.items():
+                for listing in rows:
+                    store.append("list", hall=hall, listing=listing)
+        store.close()
+    else:
+        json_path = path[:-len(".bin")] + ".json" if path.endswith(".bin") else path
+        with open(json_path, "w") as file:
+            json.dump({"users": user_rows, "halls": halls, "next_id": listings + 1, "seq": 0}, file)
+        if json_path != path:
+            convert(json_path, path, DEFAULT_HALLS)
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"count": 0}
+    return {
+        "count": len(latencies),
+        "ops_per_sec": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 4),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 4),
+        "max_ms": round(latencies[-1] * 1000, 4),
+    }
+
+
+class Workload:
+    def __init__(self, engine, users, seed):
+        self.engine = engine
+        self.users = users
+        self.rng = random.Random(seed)
+        self.new_users = 0
+        self.rejected = 0
+
+    def login(self):
+        if self.rng.random() < 0.8:
+            i = self.rng.randrange(self.users)
+            self.engine.login(f"user{i}", f"{i:07d}", f"01{i:09d}")
+        else:
+            self.new_users += 1
+            i = self.users + self.new_users
+            self.engine.login(f"user{i}", f"{i:07d}", f"01{i:09d}")
+
+    def list(self):
+        self.engine.list_tokens(f"user{self.rng.randrange(self.users)}", self.rng.choice(DEFAULT_HALLS),
+                                self.rng.choice(MEALS), self.rng.randint(1, 5), at=MORNING)
+
+    def buy(self):
+        try:
+            self.engine.buy(f"user{self.rng.randrange(self.users)}", self.rng.choice(DEFAULT_HALLS),
+                            self.rng.choice(MEALS), self.rng.randint(1, 3))
+        except TradeError:
+            self.rejected += 1
+
+    def display(self):
+        self.engine.expire(now=MORNING)
+        self.engine.snapshot(self.rng.choice(DEFAULT_HALLS))
+
+    def expire(self):
+        self.engine.expire(now=MORNING)
+
+    def save(self):
+        self.engine.store.compact(self.engine._state())
+
+
+def timed(fn, count):
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(count):
+        t = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def run_backend(backend, args, queue):
+    workdir = tempfile.mkdtemp(prefix=f"token-bench-{backend}-")
+    try:
+        path = os.path.join(workdir, BACKENDS[backend])
+        t = time.perf_counter()
+        populate(path, args.users, args.listings, args.seed)
+        populate_s = time.perf_counter() - t
+
+        t = time.perf_counter()
+        engine = TokenEngine(path)
+        load_s = time.perf_counter() - t
+        workload = Workload(engine, args.users, args.seed)
+
+        results = {
+            "populate_s": round(populate_s, 3),
+            "load": {"count": 1, "p50_ms": round(load_s * 1000, 3)},
+            "login": timed(workload.login, args.ops),
+            "list": timed(workload.list, args.ops),
+            "buy": timed(workload.buy, args.ops),
+            "expire": timed(workload.expire, args.ops),
+            "save": timed(workload.save, max(1, args.ops // 100)),
+        }
+
+        ops = [name for name, _ in MIX]
+        weights = [weight for _, weight in MIX]
+        per_op = {name: [] for name in ops}
+        start = time.perf_counter()
+        for name in workload.rng.choices(ops, weights, k=args.ops):
+            t = time.perf_counter()
+            getattr(workload, name)()
+            per_op[name].append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - start
+        results["mixed"] = summarize([latency for latencies in per_op.values() for latency in latencies], elapsed)
+        results["mixed"]["by_op"] = {name: summarize(latencies, elapsed) for name, latencies in per_op.items()}
+        results["buy_rejected"] = workload.rejected
+        engine.close()
+
+        # ru_maxrss is KiB on Linux and bytes on macOS.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results["peak_rss_kb"] = peak // 1024 if sys.platform == "darwin" else peak
+        queue.put((backend, results))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def memory_footprint(users, listings, seed):
+    # Traced bytes for the listings as the dicts json.load returns, which is what the engine used to keep, against
+    # the same listings as compact records, and against a whole order book with every index it keeps.
+    workdir = tempfile.mkdtemp(prefix="token-bench-memory-")
+    try:
+        path = os.path.join(workdir, BACKENDS["json"])
+        populate(path, users, listings, seed)
+        with open(path, "r") as file:
+            text = file.read()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    data = json.loads(text)
+    dicts = tracemalloc.get_traced_memory()[0] - base
+
+    book = OrderBook(DEFAULT_HALLS)
+    base = tracemalloc.get_traced_memory()[0]
+    orders = [book.decode(Listing, hall, listing) for hall in DEFAULT_HALLS for listing in data["halls"][hall]]
+    directory = UserDirectory(data["users"])
+    records = tracemalloc.get_traced_memory()[0] - base
+    del orders, directory, book
+
+    base = tracemalloc.get_traced_memory()[0]
+    state = (UserDirectory(data["users"]), OrderBook.from_halls(data["halls"], DEFAULT_HALLS, GUI_CUTOFFS))
+    indexed = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del state, data
+    return {
+        "users": users,
+        "listings": listings,
+        "dicts_bytes": dicts,
+        "records_bytes": records,
+        "book_bytes": indexed,
+        "dicts_bytes_per_listing": round(dicts / listings, 1),
+        "records_bytes_per_listing": round(records / listings, 1),
+        "book_bytes_per_listing": round(indexed / listings, 1),
+        "reduction": round(dicts / records, 2),
+    }
+
+
+def startup_times(users, listings, seed):
+    workdir = tempfile.mkdtemp(prefix="token-bench-startup-")
+    try:
+        path = os.path.join(workdir, BACKENDS["json"])
+        populate(path, users, listings, seed)
+        convert(path, os.path.join(workdir, BACKENDS["binary"]))
+        os.remove(path)
+        headless = os.path.join(HERE, "headless.py")
+        commands = {
+            "python": ["-c", "pass"],
+            "cli_import": ["-c", "import base"],
+            "headless": [headless, "--data", os.path.join(workdir, "empty.json"), "halls"],
+            "headless_binary": [headless, "--data", os.path.join(workdir, BACKENDS["binary"]), "book",
+                                "--hall", DEFAULT_HALLS[0]],
+            "gui": ["-c", GUI_PROBE],
+        }
+        env = dict(os.environ, PYTHONPATH=HERE)
+        env.pop("TOKEN_SERVER", None)
+        results = {}
+        for name, command in commands.items():
+            samples = []
+            for _ in range(STARTUP_RUNS):
+                start = time.perf_counter()
+                done = subprocess.run([sys.executable] + command, cwd=workdir, env=env, capture_output=True)
+                samples.append(time.perf_counter() - start)
+                if done.returncode:
+                    # Usually no display for the GUI; report why instead of a time.
+                    lines = done.stderr.decode(errors="replace").strip().splitlines()
+                    results[name] = {"error": lines[-1] if lines else f"exit code {done.returncode}"}
+                    break
+            else:
+                results[name] = {"median_ms": round(statistics.median(samples) * 1000, 1),
+                                 "max_ms": round(max(samples) * 1000, 1)}
+        check = subprocess.run([sys.executable, "-c", "import sys, headless; print('tkinter' in sys.modules)"],
+                               cwd=workdir, env=env, capture_output=True, text=True)
+        results["headless_imports_tkinter"] = check.stdout.strip() == "True"
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def serve_burst(path, limited, ports):
+    engine = TokenEngine(path)
+    if limited:
+        server = TokenServer(engine, port=0)
+    else:
+        server = TokenServer(engine, port=0, queue_size=10 ** 9, admission=AdmissionControl(0, 0, 0, 0, 0, 0), max_wait=0)
+
+    async def run():
+        await server.start()
+        ports.put(server.port)
+        await server.server.serve_forever()
+
+    asyncio.run(run())
+
+
+def flood(url, deadline, connections, rotating, counts):
+    def script(number):
+        client = RemoteEngine(url, source_address=SCRIPT_ADDRESS)
+        accepted = rejected = 0
+        sent = 0
+        while time.time() < deadline:
+            # A rotating script writes under a different registered name every time.
+            name = f"script{(number + sent * connections) % SCRIPT_NAMES}" if rotating else "script0"
+            sent += 1
+            try:
+                client.list_tokens(name, DEFAULT_HALLS[0], "Lunch", 1, at=MORNING)
+                accepted += 1
+            except TradeError:
+                rejected += 1
+        return accepted, rejected
+
+    with ThreadPoolExecutor(connections) as pool:
+        results = list(pool.map(script, range(connections)))
+    counts.put((sum(accepted for accepted, _ in results), sum(rejected for _, rejected in results)))
+
+
+def burst_latency(users, seconds, connections, limited, rotating=False):
+    # A lunch rush over HTTP: users list at a steady pace while a script hammers the server from many connections.
+    # Server, script and users each get their own process so they do not share a GIL. Every user connects from
+    # their own loopback address and the script from another, as they would from separate machines (Linux only).
+    workdir = tempfile.mkdtemp(prefix="token-bench-burst-")
+    path = os.path.join(workdir, BACKENDS["json"])
+    engine = TokenEngine(path)
+    for i in range(users):
+        engine.login(f"user{i}", f"{i:07d}", f"01{i:09d}")
+    for i in range(SCRIPT_NAMES):
+        engine.login(f"script{i}", f"9{i:06d}", f"019{i:09d}")
+    engine.close()
+
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_burst, args=(path, limited, ports), daemon=True)
+    server.start()
+    try:
+        url = f"http://127.0.0.1:{ports.get(timeout=60)}"
+        deadline = time.time() + seconds
+        counts = multiprocessing.Queue()
+        script = multiprocessing.Process(target=flood, args=(url, deadline, connections, rotating, counts), daemon=True)
+        script.start()
+
+        def user(i):
+            client = RemoteEngine(url, source_address=(f"127.0.1.{i + 1}", 0))
+            latencies, rejected = [], 0
+            while time.time() < deadline:
+                start = time.perf_counter()
+                try:
+                    client.list_tokens(f"user{i}", DEFAULT_HALLS[i % len(DEFAULT_HALLS)], "Lunch", 1, at=MORNING)
+                except TradeError:
+                    rejected += 1
+                latencies.append(time.perf_counter() - start)
+                time.sleep(0.2)
+            return latencies, rejected
+
+        with ThreadPoolExecutor(users) as pool:
+            people = list(pool.map(user, range(users)))
+        result = summarize([latency for latencies, _ in people for latency in latencies], seconds)
+        result["rejected"] = sum(rejected for _, rejected in people)
+        result["script_accepted"], result["script_rejected"] = counts.get(timeout=60)
+        script.join()
+        return result
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the token trading engine")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--listings", type=int, default=10000)
+    parser.add_argument("--ops", type=int, default=2000, help="operations per measured workload")
+    parser.add_argument("--backend", nargs="+", choices=sorted(BACKENDS), default=sorted(BACKENDS))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--memory", action="store_true", help="only measure the memory held per listing")
+    parser.add_argument("--startup", action="store_true", help="only measure how long each entry point takes to start")
+    parser.add_argument("--burst", type=float, metavar="SECONDS",
+                        help="only measure user latency over HTTP while a script floods the server, with and without "
+                             "admission control")
+    args = parser.parse_args()
+
+    report = {
+        "meta": {
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "users": args.users,
+            "listings": args.listings,
+            "ops": args.ops,
+            "seed": args.seed,
+        },
+        "results": {},
+    }
+    if args.memory:
+        report["memory"] = memory_footprint(args.users, args.listings, args.seed)
+        print(", ".join(f"{key} {value}" for key, value in report["memory"].items()))
+        with open(args.out, "w") as file:
+            json.dump(report, file, indent=4)
+        print(f"Results written to {args.out}")
+        return
+    if args.startup:
+        report["startup"] = startup_times(args.users, args.listings, args.seed)
+        for name, result in report["startup"].items():
+            print(f"{name}: " + (", ".join(f"{key} {value}" for key, value in result.items())
+                                 if isinstance(result, dict) else str(result)))
+        with open(args.out, "w") as file:
+            json.dump(report, file, indent=4)
+        print(f"Results written to {args.out}")
+        return
+
+    if args.burst:
+        # --users is the number of steady users here; each sends one listing every 0.2 s.
+        users = min(args.users, 50)
+        report["burst"] = {mode: burst_latency(users, args.burst, 32, mode != "unlimited", mode == "rotating_names")
+                           for mode in ("unlimited", "limited", "rotating_names")}
+        for mode, result in report["burst"].items():
+            print(f"{mode}: " + ", ".join(f"{key} {value}" for key, value in result.items()))
+        with open(args.out, "w") as file:
+            json.dump(report, file, indent=4)
+        print(f"Results written to {args.out}")
+        return
+
+    # Each backend runs in its own process so peak RSS is measured per backend.
+    queue = multiprocessing.Queue()
+    for backend in args.backend:
+        process = multiprocessing.Process(target=run_backend, args=(backend, args, queue))
+        process.start()
+        while True:
+            try:
+                name, results = queue.get(timeout=1)
+                break
+            except queues.Empty:
+                if not process.is_alive():
+                    sys.exit(f"{backend} benchmark exited with code {process.exitcode}")
+        process.join()
+        report["results"][name] = results
+        print(f"{name}: " + ", ".join(
+            f"{op} {results[op]['ops_per_sec']}/s p99 {results[op]['p99_ms']}ms"
+            for op in ("login", "list", "buy", "expire", "mixed")
+        ) + f", peak RSS {results['peak_rss_kb']} KiB")
+
+    with open(args.out, "w") as file:
+        json.dump(report, file, indent=4)
+    print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
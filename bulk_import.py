@@ -0,0 +1,67 @@
+import argparse
+import csv
+import json
+from itertools import islice
+
+from client import connect_engine
+from engine import TradeError
+
+FIELDS = ("username", "hall", "meal_type", "tokens")
+
+
+def read_orders(path):
+    # Yields one order at a time so a large file is never held in memory.
+    with open(path, "r", newline="") as file:
+        if path.endswith((".jsonl", ".ndjson")):
+            for line in file:
+                if line.strip():
+                    order = json.loads(line)
+                    if "timestamp" in order and "at" not in order:
+                        order["at"] = order.pop("timestamp")
+                    yield order
+        else:
+            for row in csv.DictReader(file):
+                # A missing column or a short row leaves the field out, and the engine rejects that batch for it.
+                order = {field: row[field].strip() for field in FIELDS if row.get(field) is not None}
+                if row.get("timestamp"):
+                    order["at"] = row["timestamp"].strip()
+                if row.get("price"):
+                    order["price"] = row["price"].strip()
+                yield order
+
+
+def chunks(orders, size):
+    orders = iter(orders)
+    while True:
+        chunk = list(islice(orders, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_listings(engine, path, chunk_size=500):
+    imported = 0
+    rejected = []
+    for number, chunk in enumerate(chunks(read_orders(path), chunk_size)):
+        try:
+            imported += len(engine.list_batch(chunk))
+        except TradeError as e:
+            rejected.append((number * chunk_size, str(e)))
+    return imported, rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import token listings from CSV or JSON lines")
+    parser.add_argument("path", help="CSV with username,hall,meal_type,tokens[,timestamp,price] columns, or a .jsonl file")
+    parser.add_argument("--data", default="token_data.json")
+    parser.add_argument("--chunk", type=int, default=500, help="listings committed per batch")
+    args = parser.parse_args()
+
+    imported, rejected = import_listings(connect_engine(data_file=args.data), args.path, args.chunk)
+    print(f"Imported {imported} listings.")
+    for offset, error in rejected:
+        print(f"Batch starting at row {offset + 1} rejected: {error}")
+
+
+if __name__ == "__main__":
+    main()
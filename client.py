@@ -0,0 +1,194 @@
+import json
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+from engine import TIMESTAMP_FORMAT, TokenEngine, TradeError
+
+
+class EventStream:
+    RETRY_SECONDS = 1.0
+
+    def __init__(self, host, port, callback, hall=None, meal_type=None, timeout=45):
+        query = {key: value for key, value in (("hall", hall), ("meal_type", meal_type)) if value}
+        self.path = f"/events?{urlencode(query)}" if query else "/events"
+        self.host = host
+        self.port = port
+        self.callback = callback
+        self.timeout = timeout
+        self.sock = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="event-stream", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        import http.client
+
+        connected_before = False
+        while not self.closed:
+            try:
+                connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                connection.request("GET", self.path)
+                # getresponse() hands the socket over to the response, so keep it to be able to shut it down.
+                self.sock = connection.sock
+                response = connection.getresponse()
+                if connected_before:
+                    # Anything published while we were disconnected is gone; the subscriber has to reload.
+                    self.callback({"type": "reset", "hall": None, "meal_type": None})
+                connected_before = True
+                for line in response:
+                    if line.startswith(b"data: "):
+                        self.callback(json.loads(line[6:]))
+            except (OSError, http.client.HTTPException, ValueError):
+                pass
+            if not self.closed:
+                time.sleep(self.RETRY_SECONDS)
+
+    def close(self):
+        self.closed = True
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class RemoteEngine:
+    def __init__(self, url, timeout=10, source_address=None):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 8765
+        self.timeout = timeout
+        # The server limits requests per client address; a machine with several addresses can pick the one to use.
+        self.source_address = source_address
+        self.connection = None
+        self.streams = {}
+
+    def _request(self, verb, path, payload=None):
+        # Imported here so a local engine never pays for http.client and the ssl module it loads.
+        import http.client
+
+        body = json.dumps(payload).encode() if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout,
+                                                             source_address=self.source_address)
+            try:
+                self.connection.request(verb, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                data = json.loads(response.read() or b"{}")
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # The server may have dropped an idle keep-alive connection; reconnect once.
+                self._disconnect()
+                if attempt:
+                    raise
+        if "error" in data:
+            raise TradeError(data["error"])
+        return data.get("result")
+
+    def _get(self, path, **query):
+        query = {key: value for key, value in query.items() if value is not None}
+        return self._request("GET", f"{path}?{urlencode(query)}" if query else path)
+
+    def _post(self, method, **kwargs):
+        for name in ("at", "now"):
+            if kwargs.get(name) is not None:
+                kwargs[name] = kwargs[name].strftime(TIMESTAMP_FORMAT)
+        return self._request("POST", f"/{method}", {key: value for key, value in kwargs.items() if value is not None})
+
+    def _disconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def close(self):
+        self._disconnect()
+        for stream in list(self.streams.values()):
+            stream.close()
+        self.streams.clear()
+
+    def subscribe(self, callback, hall=None, meal_type=None):
+        # Each subscription holds its own streaming connection and calls back from a background thread.
+        stream = EventStream(self.host, self.port, callback, hall, meal_type)
+        token = id(stream)
+        self.streams[token] = stream
+        return token
+
+    def unsubscribe(self, token):
+        stream = self.streams.pop(token, None)
+        if stream is None:
+            return False
+        stream.close()
+        return True
+
+    def poll(self):
+        # Events are pushed by the server; there is nothing to poll for.
+        return None
+
+    @property
+    def halls(self):
+        return self._get("/halls")
+
+    def user(self, username):
+        return self._get("/user", username=username)
+
+    def usernames(self):
+        return self._get("/users")
+
+    def snapshot(self, hall=None):
+        return self._get("/book", hall=hall)
+
+    def summary(self, hall=None, day=None, username=None):
+        return self._get("/summary", hall=hall, day=day, username=username)
+
+    def bids(self, hall=None, username=None):
+        return self._get("/bids", hall=hall, username=username)
+
+    def login(self, username, roll, mobile):
+        return self._post("login", username=username, roll=roll, mobile=mobile)
+
+    def list_tokens(self, username, hall, meal_type, tokens, at=None, price=0):
+        return self._post("list_tokens", username=username, hall=hall, meal_type=meal_type, tokens=tokens, at=at,
+                          price=price)
+
+    def list_batch(self, orders, at=None):
+        orders = [dict(order, at=order["at"].strftime(TIMESTAMP_FORMAT)) if hasattr(order.get("at"), "strftime") else order
+                  for order in orders]
+        return self._post("list_batch", orders=orders, at=at)
+
+    def buy_batch(self, username, orders):
+        return self._post("buy_batch", username=username, orders=orders)
+
+    def buy(self, username, hall, meal_type, quantity):
+        return self._post("buy", username=username, hall=hall, meal_type=meal_type, quantity=quantity)
+
+    def bid(self, username, hall, meal_type, quantity, price, at=None):
+        return self._post("bid", username=username, hall=hall, meal_type=meal_type, quantity=quantity, price=price, at=at)
+
+    def cancel_bid(self, username, bid_id):
+        return self._post("cancel_bid", username=username, bid_id=bid_id)
+
+    def take(self, username, hall, listing_id):
+        return self._post("take", username=username, hall=hall, listing_id=listing_id)
+
+    def expire(self, now=None):
+        return self._post("expire", now=now)
+
+    def remove_user(self, username):
+        return self._post("remove_user", username=username)
+
+    def reset_users(self):
+        return self._post("reset_users")
+
+
+def connect_engine(**kwargs):
+    # With TOKEN_SERVER set, every argument here is the server's business: it keeps its own data file and its own
+    # cutoffs and sell_cutoffs, and those are the ones a RemoteEngine's trades are checked against.
+    url = os.environ.get("TOKEN_SERVER")
+    if url:
+        return RemoteEngine(url)
+    return TokenEngine(**kwargs)
@@ -0,0 +1,10 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # Every test gets its own directory for data files, and the built-in halls.
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("TOKEN_HALLS", raising=False)
+    monkeypatch.delenv("TOKEN_SERVER", raising=False)
+    return tmp_path
@@ -0,0 +1,36 @@
+import tkinter as tk
+from tkinter import ttk
+
+COLUMNS = (("hall", "Hall", 140), ("meal", "Meal", 70), ("day", "Day", 100), ("available", "Available", 80),
+           ("listings", "Listings", 70), ("filled", "Sold", 70), ("volume", "Volume", 80), ("expired", "Expired", 70))
+
+
+class DashboardView:
+    def __init__(self, parent):
+        self.frame = tk.Frame(parent)
+        self.seller_label = tk.Label(self.frame, text="", font=("Arial", 11))
+        self.seller_label.pack(side=tk.BOTTOM, pady=5)
+        self.tree = ttk.Treeview(self.frame, columns=[name for name, _, _ in COLUMNS], show="headings", height=18)
+        for name, heading, width in COLUMNS:
+            self.tree.heading(name, text=heading)
+            self.tree.column(name, width=width)
+        scrollbar = ttk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def load(self, summary):
+        # The summary is a few rows per hall and day, so the table is simply refilled, newest day first.
+        self.tree.delete(*self.tree.get_children())
+        for row in sorted(summary["buckets"], key=lambda row: row["day"], reverse=True):
+            self.tree.insert("", tk.END, values=(row["hall"], row["meal_type"], row["day"], row["available"],
+                                                 row["listings"], row["filled"], row["volume"], row["expired"]))
+        if summary["sellers"]:
+            seller = summary["sellers"][0]
+            self.seller_label.config(text=f"Your listings: {seller['listings']} open, {seller['available']} tokens "
+                                          f"available, {seller['sold']} sold for {seller['volume']} in total")
+        else:
+            self.seller_label.config(text="You have not listed any tokens yet.")
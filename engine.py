@@ -0,0 +1,518 @@
+import atexit
+import functools
+import json
+import os
+from datetime import datetime
+
+from events import EventBus
+from expiry import GUI_CUTOFFS, GUI_SELL_CUTOFFS, parse_timestamp
+from history import TradeHistory
+from locking import FileLock
+from metrics import REGISTRY
+from orderbook import MEAL_TYPES, meal_key
+from records import TIMESTAMP_FORMAT, Bid, Listing
+from storage import open_store
+
+DEFAULT_HALLS = ["Zia Hall", "Hamid Hall", "Shahidul Hall", "Bongobandhu Hall", "Selim Hall"]
+HALLS_FILE = "halls.json"
+
+
+def configured_halls(path=HALLS_FILE):
+    # TOKEN_HALLS="Zia Hall,Selim Hall" or a halls.json list overrides the built-in halls.
+    env = os.environ.get("TOKEN_HALLS")
+    if env:
+        return [hall.strip() for hall in env.split(",") if hall.strip()]
+    try:
+        with open(path, "r") as file:
+            return list(json.load(file))
+    except FileNotFoundError:
+        return list(DEFAULT_HALLS)
+
+
+class TradeError(Exception):
+    pass
+
+
+def mutation(method):
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with REGISTRY.time("engine_call_seconds", method=name):
+            try:
+                with self.lock.hold(exclusive=True):
+                    self.refresh()
+                    self.book.dirty = self.users.dirty = False
+                    try:
+                        with self.store.transaction():
+                            result = method(self, *args, **kwargs)
+                    except BaseException:
+                        self.history.discard()
+                        self.book.changes = []
+                        if self.book.dirty or self.users.dirty:
+                            # The call failed after changing memory, so memory is brought back to what the store
+                            # holds. A call rejected before it changed anything costs no reload.
+                            self.load_data()
+                        raise
+                    self.history.commit()
+                    self.publish_changes()
+                    return result
+            except TradeError:
+                REGISTRY.inc("engine_rejections_total", method=name)
+                raise
+    return wrapper
+
+
+def query(method):
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with REGISTRY.time("engine_call_seconds", method=name):
+            with self.lock.hold(exclusive=False):
+                self.refresh()
+                return method(self, *args, **kwargs)
+    return wrapper
+
+
+class TokenEngine:
+    def __init__(self, data_file="token_data.json", halls=None, cutoffs=GUI_CUTOFFS, sell_cutoffs=GUI_SELL_CUTOFFS,
+                 id_offset=0, id_step=1):
+        self.data_file = data_file
+        self.default_halls = list(halls or configured_halls())
+        # A sharded deployment gives each engine its own residue class of ids, so ids stay unique across shards.
+        self.id_offset = id_offset
+        self.id_step = id_step
+        self.cutoffs = cutoffs
+        self.sell_cutoffs = sell_cutoffs
+        self.store = open_store(self.data_file)
+        self.history = TradeHistory(self.data_file + ".history")
+        self.events = EventBus()
+        self.lock = FileLock(self.data_file + ".lock")
+        with self.lock.hold(exclusive=False):
+            self.load_data()
+        atexit.register(self.close)
+
+    def _state(self):
+        return {"users": self.users, "book": self.book, "next_id": self.next_id}
+
+    def load_data(self):
+        with REGISTRY.time("load_data_seconds"):
+            state = self.store.load(self.default_halls, self.cutoffs)
+        self.users = state["users"]
+        self.book = state["book"]
+        self.book.changes = []
+        self.next_id = state["next_id"]
+
+    def refresh(self):
+        # Another process may have written since we last looked; bring memory up to the on-disk version first.
+        change = self.store.stale()
+        if change == "reload":
+            self.load_data()
+            self.events.publish([{"type": "reset", "hall": None, "meal_type": None}])
+        elif change == "append":
+            state = self._state()
+            self.store.catch_up(state)
+            self.next_id = state["next_id"]
+            self.publish_changes()
+
+    def publish_changes(self):
+        changes, self.book.changes = self.book.changes, []
+        self.events.publish(changes)
+
+    def subscribe(self, callback, hall=None, meal_type=None):
+        # Callbacks run on the thread that made the change, after it has been committed.
+        return self.events.subscribe(callback, hall, meal_type)
+
+    def unsubscribe(self, token):
+        return self.events.unsubscribe(token)
+
+    def _new_id(self):
+        order_id = self.next_id + (self.id_offset - self.next_id) % self.id_step
+        self.next_id = order_id + 1
+        return order_id
+
+    def sync(self):
+        self.store.sync()
+
+    def save_data(self, op, **fields):
+        with REGISTRY.time("save_data_seconds", op=op):
+            self.store.append(op, **fields)
+            if self.store.needs_compaction():
+                self.store.compact(self._state())
+
+    def save_batch(self, records):
+        if len(records) == 1:
+            self.save_data(**records[0])
+        elif records:
+            self.save_data("batch", records=records)
+
+    def close(self):
+        self.store.close()
+        self.lock.close()
+
+    @property
+    def halls(self):
+        return list(self.book.halls)
+
+    def _require_user(self, username):
+        if not isinstance(username, str) or username not in self.users:
+            raise TradeError(f"User '{username}' does not exist. Please log in first.")
+
+    def _require_hall(self, hall):
+        if hall not in self.book.halls:
+            raise TradeError(f"Hall '{hall}' does not exist.")
+
+    @query
+    def user(self, username):
+        if username not in self.users:
+            return None
+        return dict(self.users[username].to_dict(), username=username)
+
+    @query
+    def usernames(self):
+        return list(self.users)
+
+    def _check_number(self, value):
+        # Numbers from JSON are taken as the digits they stand for, so 2 and "2" are the same roll number.
+        if isinstance(value, int) and not isinstance(value, bool):
+            value = str(value)
+        return value.strip() if isinstance(value, str) else ""
+
+    @mutation
+    def login(self, username, roll, mobile):
+        roll = self._check_number(roll)
+        mobile = self._check_number(mobile)
+        if not isinstance(username, str) or not username or not roll or not mobile:
+            raise TradeError("All fields are required!")
+        if username in self.users:
+            return "welcome"
+        owner = self.users.by_roll(roll)
+        if owner is not None:
+            raise TradeError(f"A user with roll number {roll} already exists as '{owner}'. Please log in.")
+        owner = self.users.by_mobile(mobile)
+        if owner is not None:
+            raise TradeError(f"Mobile number {mobile} is already registered to '{owner}'.")
+        self.users.register(username, roll, mobile)
+        self.save_data("register", username=username, roll=roll, mobile=mobile)
+        return "registered"
+
+    def _check_price(self, price):
+        try:
+            price = float(price)
+        except (TypeError, ValueError):
+            raise TradeError("Invalid price!")
+        if not price >= 0:
+            raise TradeError("Price must be zero or more.")
+        return int(price) if price.is_integer() else price
+
+    def _check_meal(self, meal_type):
+        meal = meal_key(meal_type) if isinstance(meal_type, str) else None
+        if meal not in MEAL_TYPES:
+            raise TradeError(f"Unknown meal type '{meal_type}'.")
+        return meal
+
+    def _check_when(self, meal_type, at):
+        meal = self._check_meal(meal_type)
+        if isinstance(at, str):
+            at = parse_timestamp(at)
+            if at is None:
+                raise TradeError("Invalid timestamp.")
+        elif at is not None and not isinstance(at, datetime):
+            raise TradeError("Invalid timestamp.")
+        now = datetime.now()
+        at = at or now
+        # Orders expire at the cutoff on their own date, so one dated for a later day would outlive today's sweeps.
+        if at.date() > now.date():
+            raise TradeError("Cannot trade tokens for a later day.")
+        cutoff = self.sell_cutoffs.get(meal)
+        if cutoff is None:
+            raise TradeError(f"Unknown meal type '{meal_type}'.")
+        return meal, at, cutoff
+
+    def _check_listing(self, username, hall, meal_type, tokens, at, price=0):
+        self._require_user(username)
+        self._require_hall(hall)
+        try:
+            tokens = int(tokens)
+        except (TypeError, ValueError):
+            raise TradeError("Invalid token number!")
+        if tokens <= 0:
+            raise TradeError("Token count must be a positive number.")
+        price = self._check_price(price)
+
+        meal, at, cutoff = self._check_when(meal_type, at)
+        if at.time() > cutoff:
+            raise TradeError(f"Cannot sell {meal} tokens after {cutoff.strftime('%I:%M %p')}.")
+        return hall, meal, tokens, at, price
+
+    def _add_listing(self, username, hall, meal, tokens, at, price=0):
+        listing = Listing(self._new_id(), hall, meal, self.book.names.id(username), tokens, price, int(at.timestamp()))
+        self.book.add(listing)
+        records = [{"op": "list", "hall": hall, "listing": self.book.as_dict(listing)}]
+
+        # A new ask crosses any resting bids at or above its price; each trade happens at the bid's price.
+        buyers = []
+        for bid, taken in self.book.match_bids(hall, meal, tokens, price):
+            buyer = self.book.names[bid.user]
+            self.book.fill_listing(listing.id, taken, bid.price)
+            self.history.add("fill", hall, meal, taken, username, buyer, bid.price, listing.created)
+            buyers.append(self._buyer_contact(bid, taken))
+            records.append({"op": "fill", "hall": hall, "id": listing.id, "qty": taken,
+                            "buyer": buyer, "bid": bid.id, "price": bid.price})
+        return dict(self.book.as_dict(listing), matched=buyers), records
+
+    @mutation
+    def list_tokens(self, username, hall, meal_type, tokens, at=None, price=0):
+        listing, records = self._add_listing(username, *self._check_listing(username, hall, meal_type, tokens, at, price))
+        self.save_batch(records)
+        return listing
+
+    def _check_orders(self, orders, at):
+        checked = []
+        for number, order in enumerate(orders, start=1):
+            try:
+                checked.append((order["username"],) + self._check_listing(
+                    order["username"], order["hall"], order["meal_type"], order["tokens"], order.get("at", at),
+                    order.get("price", 0)))
+            except KeyError as e:
+                raise TradeError(f"Order {number}: missing field {e}.")
+            except TradeError as e:
+                raise TradeError(f"Order {number}: {e}")
+        return checked
+
+    @query
+    def check_listings(self, orders, at=None):
+        # Validates a batch without writing it; used by the shard router before committing on several shards.
+        return len(self._check_orders(orders, at))
+
+    @mutation
+    def list_batch(self, orders, at=None):
+        checked = self._check_orders(orders, at)
+        listings = []
+        records = []
+        for order in checked:
+            listing, added = self._add_listing(*order)
+            listings.append(listing)
+            records.extend(added)
+        if records:
+            self.save_batch(records)
+        return listings
+
+    def _seller_contact(self, listing, tokens_sold):
+        # Contact details come from the user directory; only very old listings carry their own copy.
+        username = self.book.names[listing.user]
+        info = self.users.get(username)
+        extra = listing.extra or {}
+        return {
+            "id": listing.id,
+            "username": username,
+            "roll": info.roll if info is not None else extra.get("roll"),
+            "mobile": info.mobile if info is not None else extra.get("mobile"),
+            "tokens_sold": tokens_sold,
+            "price": listing.price
+        }
+
+    def _buyer_contact(self, bid, tokens_bought):
+        username = self.book.names[bid.user]
+        info = self.users.get(username)
+        return {
+            "bid": bid.id,
+            "username": username,
+            "roll": info.roll if info is not None else None,
+            "mobile": info.mobile if info is not None else None,
+            "tokens_bought": tokens_bought,
+            "price": bid.price
+        }
+
+    def _check_quantity(self, quantity):
+        try:
+            quantity = int(quantity)
+        except (TypeError, ValueError):
+            raise TradeError("Invalid token number!")
+        if quantity <= 0:
+            raise TradeError("Invalid token number!")
+        return quantity
+
+    def _check_available(self, hall, meal_type, quantity):
+        total_available = self.book.available(hall, meal_type)
+        if not total_available:
+            raise TradeError(f"No tokens available for {meal_type} at {hall}.")
+        if quantity > total_available:
+            raise TradeError(f"Not enough tokens available. Only {total_available} tokens are available.")
+
+    def _record_fill(self, hall, listing, tokens_sold, buyer):
+        self.history.add("fill", hall, listing.meal, tokens_sold, self.book.names[listing.user], buyer, listing.price,
+                         listing.created)
+
+    def _fill(self, username, hall, meal_type, quantity, limit=None):
+        sellers = []
+        records = []
+        for listing, tokens_sold in self.book.fill(hall, meal_type, quantity, limit):
+            self._record_fill(hall, listing, tokens_sold, username)
+            sellers.append(self._seller_contact(listing, tokens_sold))
+            records.append({"op": "fill", "hall": hall, "id": listing.id, "qty": tokens_sold, "buyer": username,
+                            "price": listing.price})
+        return sellers, records
+
+    def _take(self, username, hall, listing_id):
+        listing = self.book.get(listing_id)
+        tokens_sold = listing.tokens
+        self.book.fill_listing(listing_id, tokens_sold)
+        self._record_fill(hall, listing, tokens_sold, username)
+        record = {"op": "fill", "hall": hall, "id": listing_id, "qty": tokens_sold, "buyer": username,
+                  "price": listing.price}
+        return self._seller_contact(listing, tokens_sold), record
+
+    def _check_take(self, hall, listing_id):
+        listing = self.book.get(listing_id)
+        if listing is None or listing.hall != hall:
+            raise TradeError(f"Invalid seller selection for {hall}.")
+
+    @mutation
+    def buy(self, username, hall, meal_type, quantity):
+        self._require_user(username)
+        self._require_hall(hall)
+        quantity = self._check_quantity(quantity)
+        meal = self._check_meal(meal_type)
+        self._check_available(hall, meal, quantity)
+
+        sellers, records = self._fill(username, hall, meal, quantity)
+        self.save_batch(records)
+        return sellers
+
+    @mutation
+    def bid(self, username, hall, meal_type, quantity, price, at=None):
+        # Fills what it can from asks at or below the limit, cheapest first, and leaves the rest resting.
+        self._require_user(username)
+        self._require_hall(hall)
+        quantity = self._check_quantity(quantity)
+        price = self._check_price(price)
+        meal, at, cutoff = self._check_when(meal_type, at)
+
+        sellers, records = self._fill(username, hall, meal, quantity, limit=price)
+        remaining = quantity - sum(seller["tokens_sold"] for seller in sellers)
+        resting = None
+        # No new asks arrive after the sell cutoff, so a late remainder is dropped instead of resting.
+        if remaining and at.time() <= cutoff:
+            resting = Bid(self._new_id(), hall, meal, self.book.names.id(username), remaining, price, int(at.timestamp()))
+            self.book.add_bid(resting)
+            resting = self.book.as_dict(resting)
+            records.append({"op": "bid", "hall": hall, "bid": dict(resting)})
+        if not records:
+            raise TradeError(f"No {meal} tokens available at {hall} for {price} or less.")
+        self.save_batch(records)
+        return {"sellers": sellers, "bid": resting}
+
+    @mutation
+    def cancel_bid(self, username, bid_id):
+        bid = self.book.get_bid(bid_id)
+        if bid is None or self.book.names[bid.user] != username:
+            raise TradeError("No such open bid.")
+        self.book.remove_bid(bid_id)
+        self.save_data("cancel_bid", id=bid_id)
+        return self.book.as_dict(bid)
+
+    @mutation
+    def take(self, username, hall, listing_id):
+        self._require_user(username)
+        self._check_take(hall, listing_id)
+        seller, record = self._take(username, hall, listing_id)
+        self.save_data(**record)
+        return seller
+
+    @mutation
+    def buy_batch(self, username, orders):
+        # Orders are either {"hall", "meal_type", "quantity"} or {"hall", "id"} for one whole listing.
+        self._require_user(username)
+        wanted = {}
+        taken = set()
+        for number, order in enumerate(orders, start=1):
+            try:
+                self._require_hall(order["hall"])
+                if "id" in order:
+                    if order["id"] in taken:
+                        raise TradeError(f"Invalid seller selection for {order['hall']}.")
+                    self._check_take(order["hall"], order["id"])
+                    taken.add(order["id"])
+                    listing = self.book.get(order["id"])
+                    bucket = (order["hall"], listing.meal)
+                    wanted[bucket] = wanted.get(bucket, 0) + listing.tokens
+                else:
+                    bucket = (order["hall"], self._check_meal(order["meal_type"]))
+                    wanted[bucket] = wanted.get(bucket, 0) + self._check_quantity(order["quantity"])
+            except KeyError as e:
+                raise TradeError(f"Order {number}: missing field {e}.")
+            except TradeError as e:
+                raise TradeError(f"Order {number}: {e}")
+        for (hall, meal), quantity in wanted.items():
+            self._check_available(hall, meal, quantity)
+
+        # Listings named by id are taken first, so a quantity order cannot use them up before their turn.
+        results = [None] * len(orders)
+        records = []
+        for number, order in enumerate(orders):
+            if "id" in order:
+                seller, record = self._take(username, order["hall"], order["id"])
+                results[number] = [seller]
+                records.append(record)
+        for number, order in enumerate(orders):
+            if "id" not in order:
+                sellers, fills = self._fill(username, order["hall"], order["meal_type"], int(order["quantity"]))
+                results[number] = sellers
+                records.extend(fills)
+        self.save_batch(records)
+        return results
+
+    @mutation
+    def expire(self, now=None):
+        expired_ids = {}
+        now = now or datetime.now()
+        with REGISTRY.time("expiry_sweep_seconds"):
+            expired = self.book.expire_due(now)
+        REGISTRY.inc("listings_expired_total", len(expired))
+        for order in expired:
+            expired_ids.setdefault(order.hall, []).append(order.id)
+            username = self.book.names[order.user]
+            if isinstance(order, Bid):
+                self.history.add("expire", order.hall, order.meal, order.tokens, None, username, order.price,
+                                 order.created, now)
+            else:
+                self.history.add("expire", order.hall, order.meal, order.tokens, username, None, order.price,
+                                 order.created, now)
+        for hall, ids in expired_ids.items():
+            self.save_data("expire", hall=hall, ids=ids)
+        return sum(len(ids) for ids in expired_ids.values())
+
+    @query
+    def snapshot(self, hall=None):
+        halls = [hall] if hall is not None else self.book.halls
+        return {name: [self.book.as_dict(listing) for listing in self.book.hall_listings(name)] for name in halls}
+
+    @query
+    def poll(self):
+        # Picks up other processes' writes, which publishes their events here; cheap when nothing changed.
+        return self.store.version()
+
+    @query
+    def summary(self, hall=None, day=None, username=None):
+        return self.book.stats.summary(hall, day, username)
+
+    @query
+    def bids(self, hall=None, username=None):
+        if username is not None:
+            return [self.book.as_dict(bid) for bid in self.book.buyer_bids(username)]
+        halls = [hall] if hall is not None else self.book.halls
+        return {name: [self.book.as_dict(bid) for bid in self.book.hall_bids(name)] for name in halls}
+
+    @mutation
+    def remove_user(self, username):
+        if self.users.remove(username) is None:
+            raise TradeError("No user selected!")
+        self.book.remove_seller(username)
+        self.save_data("remove_user", username=username)
+
+    @mutation
+    def reset_users(self):
+        self.users.reset()
+        self.save_data("reset_users")
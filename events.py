@@ -0,0 +1,41 @@
+import threading
+
+from metrics import REGISTRY
+from orderbook import meal_key
+
+
+class EventBus:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.next_token = 1
+
+    def subscribe(self, callback, hall=None, meal_type=None):
+        with self.lock:
+            token = self.next_token
+            self.next_token += 1
+            self.subscribers[token] = (callback, hall, meal_key(meal_type) if meal_type else None)
+        return token
+
+    def unsubscribe(self, token):
+        with self.lock:
+            return self.subscribers.pop(token, None) is not None
+
+    def publish(self, events):
+        if not events:
+            return
+        with self.lock:
+            subscribers = list(self.subscribers.values())
+        REGISTRY.inc("events_published_total", len(events))
+        for callback, hall, meal in subscribers:
+            for event in events:
+                # Events without a hall (user removal, reset) go to everyone.
+                if hall is not None and event.get("hall") not in (None, hall):
+                    continue
+                if meal is not None and event.get("meal_type") not in (None, meal):
+                    continue
+                try:
+                    callback(event)
+                except Exception:
+                    # A broken subscriber must not undo or block a trade that has already been committed.
+                    REGISTRY.inc("event_callback_errors_total")
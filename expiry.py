@@ -0,0 +1,60 @@
+import heapq
+from datetime import date, datetime, time
+
+GUI_CUTOFFS = {"Lunch": time(14, 10), "Dinner": time(22, 10)}
+CLI_CUTOFFS = {"Lunch": time(14, 0), "Dinner": time(22, 30)}
+# Selling is refused once the clock is past these times.
+GUI_SELL_CUTOFFS = {"Lunch": time(14, 0), "Dinner": time(22, 0)}
+CLI_SELL_CUTOFFS = {"Lunch": time(13, 59), "Dinner": time(22, 15)}
+TIMESTAMP_FORMATS = ("%Y-%m-%d %H:%M:%S", "%d/%m/%y %I:%M %p")
+
+
+def parse_timestamp(value):
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+class ExpiryQueue:
+    # Everything listed for the same meal on the same day expires at the same moment, so ids are grouped in one
+    # list per moment and only the distinct moments go through the heap.
+    def __init__(self, cutoffs):
+        self.cutoffs = cutoffs
+        self.heap = []
+        self.buckets = {}
+        self.count = 0
+        self.moments = {}
+
+    def __len__(self):
+        return self.count
+
+    def expires_at(self, meal, created):
+        # Both the creation time and the result are epoch seconds.
+        cutoff = self.cutoffs.get(meal)
+        if created is None or cutoff is None:
+            # Listings we cannot date were dropped by every display before; keep doing that.
+            return 0
+        key = (meal, date.fromtimestamp(created))
+        moment = self.moments.get(key)
+        if moment is None:
+            moment = self.moments[key] = int(datetime.combine(key[1], cutoff).timestamp())
+        return moment
+
+    def push(self, listing_id, expires_at):
+        bucket = self.buckets.get(expires_at)
+        if bucket is None:
+            bucket = self.buckets[expires_at] = []
+            heapq.heappush(self.heap, expires_at)
+        bucket.append(listing_id)
+        self.count += 1
+
+    def pop_due(self, now):
+        now = now.timestamp()
+        due = []
+        while self.heap and self.heap[0] <= now:
+            due.extend(sorted(self.buckets.pop(heapq.heappop(self.heap))))
+        self.count -= len(due)
+        return due
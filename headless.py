@@ -0,0 +1,103 @@
+import argparse
+import json
+import sys
+
+import metrics
+from client import connect_engine
+from engine import TradeError
+from expiry import parse_timestamp
+
+# One engine call per run and JSON on stdout, for kiosk scripts and tests. Nothing here imports tkinter.
+COMMANDS = {
+    "halls": lambda engine, args: engine.halls,
+    "user": lambda engine, args: engine.user(args.username),
+    "login": lambda engine, args: engine.login(args.username, args.roll, args.mobile),
+    "sell": lambda engine, args: engine.list_tokens(args.username, args.hall, args.meal_type, args.tokens,
+                                                    at=args.at, price=args.price),
+    "buy": lambda engine, args: engine.buy(args.username, args.hall, args.meal_type, args.quantity),
+    "bid": lambda engine, args: engine.bid(args.username, args.hall, args.meal_type, args.quantity, args.price,
+                                           at=args.at),
+    "cancel-bid": lambda engine, args: engine.cancel_bid(args.username, args.bid_id),
+    "take": lambda engine, args: engine.take(args.username, args.hall, args.listing_id),
+    "book": lambda engine, args: engine.snapshot(args.hall),
+    "bids": lambda engine, args: engine.bids(args.hall, args.username),
+    "summary": lambda engine, args: engine.summary(args.hall, args.day, args.username),
+    "expire": lambda engine, args: engine.expire(),
+}
+
+
+def timestamp(value):
+    # Parsed here so a RemoteEngine, which formats datetimes for the wire, gets one too.
+    parsed = parse_timestamp(value)
+    if parsed is None:
+        raise argparse.ArgumentTypeError(f"not a timestamp: {value!r}")
+    return parsed
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Run one token trading operation without the GUI")
+    parser.add_argument("--data", default="token_data.json")
+    metrics.add_arguments(parser)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("halls", help="list the configured halls")
+    commands.add_parser("user", help="show a registered user").add_argument("username")
+    login = commands.add_parser("login", help="register a user, or check an existing one")
+    for name in ("username", "roll", "mobile"):
+        login.add_argument(name)
+
+    sell = commands.add_parser("sell", help="list tokens for sale")
+    buy = commands.add_parser("buy", help="buy at the best available prices")
+    bid = commands.add_parser("bid", help="place a bid that rests until it is filled")
+    for command, amount in ((sell, "tokens"), (buy, "quantity"), (bid, "quantity")):
+        command.add_argument("username")
+        command.add_argument("hall")
+        command.add_argument("meal_type")
+        command.add_argument(amount, type=int)
+    sell.add_argument("--price", default=0)
+    bid.add_argument("price")
+    for command in (sell, bid):
+        command.add_argument("--at", type=timestamp, help="timestamp to list at instead of now")
+
+    cancel = commands.add_parser("cancel-bid", help="cancel one of your bids")
+    cancel.add_argument("username")
+    cancel.add_argument("bid_id", type=int)
+    take = commands.add_parser("take", help="buy one listing by id")
+    take.add_argument("username")
+    take.add_argument("hall")
+    take.add_argument("listing_id", type=int)
+
+    for name, help_text in (("book", "show the listings"), ("bids", "show the resting bids"),
+                            ("summary", "show the running totals")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("--hall")
+        if name != "book":
+            command.add_argument("--username")
+        if name == "summary":
+            command.add_argument("--day", help="YYYY-MM-DD")
+    commands.add_parser("expire", help="drop listings and bids past their meal cutoff")
+    return parser
+
+
+def run(args):
+    engine = connect_engine(data_file=args.data)
+    try:
+        return COMMANDS[args.command](engine, args)
+    finally:
+        engine.close()
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    metrics.configure(args)
+    try:
+        result = run(args)
+    except TradeError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
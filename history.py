@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import struct
+import zlib
+from array import array
+from datetime import date, datetime
+
+from expiry import parse_timestamp
+from metrics import REGISTRY
+
+MAGIC = b"TKH1"
+LIVE_FILE = "trades.log"
+ARCHIVE_SUFFIX = ".trades.z"
+KINDS = ("fill", "expire")
+# One fixed-width array per field; strings are stored as indexes into the archive's string table.
+COLUMNS = (
+    ("kind", "B"),
+    ("hall", "I"),
+    ("meal", "I"),
+    ("qty", "I"),
+    ("seller", "i"),
+    ("buyer", "i"),
+    ("price", "d"),
+    ("listed_at", "q"),
+    ("at", "q"),
+)
+STRING_COLUMNS = ("hall", "meal", "seller", "buyer")
+
+
+def epoch(value):
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        value = parse_timestamp(value)
+    return int(value.timestamp()) if value is not None else 0
+
+
+def event_day(event):
+    return datetime.fromtimestamp(event["at"]).date()
+
+
+def write_archive(path, events):
+    strings = {}
+    columns = {name: array(typecode) for name, typecode in COLUMNS}
+    for event in events:
+        for name, _ in COLUMNS:
+            value = event.get(name)
+            if name == "kind":
+                value = KINDS.index(value)
+            elif name in STRING_COLUMNS:
+                value = -1 if value is None else strings.setdefault(value, len(strings))
+            columns[name].append(value)
+
+    blobs = [zlib.compress(columns[name].tobytes(), 6) for name, _ in COLUMNS]
+    header = json.dumps({
+        "count": len(columns["kind"]),
+        "strings": list(strings),
+        "columns": [[name, typecode, len(blob)] for (name, typecode), blob in zip(COLUMNS, blobs)],
+    }).encode()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(MAGIC + struct.pack("<I", len(header)) + header)
+        for blob in blobs:
+            file.write(blob)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_columns(path, names=None):
+    # Only the requested columns are decompressed; the others are skipped by offset.
+    with open(path, "rb") as file:
+        if file.read(4) != MAGIC:
+            raise ValueError(f"{path} is not a trade archive")
+        header = json.loads(file.read(struct.unpack("<I", file.read(4))[0]))
+        columns = {}
+        for name, typecode, length in header["columns"]:
+            if names is not None and name not in names:
+                file.seek(length, os.SEEK_CUR)
+                continue
+            column = array(typecode)
+            column.frombytes(zlib.decompress(file.read(length)))
+            columns[name] = column
+    return header["strings"], header["count"], columns
+
+
+class TradeHistory:
+    def __init__(self, directory):
+        self.directory = directory
+        self.live_file = os.path.join(directory, LIVE_FILE)
+        self.pending = []
+        self.rolled_on = None
+
+    def add(self, kind, hall, meal, qty, seller, buyer=None, price=0, listed_at=None, at=None):
+        self.pending.append({
+            "kind": kind,
+            "hall": hall,
+            "meal": meal,
+            "qty": qty,
+            "seller": seller,
+            "buyer": buyer,
+            "price": price,
+            "listed_at": epoch(listed_at),
+            "at": epoch(at or datetime.now()),
+        })
+
+    def discard(self):
+        self.pending = []
+
+    def commit(self):
+        # Called once the engine's store transaction has committed, so history never shows a rolled-back trade.
+        if not self.pending:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        if self.rolled_on != date.today():
+            self.rolled_on = date.today()
+            self.roll(self.rolled_on)
+        data = "".join(json.dumps(event, separators=(",", ":")) + "\n" for event in self.pending).encode()
+        with open(self.live_file, "ab") as file:
+            file.write(data)
+        REGISTRY.inc("history_events_total", len(self.pending))
+        self.pending = []
+
+    def archive_path(self, day):
+        return os.path.join(self.directory, day.isoformat() + ARCHIVE_SUFFIX)
+
+    def archive_days(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(date.fromisoformat(name[:-len(ARCHIVE_SUFFIX)]) for name in names if name.endswith(ARCHIVE_SUFFIX))
+
+    def _live_events(self):
+        try:
+            with open(self.live_file, "rb") as file:
+                for line in file:
+                    if line.endswith(b"\n"):
+                        yield json.loads(line)
+        except FileNotFoundError:
+            return
+
+    def roll(self, before=None):
+        # Moves every finished day out of the live log into its archive; the current day stays live.
+        before = before or date.today()
+        days = {}
+        kept = []
+        for event in self._live_events():
+            day = event_day(event)
+            if day < before:
+                days.setdefault(day, []).append(event)
+            else:
+                kept.append(event)
+        if not days:
+            return []
+
+        with REGISTRY.time("history_roll_seconds"):
+            for day, events in sorted(days.items()):
+                path = self.archive_path(day)
+                if os.path.exists(path):
+                    events = list(self._archive_events(path)) + events
+                write_archive(path, events)
+            tmp_file = self.live_file + ".tmp"
+            with open(tmp_file, "wb") as file:
+                file.write("".join(json.dumps(event, separators=(",", ":")) + "\n" for event in kept).encode())
+            os.replace(tmp_file, self.live_file)
+        return sorted(days)
+
+    def _archive_events(self, path):
+        strings, count, columns = read_columns(path)
+        for i in range(count):
+            event = {}
+            for name, _ in COLUMNS:
+                value = columns[name][i]
+                if name == "kind":
+                    value = KINDS[value]
+                elif name in STRING_COLUMNS:
+                    value = strings[value] if value >= 0 else None
+                elif name == "price" and value.is_integer():
+                    value = int(value)
+                event[name] = value
+            yield event
+
+    def _days(self, start, end):
+        return [day for day in self.archive_days() if (start is None or day >= start) and (end is None or day <= end)]
+
+    def events(self, start=None, end=None, hall=None):
+        for day in self._days(start, end):
+            for event in self._archive_events(self.archive_path(day)):
+                if hall is None or event["hall"] == hall:
+                    yield event
+        for event in self._live_events():
+            day = event_day(event)
+            if (start is None or day >= start) and (end is None or day <= end) and (hall is None or event["hall"] == hall):
+                yield event
+
+    def traded_per_hall_per_day(self, start=None, end=None):
+        # Yields (day, hall, tokens) one day at a time, reading only the kind, hall and qty columns of each archive.
+        fill = KINDS.index("fill")
+        for day in self._days(start, end):
+            strings, count, columns = read_columns(self.archive_path(day), ("kind", "hall", "qty"))
+            totals = {}
+            for kind, hall, qty in zip(columns["kind"], columns["hall"], columns["qty"]):
+                if kind == fill:
+                    totals[strings[hall]] = totals.get(strings[hall], 0) + qty
+            for hall in sorted(totals):
+                yield day, hall, totals[hall]
+
+        live = {}
+        for event in self._live_events():
+            day = event_day(event)
+            if event["kind"] == "fill" and (start is None or day >= start) and (end is None or day <= end):
+                live.setdefault(day, {}).setdefault(event["hall"], 0)
+                live[day][event["hall"]] += event["qty"]
+        for day in sorted(live):
+            for hall in sorted(live[day]):
+                yield day, hall, live[day][hall]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report on and archive the token trade history")
+    parser.add_argument("--data", default="token_data.json")
+    parser.add_argument("--roll", action="store_true", help="archive every finished day before reporting")
+    parser.add_argument("--from", dest="start", type=date.fromisoformat)
+    parser.add_argument("--to", dest="end", type=date.fromisoformat)
+    args = parser.parse_args()
+
+    history = TradeHistory(args.data + ".history")
+    if args.roll:
+        for day in history.roll():
+            print(f"Archived {day.isoformat()}")
+    for day, hall, tokens in history.traded_per_hall_per_day(args.start, args.end):
+        print(f"{day.isoformat()}  {hall:<20} {tokens}")
+
+
+if __name__ == "__main__":
+    main()
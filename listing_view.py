@@ -0,0 +1,139 @@
+import tkinter as tk
+from bisect import bisect_left, insort
+from tkinter import ttk
+
+from metrics import REGISTRY
+
+ALL_HALLS = "All Halls"
+ALL_MEALS = "All Meals"
+COLUMNS = (("hall", "Hall", 140), ("seller", "Seller", 140), ("meal", "Meal", 80), ("tokens", "Tokens", 70), ("price", "Price", 70), ("time", "Time", 160))
+
+
+class ListingView:
+    PAGE_SIZE = 100
+
+    def __init__(self, parent, halls):
+        self.frame = tk.Frame(parent)
+        self.rows = {}
+        # Sorted listing ids for every filter choice, All Halls and All Meals included, kept up to date as rows change.
+        self.ids = {}
+        self.shown = {}
+        self.page = 0
+
+        filters = tk.Frame(self.frame)
+        filters.pack(pady=5)
+        self.hall_var = tk.StringVar(self.frame, ALL_HALLS)
+        self.meal_var = tk.StringVar(self.frame, ALL_MEALS)
+        for var, values in ((self.hall_var, [ALL_HALLS] + list(halls)), (self.meal_var, [ALL_MEALS, "Lunch", "Dinner"])):
+            box = ttk.Combobox(filters, textvariable=var, values=values, state="readonly", width=18)
+            box.bind("<<ComboboxSelected>>", self.on_filter)
+            box.pack(side=tk.LEFT, padx=5)
+
+        body = tk.Frame(self.frame)
+        body.pack(fill=tk.BOTH, expand=True)
+        self.tree = ttk.Treeview(body, columns=[name for name, _, _ in COLUMNS], show="headings", height=20)
+        for name, heading, width in COLUMNS:
+            self.tree.heading(name, text=heading)
+            self.tree.column(name, width=width)
+        scrollbar = ttk.Scrollbar(body, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        pager = tk.Frame(self.frame)
+        pager.pack(pady=5)
+        tk.Button(pager, text="< Prev", command=self.prev_page).pack(side=tk.LEFT)
+        self.page_label = tk.Label(pager, text="")
+        self.page_label.pack(side=tk.LEFT, padx=10)
+        tk.Button(pager, text="Next >", command=self.next_page).pack(side=tk.LEFT)
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def load(self, snapshot):
+        self.rows = {listing["id"]: dict(listing, hall=hall) for hall, listings in snapshot.items() for listing in listings}
+        self.ids = {}
+        for listing_id, row in self.rows.items():
+            for key in self.filter_keys(row):
+                self.ids.setdefault(key, []).append(listing_id)
+        for ids in self.ids.values():
+            ids.sort()
+        self.render()
+
+    def filter_keys(self, row):
+        hall = row["hall"]
+        meal = row["meal_type"]
+        return (hall, meal), (hall, ALL_MEALS), (ALL_HALLS, meal), (ALL_HALLS, ALL_MEALS)
+
+    def upsert(self, hall, listing):
+        if listing["tokens"] <= 0:
+            self.delete(listing["id"])
+            return
+        row = dict(listing, hall=hall)
+        old = self.rows.get(listing["id"])
+        if old is None or self.filter_keys(old) != self.filter_keys(row):
+            if old is not None:
+                self._unindex(listing["id"], old)
+            for key in self.filter_keys(row):
+                insort(self.ids.setdefault(key, []), listing["id"])
+        self.rows[listing["id"]] = row
+        self.render()
+
+    def delete(self, listing_id):
+        row = self.rows.pop(listing_id, None)
+        if row is not None:
+            self._unindex(listing_id, row)
+            self.render()
+
+    def _unindex(self, listing_id, row):
+        for key in self.filter_keys(row):
+            ids = self.ids[key]
+            del ids[bisect_left(ids, listing_id)]
+
+    def on_filter(self, event=None):
+        self.page = 0
+        self.render()
+
+    def prev_page(self):
+        if self.page > 0:
+            self.page -= 1
+            self.render()
+
+    def next_page(self):
+        self.page += 1
+        self.render()
+
+    def matching_ids(self):
+        return self.ids.get((self.hall_var.get(), self.meal_var.get()), [])
+
+    def render(self):
+        with REGISTRY.time("gui_render_seconds"):
+            self._render()
+
+    def _render(self):
+        # Only the current page lives in the Treeview, and only rows that changed are touched.
+        ids = self.matching_ids()
+        pages = max(1, (len(ids) + self.PAGE_SIZE - 1) // self.PAGE_SIZE)
+        self.page = min(self.page, pages - 1)
+        page_ids = ids[self.page * self.PAGE_SIZE:(self.page + 1) * self.PAGE_SIZE]
+
+        wanted = {}
+        for listing_id in page_ids:
+            row = self.rows[listing_id]
+            wanted[listing_id] = (row["hall"], row["username"], row["meal_type"], row["tokens"], row.get("price", 0), row["timestamp"])
+
+        for listing_id in [listing_id for listing_id in self.shown if listing_id not in wanted]:
+            self.tree.delete(str(listing_id))
+            del self.shown[listing_id]
+        for index, listing_id in enumerate(page_ids):
+            values = wanted[listing_id]
+            if listing_id not in self.shown:
+                self.tree.insert("", index, iid=str(listing_id), values=values)
+            else:
+                if self.shown[listing_id] != values:
+                    self.tree.item(str(listing_id), values=values)
+                    REGISTRY.inc("gui_rows_updated_total")
+                self.tree.move(str(listing_id), "", index)
+            self.shown[listing_id] = values
+
+        self.page_label.config(text=f"Page {self.page + 1} of {pages} ({len(ids)} listings)")
@@ -0,0 +1,43 @@
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks on this platform; a single process per data file is still safe.
+    fcntl = None
+
+
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.depth = 0
+
+    @contextmanager
+    def hold(self, exclusive=True):
+        if self.depth:
+            # Re-entrant: nested engine calls reuse the lock the outer call already took.
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+            return
+
+        if fcntl is not None:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        self.depth = 1
+        try:
+            yield
+        finally:
+            self.depth = 0
+            if fcntl is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
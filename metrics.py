@@ -0,0 +1,196 @@
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Latency buckets in seconds, from sub-millisecond dict work up to multi-second snapshot writes.
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.016, 0.05, 0.1, 0.5, 1.0, 5.0)
+NULL_TIMER = nullcontext()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def time(self, name, **labels):
+        if not self.enabled:
+            return NULL_TIMER
+        return self._timer(name, labels)
+
+    @contextmanager
+    def _timer(self, name, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value}
+                           for (name, labels), value in sorted(self.gauges.items())],
+                "histograms": [{"name": name, "labels": dict(labels), "count": h.count, "sum": h.total,
+                                "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], h.counts))}
+                               for (name, labels), h in sorted(self.histograms.items())],
+            }
+
+    def render_prometheus(self):
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"token_{name}{label_text(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"token_{name}{label_text(labels)} {value}")
+            for (name, labels), h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip([str(b) for b in BUCKETS] + ["+Inf"], h.counts):
+                    cumulative += count
+                    lines.append(f"token_{name}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"token_{name}_sum{label_text(labels)} {h.total}")
+                lines.append(f"token_{name}_count{label_text(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry(enabled=bool(os.environ.get("TOKEN_METRICS")))
+
+
+def start_dump(path, interval):
+    def loop():
+        while True:
+            time.sleep(interval)
+            write_dump(path)
+
+    threading.Thread(target=loop, name="metrics-dump", daemon=True).start()
+    atexit.register(write_dump, path)
+
+
+def write_dump(path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(dict(REGISTRY.snapshot(), at=time.time()), file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def serve(port, host="127.0.0.1"):
+    # http.server (and the email and ssl modules behind it) is only imported when metrics are actually served.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = REGISTRY.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def start_profiler(path):
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    def stop():
+        profiler.disable()
+        profiler.dump_stats(path)
+
+    atexit.register(stop)
+    return profiler
+
+
+def add_arguments(parser):
+    parser.add_argument("--metrics", action="store_true", help="collect counters and latency histograms")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus text metrics on this local port")
+    parser.add_argument("--metrics-dump", help="write a JSON metrics dump to this file periodically")
+    parser.add_argument("--metrics-interval", type=float, help="seconds between metrics dumps (default 30)")
+    parser.add_argument("--profile", help="run under cProfile and write stats to this file on exit")
+
+
+def configure(args=None):
+    # Command-line flags win; the TOKEN_* environment variables cover the GUI and scripts.
+    env = os.environ
+    port = getattr(args, "metrics_port", None) or env.get("TOKEN_METRICS_PORT")
+    dump = getattr(args, "metrics_dump", None) or env.get("TOKEN_METRICS_DUMP")
+    interval = getattr(args, "metrics_interval", None) or float(env.get("TOKEN_METRICS_INTERVAL", 30.0))
+    profile = getattr(args, "profile", None) or env.get("TOKEN_PROFILE")
+
+    if getattr(args, "metrics", False) or port or dump:
+        REGISTRY.enabled = True
+    if port:
+        serve(int(port))
+    if dump:
+        start_dump(dump, interval)
+    if profile:
+        start_profiler(profile)
@@ -0,0 +1,327 @@
+import heapq
+import sys
+
+from aggregates import Aggregates
+from expiry import ExpiryQueue
+from records import ORDER_FIELDS, Bid, Listing, Names, to_epoch
+from snapshot import NO_TIME
+
+MEAL_TYPES = ("Lunch", "Dinner")
+
+
+def meal_key(meal_type):
+    return meal_type.strip().capitalize()
+
+
+class OrderBook:
+    # Asks sit in a min-heap on (price, id) and bids in a max-heap on (-price, id): price first, then time.
+    # The book holds compact Listing and Bid records; dicts are only built for callers and the store.
+    def __init__(self, halls, cutoffs=None):
+        self.halls = [sys.intern(hall) for hall in halls]
+        self.expiry = ExpiryQueue(cutoffs) if cutoffs else None
+        self.queues = {(hall, meal): [] for hall in self.halls for meal in MEAL_TYPES}
+        self.totals = {bucket: 0 for bucket in self.queues}
+        self.by_id = {}
+        self.by_seller = {}
+        self.bid_queues = {bucket: [] for bucket in self.queues}
+        self.bids_by_id = {}
+        self.by_buyer = {}
+        self.names = Names()
+        self._stats = Aggregates(self.names)
+        # Set to a list by the engine to collect change events for subscribers; None keeps the book silent.
+        self.changes = None
+        # Set whenever an order is added, filled or removed, so a failed call knows whether memory needs reloading.
+        self.dirty = False
+        # A book opened from a binary snapshot decodes each hall the first time something needs it.
+        self.snapshot = None
+        self.unloaded = set()
+
+    @classmethod
+    def from_halls(cls, halls, default_halls, cutoffs=None, bids=None):
+        book = cls(default_halls, cutoffs)
+        for hall in book.halls:
+            for listing in halls.get(hall, []):
+                book.add(book.decode(Listing, hall, listing))
+            for bid in (bids or {}).get(hall, []):
+                book.add_bid(book.decode(Bid, hall, bid))
+        return book
+
+    @classmethod
+    def from_snapshot(cls, snapshot, default_halls, cutoffs=None):
+        book = cls(default_halls, cutoffs)
+        book.snapshot = snapshot
+        book.unloaded = {hall for hall in book.halls if hall in snapshot.halls}
+        book.names = Names(snapshot.names())
+        book._stats = None
+        return book
+
+    @property
+    def stats(self):
+        if self._stats is None:
+            self._stats = Aggregates(self.names)
+            self._stats.load_rows(self.snapshot.stats())
+        return self._stats
+
+    def _load(self, hall):
+        if hall in self.unloaded:
+            self.unloaded.discard(hall)
+            # These orders are already counted in the snapshot's totals, so they go in without touching stats.
+            for listing in self.snapshot.orders(hall, Listing):
+                self._place(listing)
+            for bid in self.snapshot.orders(hall, Bid):
+                self.add_bid(bid)
+
+    def load_all(self):
+        # Decodes everything still in the snapshot, after which the book no longer needs it open.
+        for hall in list(self.unloaded):
+            self._load(hall)
+        if self.snapshot is not None:
+            self._stats = self.stats
+            if self.names.ids is None:
+                self.names._index()
+            self.snapshot = None
+
+    def _locate(self, order_id):
+        if self.unloaded and order_id not in self.by_id and order_id not in self.bids_by_id:
+            hall = self.snapshot.find(order_id, self.unloaded)
+            if hall is not None:
+                self._load(hall)
+
+    def decode(self, kind, hall, data):
+        # Builds a record from the stored dict. Whatever the record cannot reproduce exactly (contact fields on
+        # old listings, old timestamp formats, odd meal spellings) is kept in extra, so to_dict gives back the input.
+        meal = meal_key(data["meal_type"])
+        timestamp = data["timestamp"]
+        created = to_epoch(timestamp)
+        extra = None
+        if len(data) > len(ORDER_FIELDS):
+            extra = {key: value for key, value in data.items() if key not in ORDER_FIELDS} or None
+        if created is None or len(timestamp) != 19 or timestamp[4] != "-":
+            extra = dict(extra or {}, timestamp=timestamp)
+        if data["meal_type"] != meal:
+            extra = dict(extra or {}, meal_type=data["meal_type"])
+        return kind(data["id"], hall, meal, self.names.id(data["username"]), data["tokens"],
+                    data.get("price", 0), created, extra)
+
+    def as_dict(self, order):
+        return order.to_dict(self.names)
+
+    def _bucket(self, hall, meal):
+        bucket = (hall, meal)
+        if bucket not in self.queues:
+            self.queues[bucket] = []
+            self.totals[bucket] = 0
+            self.bid_queues[bucket] = []
+        return bucket
+
+    def _changed(self, kind, listing, **extra):
+        if self.changes is not None:
+            self.changes.append(dict(extra, type=kind, hall=listing.hall, meal_type=listing.meal,
+                                     listing=self.as_dict(listing)))
+
+    def _push_expiry(self, order):
+        if self.expiry is not None:
+            self.expiry.push(order.id, self.expiry.expires_at(order.meal, order.created))
+
+    def _place(self, listing):
+        self.dirty = True
+        bucket = self._bucket(listing.hall, listing.meal)
+        heapq.heappush(self.queues[bucket], listing)
+        self.totals[bucket] += listing.tokens
+        self.by_id[listing.id] = listing
+        self.by_seller.setdefault(listing.user, {})[listing.id] = listing
+        self._push_expiry(listing)
+
+    def add(self, listing):
+        self._place(listing)
+        self.stats.listed(listing)
+        self._changed("listed", listing)
+
+    def add_bid(self, bid):
+        self.dirty = True
+        bucket = self._bucket(bid.hall, bid.meal)
+        heapq.heappush(self.bid_queues[bucket], bid)
+        self.bids_by_id[bid.id] = bid
+        self.by_buyer.setdefault(bid.user, {})[bid.id] = bid
+        self._push_expiry(bid)
+
+    def available(self, hall, meal_type):
+        self._load(hall)
+        return self.totals.get((hall, meal_key(meal_type)), 0)
+
+    def get(self, listing_id):
+        self._locate(listing_id)
+        return self.by_id.get(listing_id)
+
+    def get_bid(self, bid_id):
+        self._locate(bid_id)
+        return self.bids_by_id.get(bid_id)
+
+    def _unindex(self, listing):
+        self.dirty = True
+        self.by_id.pop(listing.id, None)
+        seller = self.by_seller.get(listing.user)
+        if seller is not None:
+            seller.pop(listing.id, None)
+            if not seller:
+                del self.by_seller[listing.user]
+
+    def _unindex_bid(self, bid):
+        self.dirty = True
+        self.bids_by_id.pop(bid.id, None)
+        buyer = self.by_buyer.get(bid.user)
+        if buyer is not None:
+            buyer.pop(bid.id, None)
+            if not buyer:
+                del self.by_buyer[bid.user]
+
+    @staticmethod
+    def _live_front(heap, live):
+        # Removed orders are dropped lazily when they reach the top of their heap.
+        while heap and heap[0].id not in live:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def fill(self, hall, meal_type, quantity, limit=None):
+        self._load(hall)
+        bucket = (hall, meal_key(meal_type))
+        queue = self.queues.get(bucket)
+        fills = []
+        while quantity > 0 and queue:
+            listing = self._live_front(queue, self.by_id)
+            if listing is None or (limit is not None and listing.price > limit):
+                break
+            taken = min(quantity, listing.tokens)
+            self.dirty = True
+            listing.tokens -= taken
+            self.totals[bucket] -= taken
+            quantity -= taken
+            self.stats.filled(listing, taken, listing.price)
+            self._changed("filled", listing, quantity=taken)
+            fills.append((listing, taken))
+            if listing.tokens == 0:
+                heapq.heappop(queue)
+                self._unindex(listing)
+        return fills
+
+    def match_bids(self, hall, meal_type, quantity, price):
+        # Resting bids at or above the ask price, best price first; the caller fills the ask itself.
+        self._load(hall)
+        queue = self.bid_queues.get((hall, meal_key(meal_type)))
+        fills = []
+        while quantity > 0 and queue:
+            bid = self._live_front(queue, self.bids_by_id)
+            if bid is None or bid.price < price:
+                break
+            taken = min(quantity, bid.tokens)
+            self.dirty = True
+            bid.tokens -= taken
+            quantity -= taken
+            fills.append((bid, taken))
+            if bid.tokens == 0:
+                heapq.heappop(queue)
+                self._unindex_bid(bid)
+        return fills
+
+    def fill_listing(self, listing_id, quantity, price=None):
+        listing = self.get(listing_id)
+        if listing is None:
+            return None
+        taken = min(quantity, listing.tokens)
+        self.dirty = True
+        listing.tokens -= taken
+        self.totals[(listing.hall, listing.meal)] -= taken
+        self.stats.filled(listing, taken, listing.price if price is None else price)
+        self._changed("filled", listing, quantity=taken)
+        if listing.tokens == 0:
+            self._unindex(listing)
+        return taken
+
+    def fill_bid(self, bid_id, quantity):
+        bid = self.get_bid(bid_id)
+        if bid is None:
+            return None
+        taken = min(quantity, bid.tokens)
+        self.dirty = True
+        bid.tokens -= taken
+        if bid.tokens == 0:
+            self._unindex_bid(bid)
+        return taken
+
+    def remove(self, listing_id, expired=False):
+        listing = self.get(listing_id)
+        if listing is None:
+            # Bids share the id sequence, so expiry records can name either.
+            return self.remove_bid(listing_id)
+        self.totals[(listing.hall, listing.meal)] -= listing.tokens
+        self.stats.removed(listing, expired)
+        self._changed("expired" if expired else "removed", listing)
+        self._unindex(listing)
+        return listing
+
+    def remove_bid(self, bid_id):
+        bid = self.get_bid(bid_id)
+        if bid is not None:
+            self._unindex_bid(bid)
+        return bid
+
+    def remove_seller(self, username):
+        self.load_all()
+        removed = []
+        user = self.names.get(username)
+        for listing_id in list(self.by_seller.get(user, {})):
+            removed.append(self.remove(listing_id))
+        for bid_id in list(self.by_buyer.get(user, {})):
+            removed.append(self.remove_bid(bid_id))
+        if self.changes is not None:
+            self.changes.append({"type": "user_removed", "hall": None, "meal_type": None, "username": username})
+        return removed
+
+    def expire_due(self, now):
+        if self.expiry is None:
+            return []
+        for hall in list(self.unloaded):
+            oldest = self.snapshot.halls[hall]["oldest"]
+            if any(self.expiry.expires_at(meal, None if created == NO_TIME else created) <= now.timestamp()
+                   for meal, created in oldest.items()):
+                self._load(hall)
+        expired = []
+        for order_id in self.expiry.pop_due(now):
+            if order_id in self.by_id:
+                expired.append(self.remove(order_id, expired=True))
+            elif order_id in self.bids_by_id:
+                expired.append(self.remove_bid(order_id))
+        return expired
+
+    def expire(self, order_ids):
+        return [self.remove(order_id, expired=True) for order_id in order_ids]
+
+    def hall_listings(self, hall):
+        self._load(hall)
+        listings = [
+            listing
+            for (bucket_hall, _), queue in self.queues.items() if bucket_hall == hall
+            for listing in queue if listing.id in self.by_id
+        ]
+        listings.sort(key=lambda listing: listing.id)
+        return listings
+
+    def hall_bids(self, hall):
+        self._load(hall)
+        bids = [
+            bid
+            for (bucket_hall, _), queue in self.bid_queues.items() if bucket_hall == hall
+            for bid in queue if bid.id in self.bids_by_id
+        ]
+        bids.sort(key=lambda bid: bid.id)
+        return bids
+
+    def buyer_bids(self, username):
+        self.load_all()
+        return list(self.by_buyer.get(self.names.get(username), {}).values())
+
+    def to_halls(self):
+        return {hall: [self.as_dict(listing) for listing in self.hall_listings(hall)] for hall in self.halls}
+
+    def bids_to_halls(self):
+        return {hall: [self.as_dict(bid) for bid in self.hall_bids(hall)] for hall in self.halls}
@@ -0,0 +1,111 @@
+import sys
+import time
+from datetime import datetime
+from functools import lru_cache
+
+from expiry import parse_timestamp
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+# The fields every stored listing and bid has; anything else is carried along in Order.extra.
+ORDER_FIELDS = ("id", "username", "meal_type", "tokens", "price", "timestamp")
+
+
+@lru_cache(maxsize=4096)
+def to_epoch(timestamp):
+    # Timestamps written by the engine take the fast path; older formats go through the general parser.
+    if len(timestamp) == 19 and timestamp[4] == "-":
+        try:
+            return int(datetime(int(timestamp[:4]), int(timestamp[5:7]), int(timestamp[8:10]), int(timestamp[11:13]),
+                                int(timestamp[14:16]), int(timestamp[17:19])).timestamp())
+        except ValueError:
+            pass
+    parsed = parse_timestamp(timestamp)
+    return int(parsed.timestamp()) if parsed is not None else None
+
+
+@lru_cache(maxsize=4096)
+def format_epoch(created):
+    return datetime.fromtimestamp(created).strftime(TIMESTAMP_FORMAT)
+
+
+def epoch_day(created):
+    if created is None:
+        return ""
+    return "%04d-%02d-%02d" % time.localtime(created)[:3]
+
+
+class Names:
+    # Every username is stored once; orders and running totals refer to it by its index here.
+    def __init__(self, names=None):
+        # A binary snapshot hands over a lazily decoded sequence; the reverse index is built on first lookup by name.
+        self.names = names if names is not None else []
+        self.ids = None if names is not None else {}
+
+    def __getitem__(self, user_id):
+        return self.names[user_id]
+
+    def __len__(self):
+        return len(self.names)
+
+    def _index(self):
+        self.names = list(self.names)
+        self.ids = {name: user_id for user_id, name in enumerate(self.names)}
+
+    def id(self, name):
+        if self.ids is None:
+            self._index()
+        user_id = self.ids.get(name)
+        if user_id is None:
+            user_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return user_id
+
+    def get(self, name):
+        if self.ids is None:
+            self._index()
+        return self.ids.get(name)
+
+
+class Order:
+    # One listing or bid: a fixed set of slots instead of a dict, with the seller as an id into Names and the
+    # timestamp as epoch seconds. Hall and meal are shared strings, so each order only holds a reference.
+    __slots__ = ("id", "hall", "meal", "user", "tokens", "price", "created", "extra")
+
+    def __init__(self, order_id, hall, meal, user, tokens, price=0, created=None, extra=None):
+        self.id = order_id
+        self.hall = sys.intern(hall)
+        self.meal = sys.intern(meal)
+        self.user = user
+        self.tokens = tokens
+        self.price = price
+        self.created = created
+        self.extra = extra
+
+    def to_dict(self, names):
+        data = {
+            "id": self.id,
+            "username": names[self.user],
+            "meal_type": self.meal,
+            "tokens": self.tokens,
+            "price": self.price,
+            "timestamp": format_epoch(self.created) if self.created is not None else "",
+        }
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+class Listing(Order):
+    # Asks order cheapest first, then oldest, so the heap holds the records themselves.
+    __slots__ = ()
+
+    def __lt__(self, other):
+        return self.price < other.price or (self.price == other.price and self.id < other.id)
+
+
+class Bid(Order):
+    # Bids order highest price first, then oldest.
+    __slots__ = ()
+
+    def __lt__(self, other):
+        return self.price > other.price or (self.price == other.price and self.id < other.id)
@@ -0,0 +1,311 @@
+import argparse
+import asyncio
+import functools
+import json
+import time
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+
+import metrics
+from admission import AdmissionControl, FairQueue, Rejected
+from engine import TIMESTAMP_FORMAT, TokenEngine, TradeError
+
+MUTATIONS = {"login", "list_tokens", "list_batch", "buy", "buy_batch", "bid", "cancel_bid", "take", "expire", "remove_user", "reset_users"}
+DATETIME_ARGS = {"at", "now"}
+SCALARS = (str, int, float, bool, type(None))
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 429: "Too Many Requests",
+               500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+def non_scalar(fields):
+    # Every argument is a JSON scalar; anything else would reach the engine as an unhashable or unusable value.
+    for name, value in fields.items():
+        if not isinstance(value, SCALARS):
+            return name
+    return None
+
+
+def request_hall(kwargs):
+    hall = kwargs.get("hall")
+    if hall is None and kwargs.get("orders"):
+        hall = kwargs["orders"][0].get("hall")
+    return hall
+
+
+class TokenServer:
+    def __init__(self, engine, host="127.0.0.1", port=8765, queue_size=1024, event_buffer=1024, heartbeat=15.0,
+                 admission=None, max_wait=2.0):
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.admission = admission if admission is not None else AdmissionControl()
+        # A write that waited longer than this is refused rather than run, which bounds the latency of a burst.
+        self.max_wait = max_wait
+        self.event_buffer = event_buffer
+        self.heartbeat = heartbeat
+        self.queues = []
+        self.server = None
+        self.writer_tasks = []
+        # A sharded engine can take calls for different workers at once, so each worker gets its own writer
+        # and calls run on executor threads instead of blocking the event loop.
+        self.lanes = getattr(engine, "lanes", 1)
+        self.threaded = self.lanes > 1
+
+    async def start(self):
+        self.queues = [FairQueue(self.queue_size) for _ in range(self.lanes)]
+        self.writer_tasks = [asyncio.create_task(self.write_loop(queue)) for queue in self.queues]
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        for task in self.writer_tasks:
+            task.cancel()
+        self.engine.close()
+
+    async def call(self, fn, *args, **kwargs):
+        if self.threaded:
+            return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args, **kwargs))
+        return fn(*args, **kwargs)
+
+    async def write_loop(self, queue):
+        # Every mutation for a lane goes through this one task, so an engine never sees two writes at once.
+        while True:
+            method, kwargs, future, queued = await queue.get()
+            self.report_depth()
+            waited = time.monotonic() - queued
+            metrics.REGISTRY.observe("server_queue_wait_seconds", waited)
+            if future.cancelled():
+                pass
+            elif self.max_wait and waited > self.max_wait:
+                metrics.REGISTRY.inc("server_rejections_total", reason="deadline")
+                future.set_exception(Rejected("The server is busy; try again shortly.", 503, self.max_wait))
+            else:
+                try:
+                    result = await self.call(getattr(self.engine, method), **kwargs)
+                except Exception as e:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                else:
+                    if not future.cancelled():
+                        future.set_result(result)
+            if queue.empty():
+                self.engine.sync()
+
+    def report_depth(self):
+        metrics.REGISTRY.set("server_queue_depth", sum(queue.qsize() for queue in self.queues))
+
+    async def submit(self, method, kwargs):
+        future = asyncio.get_running_loop().create_future()
+        lane = self.engine.lane_for(method, kwargs) if self.threaded else 0
+        try:
+            self.queues[lane].put(request_hall(kwargs), (method, kwargs, future, time.monotonic()))
+        except asyncio.QueueFull:
+            # Backpressure: a full queue answers at once instead of making the caller wait behind it.
+            metrics.REGISTRY.inc("server_rejections_total", reason="queue_full")
+            raise Rejected("The server is busy; try again shortly.", 503, self.max_wait or 1.0)
+        self.report_depth()
+        return await future
+
+    def read(self, path, query):
+        if path == "/book":
+            return self.engine.snapshot(query.get("hall"))
+        if path == "/summary":
+            return self.engine.summary(query.get("hall"), query.get("day"), query.get("username"))
+        if path == "/bids":
+            return self.engine.bids(query.get("hall"), query.get("username"))
+        if path == "/users":
+            return self.engine.usernames()
+        if path == "/user":
+            return self.engine.user(query.get("username"))
+        if path == "/halls":
+            return self.engine.halls
+        return None
+
+    async def dispatch(self, verb, target, body, client=None):
+        url = urlsplit(target)
+        path = url.path
+        if verb == "GET":
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if path not in ("/book", "/bids", "/summary", "/users", "/user", "/halls"):
+                return 404, {"error": f"Unknown endpoint {path}"}
+            # Reads skip the writer queue but still build their answer on the event loop, so every read takes from
+            # its address's bucket, and from the user's bucket when it names one.
+            try:
+                self.admission.admit(client, query.get("username") or None, write=False)
+            except Rejected as e:
+                return e.status, {"error": str(e), "retry_after": e.retry_after}
+            return 200, {"result": await self.call(self.read, path, query)}
+
+        if verb != "POST":
+            return 405, {"error": f"Method {verb} not allowed"}
+        method = path.strip("/")
+        if method not in MUTATIONS:
+            return 404, {"error": f"Unknown endpoint {path}"}
+        try:
+            kwargs = json.loads(body) if body else {}
+            if not isinstance(kwargs, dict):
+                raise ValueError
+        except ValueError:
+            return 400, {"error": "Request body must be a JSON object."}
+        orders = kwargs.get("orders")
+        if "orders" in kwargs and not (isinstance(orders, list) and all(isinstance(order, dict) for order in orders)):
+            return 400, {"error": "orders must be a list of JSON objects."}
+        name = non_scalar({key: value for key, value in kwargs.items() if key != "orders"})
+        if name is not None:
+            return 400, {"error": f"{name} must be a string or a number."}
+        for number, order in enumerate(orders or [], start=1):
+            name = non_scalar(order)
+            if name is not None:
+                return 400, {"error": f"Order {number}: {name} must be a string or a number."}
+        for name in DATETIME_ARGS & kwargs.keys():
+            if kwargs[name] is None:
+                continue
+            try:
+                kwargs[name] = datetime.strptime(kwargs[name], TIMESTAMP_FORMAT)
+            except (TypeError, ValueError):
+                return 400, {"error": f"{name} must be a timestamp like 2024-01-31 12:00:00."}
+        try:
+            username = kwargs.get("username")
+            self.admission.admit(client, username if isinstance(username, str) else None)
+            return 200, {"result": await self.submit(method, kwargs)}
+        except Rejected as e:
+            return e.status, {"error": str(e), "retry_after": e.retry_after}
+        except (TradeError, TypeError) as e:
+            return 400, {"error": str(e)}
+
+    async def stream_events(self, writer, query):
+        # Server-Sent Events: one "data:" line per engine event, plus a comment line as a heartbeat when idle.
+        events = asyncio.Queue(self.event_buffer)
+        loop = asyncio.get_running_loop()
+
+        def push(event):
+            try:
+                events.put_nowait(event)
+            except asyncio.QueueFull:
+                # The client is too slow to keep up; drop its backlog and tell it to reload instead.
+                while not events.empty():
+                    events.get_nowait()
+                events.put_nowait({"type": "reset", "hall": None, "meal_type": None})
+                metrics.REGISTRY.inc("server_event_overflows_total")
+
+        def deliver(event):
+            # Engines publish from whichever thread made the change; hand the event to the loop safely.
+            loop.call_soon_threadsafe(push, event)
+
+        token = self.engine.subscribe(deliver, query.get("hall"), query.get("meal_type"))
+        metrics.REGISTRY.inc("server_event_streams_total")
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                         b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    writer.write(b": ping\n\n")
+                else:
+                    writer.write(b"data: " + json.dumps(event).encode() + b"\n\n")
+                await writer.drain()
+        finally:
+            self.engine.unsubscribe(token)
+
+    async def handle(self, reader, writer):
+        client = (writer.get_extra_info("peername") or ("local",))[0]
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                verb, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                body = await reader.readexactly(length) if length else b""
+
+                content_type = "application/json"
+                if verb == "GET" and urlsplit(target).path == "/events":
+                    query = {key: values[0] for key, values in parse_qs(urlsplit(target).query).items()}
+                    await self.stream_events(writer, query)
+                    break
+                if verb == "GET" and urlsplit(target).path == "/metrics":
+                    status, data, content_type = 200, metrics.REGISTRY.render_prometheus().encode(), "text/plain; version=0.0.4"
+                else:
+                    try:
+                        status, payload = await self.dispatch(verb, target, body, client)
+                    except Exception as e:
+                        status, payload = 500, {"error": str(e)}
+                    data = json.dumps(payload).encode()
+                keep_alive = headers.get("connection", "").lower() != "close"
+                retry = f"Retry-After: {max(1, round(payload['retry_after']))}\r\n" if status in (429, 503) else ""
+                writer.write(
+                    f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                    f"Content-Type: {content_type}\r\n{retry}"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(engine, host, port, **options):
+    server = TokenServer(engine, host, port, **options)
+    await server.start()
+    print(f"Token server listening on http://{server.host}:{server.port}")
+    try:
+        await server.server.serve_forever()
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Token Trading System HTTP server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--data", default="token_data.json")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="run the halls in this many worker processes, each with its own data files (0: one process)")
+    parser.add_argument("--user-rate", type=float, default=10.0, help="requests per second allowed per user (0: no limit)")
+    parser.add_argument("--user-burst", type=int, default=30, help="requests a user may make at once before being limited")
+    parser.add_argument("--peer-rate", type=float, default=100.0,
+                        help="requests per second allowed per client address, whatever users they name (0: no limit)")
+    parser.add_argument("--peer-burst", type=int, default=200)
+    parser.add_argument("--global-rate", type=float, default=1000.0, help="writes per second across all users (0: no limit)")
+    parser.add_argument("--global-burst", type=int, default=1000)
+    parser.add_argument("--queue-size", type=int, default=1024, help="writes waiting per writer before new ones are refused")
+    parser.add_argument("--max-wait", type=float, default=2.0,
+                        help="seconds a write may wait in the queue before it is refused (0: no limit)")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure(args)
+    if args.shards:
+        from sharded import ShardedEngine
+        try:
+            engine = ShardedEngine(args.data, workers=args.shards)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        engine = TokenEngine(args.data)
+    try:
+        admission = AdmissionControl(args.user_rate, args.user_burst, args.global_rate, args.global_burst,
+                                     args.peer_rate, args.peer_burst)
+        asyncio.run(serve(engine, args.host, args.port, queue_size=args.queue_size, admission=admission,
+                          max_wait=args.max_wait))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
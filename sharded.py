@@ -0,0 +1,275 @@
+import multiprocessing
+import os
+import threading
+
+from engine import TokenEngine, TradeError, configured_halls
+from events import EventBus
+from locking import FileLock
+from storage import open_store
+
+# Ids are handed out in steps of this many, one residue per hall, so halls can be appended to the config later.
+ID_STEP = 64
+
+
+def shard_file(data_file, hall):
+    base, ext = os.path.splitext(data_file)
+    return f"{base}.{hall.lower().replace(' ', '-')}{ext or '.json'}"
+
+
+def holds_data(data_file, halls):
+    # True when the one-process data file has users or has ever had an order; sharded mode never reads it.
+    if not any(os.path.exists(path) for path in (data_file, data_file + ".log")):
+        return False
+    store = open_store(data_file)
+    lock = FileLock(data_file + ".lock")
+    try:
+        with lock.hold(exclusive=False):
+            state = store.load(halls)
+    finally:
+        lock.close()
+        store.close()
+    return len(state["users"]) > 0 or state["next_id"] > 1
+
+
+def serve_shard(connection, data_file, halls, offsets, engine_options, events):
+    # Each worker process owns the engines for its halls and runs their calls one at a time: a single writer.
+    try:
+        engines = {hall: TokenEngine(shard_file(data_file, hall), halls=[hall], id_offset=offsets[hall],
+                                     id_step=ID_STEP, **engine_options) for hall in halls}
+    except Exception as e:
+        connection.send(("error", e))
+        return
+    connection.send(("ok", None))
+    forwarding = False
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        hall, method, args, kwargs = request
+        if method == "forward_events":
+            if not forwarding:
+                for hall_name, engine in engines.items():
+                    # Users are replicated to every hall, but only the primary hall reports their removal.
+                    if offsets[hall_name] == 0:
+                        engine.subscribe(events.put)
+                    else:
+                        engine.subscribe(lambda event: event["type"] != "user_removed" and events.put(event))
+                forwarding = True
+            connection.send(("ok", None))
+            continue
+        try:
+            result = getattr(engines[hall], method)(*args, **kwargs)
+        except Exception as e:
+            connection.send(("error", e))
+        else:
+            connection.send(("ok", result))
+        if not connection.poll():
+            for engine in engines.values():
+                engine.sync()
+    for engine in engines.values():
+        engine.close()
+    connection.close()
+
+
+class ShardedEngine:
+    # A router with the TokenEngine interface; every hall lives in a worker process with its own book and log.
+    def __init__(self, data_file="token_data.json", halls=None, workers=None, **engine_options):
+        self.data_file = data_file
+        self.default_halls = list(halls or configured_halls())
+        if len(self.default_halls) > ID_STEP:
+            raise ValueError(f"At most {ID_STEP} halls can be sharded.")
+        if holds_data(data_file, self.default_halls):
+            raise ValueError(f"{data_file} holds data that sharded mode would not see; keep serving it without "
+                             f"--shards, or move it aside to start the shards empty.")
+        workers = max(1, min(workers or os.cpu_count() or 1, len(self.default_halls)))
+        offsets = {hall: index for index, hall in enumerate(self.default_halls)}
+
+        context = multiprocessing.get_context("spawn")
+        self.event_queue = context.Queue()
+        self.events = EventBus()
+        self.forwarding = False
+        self.workers = []
+        self.worker_of = {}
+        for index in range(workers):
+            halls = self.default_halls[index::workers]
+            parent, child = context.Pipe()
+            process = context.Process(target=serve_shard, name=f"token-shard-{index}", daemon=True,
+                                      args=(child, data_file, halls, offsets, engine_options, self.event_queue))
+            process.start()
+            child.close()
+            self.workers.append((parent, threading.Lock(), process))
+            for hall in halls:
+                self.worker_of[hall] = index
+        for connection, _, _ in self.workers:
+            status, value = connection.recv()
+            if status == "error":
+                self.close()
+                raise value
+        # The first hall's engine decides registrations; every other hall keeps a replica of the user list.
+        self.primary = self.default_halls[0]
+
+    def _call(self, hall, method, *args, **kwargs):
+        if hall not in self.worker_of:
+            raise TradeError(f"Hall '{hall}' does not exist.")
+        connection, lock, _ = self.workers[self.worker_of[hall]]
+        with lock:
+            connection.send((hall, method, args, kwargs))
+            status, value = connection.recv()
+        if status == "error":
+            raise value
+        return value
+
+    def _each(self, method, *args, **kwargs):
+        return [self._call(hall, method, *args, **kwargs) for hall in self.default_halls]
+
+    def lane_for(self, method, kwargs):
+        # The HTTP server runs one writer per worker; calls that touch every hall go through the first one.
+        hall = kwargs.get("hall")
+        if hall is None and kwargs.get("orders"):
+            hall = kwargs["orders"][0].get("hall")
+        return self.worker_of.get(hall, 0)
+
+    @property
+    def lanes(self):
+        return len(self.workers)
+
+    @property
+    def halls(self):
+        return list(self.default_halls)
+
+    def sync(self):
+        # Workers fsync their own logs whenever their request pipe runs dry.
+        pass
+
+    def close(self):
+        for connection, lock, process in self.workers:
+            with lock:
+                try:
+                    connection.send(None)
+                except OSError:
+                    pass
+            process.join(5)
+            connection.close()
+        self.workers = []
+
+    def user(self, username):
+        return self._call(self.primary, "user", username)
+
+    def usernames(self):
+        return self._call(self.primary, "usernames")
+
+    def login(self, username, roll, mobile):
+        status = self._call(self.primary, "login", username, roll, mobile)
+        for hall in self.default_halls[1:]:
+            self._call(hall, "login", username, roll, mobile)
+        return status
+
+    def list_tokens(self, username, hall, meal_type, tokens, at=None, price=0):
+        return self._call(hall, "list_tokens", username, hall, meal_type, tokens, at=at, price=price)
+
+    def _group(self, orders):
+        groups = {}
+        for order in orders:
+            groups.setdefault(order.get("hall"), []).append(order)
+        return groups
+
+    def list_batch(self, orders, at=None):
+        # Every hall validates its part first, so a bad order rejects the batch before any hall has written.
+        groups = self._group(orders)
+        for hall, group in groups.items():
+            try:
+                self._call(hall, "check_listings", group, at=at)
+            except TradeError as e:
+                raise TradeError(f"{hall}: {e}")
+        listings = {}
+        for hall, group in groups.items():
+            listings[hall] = iter(self._call(hall, "list_batch", group, at=at))
+        return [next(listings[order.get("hall")]) for order in orders]
+
+    def buy(self, username, hall, meal_type, quantity):
+        return self._call(hall, "buy", username, hall, meal_type, quantity)
+
+    def bid(self, username, hall, meal_type, quantity, price, at=None):
+        return self._call(hall, "bid", username, hall, meal_type, quantity, price, at=at)
+
+    def cancel_bid(self, username, bid_id):
+        hall = self.default_halls[bid_id % ID_STEP] if bid_id % ID_STEP < len(self.default_halls) else None
+        return self._call(hall, "cancel_bid", username, bid_id)
+
+    def take(self, username, hall, listing_id):
+        return self._call(hall, "take", username, hall, listing_id)
+
+    def buy_batch(self, username, orders):
+        groups = self._group(orders)
+        if len(groups) > 1:
+            raise TradeError("A batch can only buy from one hall at a time.")
+        if not groups:
+            return []
+        hall, = groups
+        return self._call(hall, "buy_batch", username, orders)
+
+    def expire(self, now=None):
+        return sum(self._each("expire", now=now))
+
+    def remove_user(self, username):
+        self._call(self.primary, "remove_user", username)
+        for hall in self.default_halls[1:]:
+            try:
+                self._call(hall, "remove_user", username)
+            except TradeError:
+                pass
+
+    def reset_users(self):
+        self._each("reset_users")
+
+    def snapshot(self, hall=None):
+        if hall is not None:
+            return self._call(hall, "snapshot", hall)
+        return {hall: self._call(hall, "snapshot", hall)[hall] for hall in self.default_halls}
+
+    def bids(self, hall=None, username=None):
+        if username is not None:
+            return [bid for bids in self._each("bids", username=username) for bid in bids]
+        if hall is not None:
+            return self._call(hall, "bids", hall)
+        return {hall: self._call(hall, "bids", hall)[hall] for hall in self.default_halls}
+
+    def summary(self, hall=None, day=None, username=None):
+        halls = [hall] if hall is not None else self.default_halls
+        buckets = []
+        sellers = {}
+        for name in halls:
+            part = self._call(name, "summary", name, day, username)
+            buckets.extend(part["buckets"])
+            for row in part["sellers"]:
+                total = sellers.setdefault(row["username"], dict.fromkeys(row, 0))
+                for field, value in row.items():
+                    if field != "username":
+                        total[field] += value
+                total["username"] = row["username"]
+        buckets.sort(key=lambda row: (row["hall"], row["meal_type"], row["day"]))
+        return {"buckets": buckets, "sellers": [sellers[name] for name in sorted(sellers)]}
+
+    def subscribe(self, callback, hall=None, meal_type=None):
+        if not self.forwarding:
+            self.forwarding = True
+            threading.Thread(target=self._pump_events, name="shard-events", daemon=True).start()
+            for connection, lock, _ in self.workers:
+                with lock:
+                    connection.send((None, "forward_events", (), {}))
+                    connection.recv()
+        return self.events.subscribe(callback, hall, meal_type)
+
+    def unsubscribe(self, token):
+        return self.events.unsubscribe(token)
+
+    def _pump_events(self):
+        while True:
+            self.events.publish([self.event_queue.get()])
+
+    def poll(self):
+        # Workers push their events; there is nothing to poll for.
+        return None
@@ -0,0 +1,217 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+from array import array
+
+from records import Bid
+from users import User
+
+MAGIC = b"TKSN"
+VERSION = 1
+# Magic, format version and the length of the JSON header that follows.
+PREAMBLE = struct.Struct("<4sHI")
+# One fixed-size record per listing or bid: id, created, price, user (index into names), meal and extra
+# (indexes into the string table, extra -1 when there is none) and tokens.
+ORDER = struct.Struct("<qqdiiiI")
+# Username, roll and mobile as indexes into the string table.
+USER = struct.Struct("<III")
+SPAN = struct.Struct("<II")
+NO_TIME = -(2 ** 63)
+SUFFIX = ".bin"
+
+
+def write_snapshot(path, users, book, next_id, seq):
+    # Layout: preamble, JSON header, then the sections it lists. Orders are stored per hall, sorted by id, so a
+    # reader can binary-search for an id without decoding anything.
+    strings = {}
+
+    def intern(value):
+        index = strings.get(value)
+        if index is None:
+            index = strings[value] = len(strings)
+        return index
+
+    def pack(order):
+        return ORDER.pack(order.id, NO_TIME if order.created is None else order.created, order.price, order.user,
+                          intern(order.meal), intern(json.dumps(order.extra)) if order.extra else -1, order.tokens)
+
+    blobs = []
+    sections = {}
+    offset = 0
+
+    def section(name, data):
+        nonlocal offset
+        sections[name] = [offset, len(data)]
+        blobs.append(data)
+        offset += len(data)
+
+    section("users", b"".join(USER.pack(intern(name), intern(user.roll), intern(user.mobile))
+                              for name, user in users.items()))
+    section("names", array("I", [intern(book.names[user]) for user in range(len(book.names))]).tobytes())
+    section("stats", json.dumps(book.stats.to_rows(), separators=(",", ":")).encode())
+    halls = []
+    for hall in book.halls:
+        oldest = {}
+        for kind, orders in (("listings", book.hall_listings(hall)), ("bids", book.hall_bids(hall))):
+            section(f"{kind}:{hall}", b"".join(pack(order) for order in orders))
+            for order in orders:
+                # The oldest order per meal tells a reader whether anything in the hall is due to expire.
+                created = NO_TIME if order.created is None else order.created
+                oldest[order.meal] = min(oldest.get(order.meal, created), created)
+        halls.append({"name": hall, "oldest": oldest})
+
+    encoded = [value.encode() for value in strings]
+    spans = array("I", [0])
+    for value in encoded:
+        spans.append(spans[-1] + len(value))
+    section("string_spans", spans.tobytes())
+    section("strings", b"".join(encoded))
+
+    header = json.dumps({
+        "seq": seq,
+        "next_id": next_id,
+        "halls": halls,
+        "users": len(users),
+        "names": len(book.names),
+        "strings": len(encoded),
+        "sections": sections,
+    }).encode()
+    with open(path, "wb") as file:
+        file.write(PREAMBLE.pack(MAGIC, VERSION, len(header)) + header)
+        for blob in blobs:
+            file.write(blob)
+        file.flush()
+        os.fsync(file.fileno())
+        return file.tell()
+
+
+class Snapshot:
+    # A memory-mapped snapshot. Opening it only reads the header; users, names, totals and each hall's orders are
+    # decoded the first time they are asked for.
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise EOFError(f"{path} is empty")
+        magic, version, length = PREAMBLE.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a token snapshot")
+        if version != VERSION:
+            self.close()
+            raise ValueError(f"{path} is snapshot version {version}; this build reads version {VERSION}")
+        self.header = json.loads(self.map[PREAMBLE.size:PREAMBLE.size + length])
+        self.base = PREAMBLE.size + length
+        self.seq = self.header["seq"]
+        self.next_id = self.header["next_id"]
+        self.halls = {info["name"]: info for info in self.header["halls"]}
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def _section(self, name):
+        offset, length = self.header["sections"][name]
+        return self.base + offset, length
+
+    def string(self, index):
+        spans, _ = self._section("string_spans")
+        start, end = SPAN.unpack_from(self.map, spans + 4 * index)
+        strings, _ = self._section("strings")
+        return self.map[strings + start:strings + end].decode()
+
+    def names(self):
+        return NameColumn(self)
+
+    def users(self):
+        start, length = self._section("users")
+        return {self.string(name): User(self.string(roll), self.string(mobile))
+                for name, roll, mobile in USER.iter_unpack(self.map[start:start + length])}
+
+    def stats(self):
+        start, length = self._section("stats")
+        return json.loads(self.map[start:start + length])
+
+    def orders(self, hall, kind):
+        start, length = self._section(f"{'bids' if kind is Bid else 'listings'}:{hall}")
+        meals = {}
+        for order_id, created, price, user, meal, extra, tokens in ORDER.iter_unpack(self.map[start:start + length]):
+            if meal not in meals:
+                meals[meal] = self.string(meal)
+            yield kind(order_id, hall, meals[meal], user, tokens, int(price) if price.is_integer() else price,
+                       None if created == NO_TIME else created, json.loads(self.string(extra)) if extra >= 0 else None)
+
+    def _contains(self, name, order_id):
+        start, length = self._section(name)
+        low, high = 0, length // ORDER.size
+        while low < high:
+            middle = (low + high) // 2
+            found = struct.unpack_from("<q", self.map, start + middle * ORDER.size)[0]
+            if found < order_id:
+                low = middle + 1
+            elif found > order_id:
+                high = middle
+            else:
+                return True
+        return False
+
+    def find(self, order_id, halls):
+        for hall in halls:
+            if self._contains(f"listings:{hall}", order_id) or self._contains(f"bids:{hall}", order_id):
+                return hall
+        return None
+
+
+class NameColumn:
+    # The names section as a read-only sequence, decoded one entry at a time.
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.start, _ = snapshot._section("names")
+        self.count = snapshot.header["names"]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return self.snapshot.string(struct.unpack_from("<I", self.snapshot.map, self.start + 4 * index)[0])
+
+    def __iter__(self):
+        return (self[index] for index in range(self.count))
+
+
+def convert(source, target, halls=None):
+    # Either direction between the JSON snapshot and the binary one; the source's log is folded in on the way.
+    from engine import configured_halls
+    from locking import FileLock
+    from storage import LogStore
+
+    reader = LogStore(source)
+    lock = FileLock(source + ".lock")
+    with lock.hold(exclusive=False):
+        state = reader.load(list(halls or configured_halls()))
+    lock.close()
+    writer = LogStore(target)
+    writer.seq = reader.seq
+    writer.compact(state)
+    writer.close()
+    reader.close()
+    return len(state["users"]), len(state["book"].by_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a token data file between the JSON and binary snapshot formats")
+    parser.add_argument("source", help=f"a .json data file, or a {SUFFIX} snapshot to turn back into JSON")
+    parser.add_argument("target")
+    args = parser.parse_args()
+    users, listings = convert(args.source, args.target)
+    print(f"Wrote {users} users and {listings} listings to {args.target}.")
+
+
+if __name__ == "__main__":
+    main()
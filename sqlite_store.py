@@ -0,0 +1,316 @@
+import argparse
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+
+from aggregates import listing_day
+from metrics import REGISTRY
+from orderbook import OrderBook
+from users import UserDirectory
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    roll TEXT NOT NULL UNIQUE,
+    mobile TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_mobile ON users (mobile);
+CREATE TABLE IF NOT EXISTS listings (
+    id INTEGER PRIMARY KEY,
+    hall TEXT NOT NULL,
+    meal_type TEXT NOT NULL,
+    username TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    price REAL NOT NULL DEFAULT 0,
+    timestamp TEXT NOT NULL,
+    roll TEXT,
+    mobile TEXT,
+    status TEXT NOT NULL DEFAULT 'open'
+);
+DROP INDEX IF EXISTS listings_book;
+CREATE INDEX IF NOT EXISTS listings_seller ON listings (username) WHERE status = 'open';
+CREATE INDEX IF NOT EXISTS listings_open ON listings (id) WHERE status = 'open';
+CREATE TABLE IF NOT EXISTS fills (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    listing_id INTEGER NOT NULL,
+    buyer TEXT,
+    qty INTEGER NOT NULL,
+    price REAL NOT NULL DEFAULT 0,
+    bid_id INTEGER,
+    at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fills_listing ON fills (listing_id);
+CREATE TABLE IF NOT EXISTS bids (
+    id INTEGER PRIMARY KEY,
+    hall TEXT NOT NULL,
+    meal_type TEXT NOT NULL,
+    username TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    price REAL NOT NULL,
+    timestamp TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'open'
+);
+DROP INDEX IF EXISTS bids_book;
+CREATE INDEX IF NOT EXISTS bids_open ON bids (id) WHERE status = 'open';
+CREATE TABLE IF NOT EXISTS closed_buckets (
+    hall TEXT NOT NULL,
+    meal_type TEXT NOT NULL,
+    day TEXT NOT NULL,
+    filled INTEGER NOT NULL DEFAULT 0,
+    volume REAL NOT NULL DEFAULT 0,
+    expired INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (hall, meal_type, day)
+);
+CREATE TABLE IF NOT EXISTS closed_sellers (
+    username TEXT PRIMARY KEY,
+    sold INTEGER NOT NULL DEFAULT 0,
+    volume REAL NOT NULL DEFAULT 0,
+    expired INTEGER NOT NULL DEFAULT 0
+);
+"""
+# Columns added after the first release; older databases get them on open.
+UPGRADES = (("listings", "price", "REAL NOT NULL DEFAULT 0"),
+            ("fills", "price", "REAL NOT NULL DEFAULT 0"),
+            ("fills", "bid_id", "INTEGER"))
+
+# Only a clash on the username is an update; a clash on the roll number must fail rather than delete the other user.
+INSERT_USER = ("INSERT INTO users (username, roll, mobile) VALUES (?, ?, ?) "
+               "ON CONFLICT (username) DO UPDATE SET roll = excluded.roll, mobile = excluded.mobile")
+INSERT_LISTING = ("INSERT OR REPLACE INTO listings (id, hall, meal_type, username, tokens, price, timestamp, roll, mobile) "
+                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+INSERT_BID = ("INSERT OR REPLACE INTO bids (id, hall, meal_type, username, tokens, price, timestamp) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?)")
+FILL_LISTING = ("UPDATE listings SET tokens = tokens - ?, status = CASE WHEN tokens - ? <= 0 THEN 'filled' ELSE status END "
+                "WHERE id = ? AND status = 'open'")
+FILL_BID = ("UPDATE bids SET tokens = tokens - ?, status = CASE WHEN tokens - ? <= 0 THEN 'filled' ELSE status END "
+            "WHERE id = ? AND status = 'open'")
+INSERT_FILL = "INSERT INTO fills (listing_id, buyer, qty, price, bid_id, at) VALUES (?, ?, ?, ?, ?, ?)"
+EXPIRE_LISTING = "UPDATE listings SET status = 'expired' WHERE id = ? AND status = 'open'"
+EXPIRE_BID = "UPDATE bids SET status = 'expired' WHERE id = ? AND status = 'open'"
+CANCEL_BID = "UPDATE bids SET status = 'cancelled' WHERE id = ? AND status = 'open'"
+DELETE_USER = "DELETE FROM users WHERE username = ?"
+REMOVE_SELLER = "UPDATE listings SET status = 'removed' WHERE username = ? AND status = 'open'"
+REMOVE_BUYER = "UPDATE bids SET status = 'removed' WHERE username = ? AND status = 'open'"
+OPEN_LISTINGS = ("SELECT id, hall, meal_type, username, tokens, price, timestamp, roll, mobile FROM listings "
+                 "WHERE status = 'open' ORDER BY id")
+OPEN_BIDS = "SELECT id, hall, username, meal_type, tokens, price, timestamp FROM bids WHERE status = 'open' ORDER BY id"
+# Closed totals for the running aggregates, kept up to date in the same transaction as each fill and expiry.
+LISTING_OWNER = "SELECT hall, meal_type, username, tokens, timestamp FROM listings WHERE id = ? AND status = 'open'"
+ADD_CLOSED_BUCKET = ("INSERT INTO closed_buckets (hall, meal_type, day, filled, volume, expired) VALUES (?, ?, ?, ?, ?, ?) "
+                     "ON CONFLICT (hall, meal_type, day) DO UPDATE SET filled = filled + excluded.filled, "
+                     "volume = volume + excluded.volume, expired = expired + excluded.expired")
+ADD_CLOSED_SELLER = ("INSERT INTO closed_sellers (username, sold, volume, expired) VALUES (?, ?, ?, ?) "
+                     "ON CONFLICT (username) DO UPDATE SET sold = sold + excluded.sold, "
+                     "volume = volume + excluded.volume, expired = expired + excluded.expired")
+# Only used once, to fill the tables above in a database written before they existed.
+FILL_TOTALS = ("SELECT l.hall, l.meal_type, l.timestamp, l.username, SUM(f.qty) AS qty, SUM(f.qty * f.price) AS volume "
+               "FROM fills f JOIN listings l ON l.id = f.listing_id GROUP BY l.hall, l.meal_type, l.timestamp, l.username")
+EXPIRED_TOTALS = ("SELECT hall, meal_type, timestamp, username, SUM(tokens) AS qty FROM listings WHERE status = 'expired' "
+                  "GROUP BY hall, meal_type, timestamp, username")
+
+
+def _number(value):
+    # REAL columns come back as floats; whole prices read back as ints, matching the JSON store.
+    return int(value) if float(value).is_integer() else value
+
+
+class SqliteStore:
+    def __init__(self, db_file):
+        self.data_file = db_file
+        self.db = sqlite3.connect(db_file, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        upgrading = self._has_rows("listings") and not self._has_table("closed_buckets")
+        self.db.executescript(SCHEMA)
+        for table, column, declaration in UPGRADES:
+            if column not in {row["name"] for row in self.db.execute(f"PRAGMA table_info({table})")}:
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+        self.depth = 0
+        self.data_version = None
+        if upgrading:
+            with self.transaction():
+                self._backfill_closed_totals()
+
+    def _has_table(self, name):
+        return self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+    def _has_rows(self, table):
+        return self._has_table(table) and self.db.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is not None
+
+    def _data_version(self):
+        return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def load(self, default_halls, cutoffs=None):
+        # Only users and open listings are read; fills and closed listings stay on disk.
+        users = {row["username"]: {"roll": row["roll"], "mobile": row["mobile"]}
+                 for row in self.db.execute("SELECT username, roll, mobile FROM users")}
+        halls = {hall: [] for hall in default_halls}
+        for row in self.db.execute(OPEN_LISTINGS):
+            listing = {"id": row["id"], "username": row["username"], "meal_type": row["meal_type"],
+                       "tokens": row["tokens"], "price": _number(row["price"]), "timestamp": row["timestamp"]}
+            if row["roll"] is not None:
+                listing["roll"] = row["roll"]
+                listing["mobile"] = row["mobile"]
+            halls.setdefault(row["hall"], []).append(listing)
+        bids = {hall: [] for hall in default_halls}
+        for row in self.db.execute(OPEN_BIDS):
+            bid = dict(row)
+            bid["price"] = _number(bid["price"])
+            bids.setdefault(bid.pop("hall"), []).append(bid)
+        # Listings and bids share one id sequence.
+        next_id = max(self.db.execute("SELECT MAX(id) FROM listings").fetchone()[0] or 0,
+                      self.db.execute("SELECT MAX(id) FROM bids").fetchone()[0] or 0) + 1
+        book = OrderBook.from_halls(halls, default_halls, cutoffs, bids)
+        book.stats.load_closed({
+            "buckets": [[row["hall"], row["meal_type"], row["day"], row["filled"], _number(row["volume"]), row["expired"]]
+                        for row in self.db.execute("SELECT * FROM closed_buckets")],
+            "sellers": [[row["username"], row["sold"], _number(row["volume"]), row["expired"]]
+                        for row in self.db.execute("SELECT * FROM closed_sellers")],
+        })
+        self.data_version = self._data_version()
+        return {
+            "users": UserDirectory(users),
+            "book": book,
+            "next_id": next_id,
+        }
+
+    def _add_closed(self, listing, filled=0, volume=0, expired=0):
+        self.db.execute(ADD_CLOSED_BUCKET, (listing["hall"], listing["meal_type"], listing_day(listing["timestamp"]),
+                                            filled, volume, expired))
+        self.db.execute(ADD_CLOSED_SELLER, (listing["username"], filled, volume, expired))
+
+    def _backfill_closed_totals(self):
+        for row in self.db.execute(FILL_TOTALS).fetchall():
+            self._add_closed(row, filled=row["qty"], volume=row["volume"])
+        for row in self.db.execute(EXPIRED_TOTALS).fetchall():
+            self._add_closed(row, expired=row["qty"])
+
+    def version(self):
+        return self.data_version
+
+    def stale(self):
+        return "reload" if self._data_version() != self.data_version else None
+
+    def catch_up(self, state):
+        return 0
+
+    @contextmanager
+    def transaction(self):
+        if self.depth:
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+            return
+        self.db.execute("BEGIN IMMEDIATE")
+        self.depth = 1
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        else:
+            with REGISTRY.time("store_commit_seconds", store="sqlite"):
+                self.db.execute("COMMIT")
+        finally:
+            self.depth = 0
+
+    def append(self, op, **fields):
+        REGISTRY.inc("store_records_total", op=op)
+        db = self.db
+        if op == "register":
+            db.execute(INSERT_USER, (fields["username"], fields["roll"], fields["mobile"]))
+        elif op == "list":
+            listing = fields["listing"]
+            db.execute(INSERT_LISTING, (listing["id"], fields["hall"], listing["meal_type"], listing["username"],
+                                        listing["tokens"], listing.get("price", 0), listing["timestamp"],
+                                        listing.get("roll"), listing.get("mobile")))
+        elif op == "fill":
+            listing = db.execute(LISTING_OWNER, (fields["id"],)).fetchone()
+            if listing is not None:
+                self._add_closed(listing, filled=fields["qty"], volume=fields["qty"] * fields.get("price", 0))
+            db.execute(FILL_LISTING, (fields["qty"], fields["qty"], fields["id"]))
+            if fields.get("bid") is not None:
+                db.execute(FILL_BID, (fields["qty"], fields["qty"], fields["bid"]))
+            db.execute(INSERT_FILL, (fields["id"], fields.get("buyer"), fields["qty"], fields.get("price", 0),
+                                     fields.get("bid"), datetime.now().isoformat(" ", "seconds")))
+        elif op == "bid":
+            bid = fields["bid"]
+            db.execute(INSERT_BID, (bid["id"], fields["hall"], bid["meal_type"], bid["username"], bid["tokens"],
+                                    bid["price"], bid["timestamp"]))
+        elif op == "cancel_bid":
+            db.execute(CANCEL_BID, (fields["id"],))
+        elif op == "expire":
+            # Ids are shared between listings and bids, so each one closes whichever row it names.
+            for order_id in fields["ids"]:
+                listing = db.execute(LISTING_OWNER, (order_id,)).fetchone()
+                if listing is not None:
+                    self._add_closed(listing, expired=listing["tokens"])
+            db.executemany(EXPIRE_LISTING, [(order_id,) for order_id in fields["ids"]])
+            db.executemany(EXPIRE_BID, [(order_id,) for order_id in fields["ids"]])
+        elif op == "remove_user":
+            db.execute(DELETE_USER, (fields["username"],))
+            db.execute(REMOVE_SELLER, (fields["username"],))
+            db.execute(REMOVE_BUYER, (fields["username"],))
+        elif op == "reset_users":
+            db.execute("DELETE FROM users")
+        elif op == "batch":
+            for entry in fields["records"]:
+                entry = dict(entry)
+                self.append(entry.pop("op"), **entry)
+        else:
+            raise ValueError(f"Unknown log record: {op}")
+        return dict(fields, op=op)
+
+    def sync(self):
+        pass
+
+    def needs_compaction(self):
+        return False
+
+    def compact(self, state):
+        pass
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def migrate(json_file, db_file, halls=None):
+    from engine import DEFAULT_HALLS
+    from locking import FileLock
+    from storage import LogStore
+
+    halls = list(halls or DEFAULT_HALLS)
+    lock = FileLock(json_file + ".lock")
+    with lock.hold(exclusive=False):
+        state = LogStore(json_file).load(halls)
+    lock.close()
+    store = SqliteStore(db_file)
+    with store.transaction():
+        for username, info in state["users"].items():
+            store.append("register", username=username, roll=info.roll, mobile=info.mobile)
+        for hall, listings in state["book"].to_halls().items():
+            for listing in listings:
+                store.append("list", hall=hall, listing=listing)
+        for hall, bids in state["book"].bids_to_halls().items():
+            for bid in bids:
+                store.append("bid", hall=hall, bid=bid)
+    store.close()
+    return len(state["users"]), sum(len(listings) for listings in state["book"].to_halls().values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a token_data.json file into a SQLite database")
+    parser.add_argument("json_file", nargs="?", default="token_data.json")
+    parser.add_argument("db_file", nargs="?", default="token_data.db")
+    args = parser.parse_args()
+    users, listings = migrate(args.json_file, args.db_file)
+    print(f"Imported {users} users and {listings} listings into {args.db_file}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from metrics import REGISTRY
+from orderbook import OrderBook
+from records import Bid, Listing
+from snapshot import SUFFIX as SNAPSHOT_SUFFIX, Snapshot, write_snapshot
+from users import UserDirectory
+
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+
+
+def open_store(data_file):
+    if data_file.endswith(SQLITE_SUFFIXES):
+        # sqlite3 is only loaded for SQLite data files.
+        from sqlite_store import SqliteStore
+
+        return SqliteStore(data_file)
+    return LogStore(data_file)
+
+
+def apply_record(state, record):
+    op = record["op"]
+    users = state["users"]
+    book = state["book"]
+
+    if op == "register":
+        users.register(record["username"], record["roll"], record["mobile"])
+    elif op == "list":
+        book.add(book.decode(Listing, record["hall"], record["listing"]))
+        state["next_id"] = max(state.get("next_id", 1), record["listing"]["id"] + 1)
+    elif op == "fill":
+        book.fill_listing(record["id"], record["qty"], record.get("price"))
+        if record.get("bid") is not None:
+            book.fill_bid(record["bid"], record["qty"])
+    elif op == "bid":
+        book.add_bid(book.decode(Bid, record["hall"], record["bid"]))
+        state["next_id"] = max(state.get("next_id", 1), record["bid"]["id"] + 1)
+    elif op == "cancel_bid":
+        book.remove_bid(record["id"])
+    elif op == "expire":
+        book.expire(record["ids"])
+    elif op == "remove_user":
+        users.remove(record["username"])
+        book.remove_seller(record["username"])
+    elif op == "reset_users":
+        users.reset()
+    elif op == "batch":
+        for entry in record["records"]:
+            apply_record(state, entry)
+    else:
+        raise ValueError(f"Unknown log record: {op}")
+
+
+def snapshot_layout(state, seq):
+    # The JSON snapshot layout; the binary format holds the same content.
+    return {
+        "users": state["users"].to_json(),
+        "indexes": state["users"].indexes(),
+        "halls": state["book"].to_halls(),
+        "bids": state["book"].bids_to_halls(),
+        "stats": state["book"].stats.to_json(),
+        "next_id": state.get("next_id", 1),
+        "seq": seq,
+    }
+
+
+class LogStore:
+    def __init__(self, data_file, fsync_every=32, fsync_interval=0.5, compact_every=1000):
+        self.data_file = data_file
+        self.log_file = data_file + ".log"
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.seq = 0
+        self.log_records = 0
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        self.log = None
+        self.log_id = None
+        self.snapshot_id = None
+        self.offset = 0
+        # A data file ending in .bin keeps its snapshot in the binary format, which is memory-mapped and decoded lazily.
+        self.binary = data_file.endswith(SNAPSHOT_SUFFIX)
+        self.snapshot = None
+
+    def load(self, default_halls, cutoffs=None):
+        self.close()
+        state = self._load_binary(default_halls, cutoffs) if self.binary else self._load_json(default_halls, cutoffs)
+        self.snapshot_id = self._snapshot_identity()
+        self.log_id = self._log_identity()[0]
+        self.offset = 0
+        self.log_records = 0
+        self.catch_up(state)
+        return state
+
+    def _load_binary(self, default_halls, cutoffs):
+        try:
+            snapshot = Snapshot(self.data_file)
+        except (FileNotFoundError, EOFError):
+            self.seq = 0
+            return {"users": UserDirectory(), "book": OrderBook(default_halls, cutoffs), "next_id": 1}
+        REGISTRY.inc("store_bytes_read_total", snapshot.base, store="snapshot")
+        self.snapshot = snapshot
+        self.seq = snapshot.seq
+        return {
+            "users": UserDirectory(source=snapshot.users),
+            "book": OrderBook.from_snapshot(snapshot, default_halls, cutoffs),
+            "next_id": snapshot.next_id,
+        }
+
+    def _load_json(self, default_halls, cutoffs):
+        try:
+            with open(self.data_file, "r") as file:
+                data = json.load(file)
+                REGISTRY.inc("store_bytes_read_total", file.tell(), store="snapshot")
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            data = {}
+
+        halls = data.get("halls", {})
+        next_id = data.get("next_id", 1)
+        self.seq = data.get("seq", 0)
+
+        # Older files have listings without ids; number them so log records can refer to them.
+        for hall in default_halls:
+            for token in halls.get(hall, []):
+                if "id" not in token:
+                    token["id"] = next_id
+                    next_id += 1
+
+        state = {
+            "users": UserDirectory(data.get("users", {}), data.get("indexes")),
+            "book": OrderBook.from_halls(halls, default_halls, cutoffs, data.get("bids")),
+            "next_id": next_id,
+        }
+        state["book"].stats.load_closed(data.get("stats"))
+        return state
+
+    def _log_identity(self):
+        try:
+            stat = os.stat(self.log_file)
+        except FileNotFoundError:
+            return None, 0
+        return (stat.st_dev, stat.st_ino), stat.st_size
+
+    def _snapshot_identity(self):
+        try:
+            stat = os.stat(self.data_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    def version(self):
+        return self.seq
+
+    def stale(self):
+        # Another process has either appended to the log ("append") or compacted it into a new file ("reload").
+        identity, size = self._log_identity()
+        if identity != self.log_id:
+            # A log that did not exist when we loaded is either a first append or a compaction's fresh log; only
+            # a compaction also replaces the snapshot.
+            if self.log_id is not None or self.offset or self._snapshot_identity() != self.snapshot_id:
+                return "reload"
+        if size != self.offset:
+            return "append"
+        return None
+
+    def catch_up(self, state):
+        # Called with the data file's lock held, shared or exclusive. Writers hold it exclusively, so an unfinished
+        # last record can only be left over from a writer that crashed.
+        applied = 0
+        torn = False
+        try:
+            with open(self.log_file, "rb") as file:
+                if self.log_id is None:
+                    self.log_id = self._log_identity()[0]
+                file.seek(self.offset)
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        torn = True
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        record = None
+                    if not isinstance(record, dict):
+                        # As the last line, an unreadable record is crash debris like a torn one and is cut off the
+                        # same way. Cutting back past later records would lose them, so that is refused instead.
+                        if file.read().strip():
+                            raise ValueError(f"{self.log_file} has an unreadable record at byte {self.offset} "
+                                             f"followed by more records; repair it before opening the data file.")
+                        torn = True
+                        break
+                    self.offset += len(line)
+                    REGISTRY.inc("store_bytes_read_total", len(line), store="log")
+                    if record["seq"] <= self.seq:
+                        continue
+                    apply_record(state, record)
+                    self.seq = record["seq"]
+                    self.log_records += 1
+                    applied += 1
+        except FileNotFoundError:
+            pass
+        if torn:
+            self._truncate_log()
+        return applied
+
+    def _truncate_log(self):
+        # Appending after the partial record would glue the next one onto it and make both unreadable, so the log
+        # is cut back to the end of the last complete record.
+        with open(self.log_file, "r+b") as file:
+            file.truncate(self.offset)
+            os.fsync(file.fileno())
+        REGISTRY.inc("store_torn_records_total")
+
+    @contextmanager
+    def transaction(self):
+        # Records are already appended one by one and fsynced in groups; there is nothing to roll back.
+        yield
+
+    def append(self, op, **fields):
+        if self.log is None:
+            self.log = open(self.log_file, "ab")
+            self.log_id = self._log_identity()[0]
+        self.seq += 1
+        record = {"seq": self.seq, "op": op, **fields}
+        data = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+        self.log.write(data)
+        REGISTRY.inc("store_bytes_written_total", len(data), store="log")
+        REGISTRY.inc("store_records_total", op=op)
+        self.log.flush()
+        self.offset = self.log.tell()
+        self.log_records += 1
+        self.pending += 1
+        if self.pending >= self.fsync_every or time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+        return record
+
+    def sync(self):
+        if self.log is not None and self.pending:
+            with REGISTRY.time("store_fsync_seconds"):
+                os.fsync(self.log.fileno())
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def needs_compaction(self):
+        return self.log_records >= self.compact_every
+
+    def compact(self, state):
+        self.sync()
+        # Whatever is still undecoded in the old snapshot is read in first, so it can be closed before it is replaced.
+        state["users"].load_all()
+        state["book"].load_all()
+        self._close_snapshot()
+        tmp_file = self.data_file + ".tmp"
+        with REGISTRY.time("store_compact_seconds"):
+            if self.binary:
+                size = write_snapshot(tmp_file, state["users"], state["book"], state.get("next_id", 1), self.seq)
+            else:
+                with open(tmp_file, "w") as file:
+                    json.dump(snapshot_layout(state, self.seq), file, indent=4)
+                    file.flush()
+                    os.fsync(file.fileno())
+                    size = file.tell()
+            REGISTRY.inc("store_bytes_written_total", size, store="snapshot")
+        os.replace(tmp_file, self.data_file)
+        self.snapshot_id = self._snapshot_identity()
+
+        # The log is swapped for a fresh file rather than truncated, so other processes notice the new inode.
+        # The snapshot records the last seq it covers, so a crash before the swap only leaves stale records.
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        open(tmp_file, "wb").close()
+        os.replace(tmp_file, self.log_file)
+        self.log_id = self._log_identity()[0]
+        self.offset = 0
+        self.log_records = 0
+
+    def _close_snapshot(self):
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+
+    def close(self):
+        self._close_snapshot()
+        if self.log is not None:
+            self.sync()
+            self.log.close()
+            self.log = None
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionControl, FairQueue, Rejected
+
+
+def admitted(control, peer, names):
+    count = 0
+    for name in names:
+        try:
+            control.admit(peer, name)
+            count += 1
+        except Rejected:
+            pass
+    return count
+
+
+def test_writing_under_someone_elses_name_does_not_use_up_their_share():
+    control = AdmissionControl(user_rate=1.0, user_burst=3, global_rate=0, peer_rate=100.0, peer_burst=100)
+    assert admitted(control, "10.0.0.9", ["alice"] * 5) == 3
+    assert admitted(control, "10.0.0.1", ["alice"]) == 1
+
+
+def test_changing_names_does_not_escape_the_address_limit():
+    control = AdmissionControl(user_rate=1.0, user_burst=3, global_rate=0, peer_rate=1.0, peer_burst=5)
+    assert admitted(control, "10.0.0.9", [f"user{i}" for i in range(20)]) == 5
+    assert admitted(control, "10.0.0.1", ["alice"]) == 1
+
+
+def test_the_global_bucket_answers_503():
+    control = AdmissionControl(user_rate=0, global_rate=1.0, global_burst=1, peer_rate=0)
+    control.admit("10.0.0.1", "a")
+    with pytest.raises(Rejected) as rejected:
+        control.admit("10.0.0.2", "b")
+    assert rejected.value.status == 503
+    control.admit("10.0.0.2", "b", write=False)
+
+
+def test_fair_queue_takes_turns_between_halls_and_refuses_when_full():
+    async def drain():
+        queue = FairQueue(5)
+        for i in range(3):
+            queue.put("Zia Hall", f"zia{i}")
+        queue.put("Selim Hall", "selim0")
+        queue.put(None, "all halls")
+        with pytest.raises(asyncio.QueueFull):
+            queue.put("Hamid Hall", "hamid0")
+        return [await queue.get() for _ in range(5)]
+
+    assert asyncio.run(drain()) == ["zia0", "selim0", "all halls", "zia1", "zia2"]
@@ -0,0 +1,43 @@
+from datetime import datetime
+
+from bulk_import import import_listings
+from engine import TokenEngine
+
+MORNING = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def listed(engine):
+    return [(listing["tokens"], listing["timestamp"], listing["price"]) for listing in engine.snapshot("Zia Hall")["Zia Hall"]]
+
+
+def test_json_lines_take_the_timestamp_like_csv_rows():
+    with open("orders.jsonl", "w") as file:
+        file.write(f'{{"username": "a", "hall": "Zia Hall", "meal_type": "Lunch", "tokens": 2, "timestamp": "{MORNING}"}}\n')
+        file.write(f'{{"username": "a", "hall": "Zia Hall", "meal_type": "Lunch", "tokens": 3, "price": 4}}\n')
+    with open("orders.csv", "w") as file:
+        file.write(f"username,hall,meal_type,tokens,timestamp\na,Zia Hall,Lunch,5,{MORNING}\n")
+    engine = TokenEngine("data.json")
+    engine.login("a", "1", "1")
+    assert import_listings(engine, "orders.jsonl") == (2, [])
+    assert import_listings(engine, "orders.csv") == (1, [])
+    rows = listed(engine)
+    assert rows[0] == (2, MORNING, 0)
+    assert rows[1][0] == 3 and rows[1][1] != MORNING
+    assert rows[2] == (5, MORNING, 0)
+    engine.close()
+
+
+def test_a_csv_with_missing_columns_rejects_its_batches():
+    with open("short.csv", "w") as file:
+        file.write("username,hall,tokens\na,Zia Hall,1\na,Zia Hall,2\na,Zia Hall,3\n")
+    with open("ragged.csv", "w") as file:
+        file.write("username,hall,meal_type,tokens\na,Zia Hall,Lunch,1\na,Zia Hall\n")
+    engine = TokenEngine("data.json")
+    engine.login("a", "1", "1")
+    imported, rejected = import_listings(engine, "short.csv", chunk_size=2)
+    assert imported == 0
+    assert [(offset, "missing field 'meal_type'" in error) for offset, error in rejected] == [(0, True), (2, True)]
+    imported, rejected = import_listings(engine, "ragged.csv", chunk_size=1)
+    assert imported == 1
+    assert [(offset, "missing field 'meal_type'" in error) for offset, error in rejected] == [(1, True)]
+    engine.close()
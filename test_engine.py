@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from engine import TokenEngine, TradeError
+
+MORNING = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
+
+
+@pytest.fixture(params=["data.json", "data.db"])
+def data_file(request):
+    return request.param
+
+
+def test_buy_batch_takes_named_listings_before_quantity_orders(data_file):
+    engine = TokenEngine(data_file)
+    engine.login("a", "1", "1")
+    engine.login("b", "2", "2")
+    first = engine.list_tokens("a", "Zia Hall", "Lunch", 5, at=MORNING)
+    second = engine.list_tokens("a", "Zia Hall", "Lunch", 5, at=MORNING)
+
+    results = engine.buy_batch("b", [{"hall": "Zia Hall", "meal_type": "Lunch", "quantity": 5},
+                                     {"hall": "Zia Hall", "id": first["id"]}])
+    assert [[seller["id"] for seller in sellers] for sellers in results] == [[second["id"]], [first["id"]]]
+    engine.close()
+
+    engine = TokenEngine(data_file)
+    assert engine.snapshot("Zia Hall") == {"Zia Hall": []}
+    engine.close()
+
+
+def test_a_failed_mutation_leaves_memory_as_stored(data_file, monkeypatch):
+    engine = TokenEngine(data_file)
+    engine.login("a", "1", "1")
+    engine.login("b", "2", "2")
+    engine.list_tokens("a", "Zia Hall", "Lunch", 5, at=MORNING)
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    # The book has already been filled when saving fails.
+    monkeypatch.setattr(engine, "save_batch", fail)
+    with pytest.raises(OSError):
+        engine.buy("b", "Zia Hall", "Lunch", 2)
+    assert engine.snapshot("Zia Hall")["Zia Hall"][0]["tokens"] == 5
+    engine.close()
+
+
+def test_a_call_that_fails_before_changing_anything_does_not_reload(data_file, monkeypatch):
+    engine = TokenEngine(data_file)
+    engine.login("a", "1", "1")
+    engine.list_tokens("a", "Zia Hall", "Lunch", 5, at=MORNING)
+    reloads = []
+    monkeypatch.setattr(engine, "load_data", lambda: reloads.append(1))
+    with pytest.raises(TypeError):
+        engine.take("a", "Zia Hall", [1])
+    with pytest.raises(TradeError):
+        engine.buy("a", "Zia Hall", None, 1)
+    assert reloads == []
+    engine.close()
+
+def test_a_new_ask_fills_resting_bids_best_price_first():
+    engine = TokenEngine("data.json")
+    for name in ("seller", "low", "high"):
+        engine.login(name, name, name)
+    assert engine.bid("low", "Zia Hall", "Lunch", 2, 4, at=MORNING)["bid"]["tokens"] == 2
+    assert engine.bid("high", "Zia Hall", "Lunch", 2, 6, at=MORNING)["bid"]["tokens"] == 2
+
+    listing = engine.list_tokens("seller", "Zia Hall", "Lunch", 3, at=MORNING, price=4)
+    assert [(buyer["username"], buyer["tokens_bought"], buyer["price"]) for buyer in listing["matched"]] == [
+        ("high", 2, 6), ("low", 1, 4)]
+    assert listing["tokens"] == 0
+    assert [(bid["username"], bid["tokens"]) for bid in engine.bids("Zia Hall")["Zia Hall"]] == [("low", 1)]
+    engine.close()
+
+
+def test_an_ask_above_every_bid_rests():
+    engine = TokenEngine("data.json")
+    engine.login("seller", "1", "1")
+    engine.login("buyer", "2", "2")
+    engine.bid("buyer", "Zia Hall", "Lunch", 2, 4, at=MORNING)
+    listing = engine.list_tokens("seller", "Zia Hall", "Lunch", 3, at=MORNING, price=5)
+    assert listing["matched"] == [] and listing["tokens"] == 3
+    # A bid fills what it can from cheaper asks and rests with the rest.
+    result = engine.bid("buyer", "Zia Hall", "Lunch", 5, 5, at=MORNING)
+    assert [seller["tokens_sold"] for seller in result["sellers"]] == [3]
+    assert result["bid"]["tokens"] == 2
+    engine.close()
+
+
+def test_a_mobile_number_registers_only_one_user(data_file):
+    engine = TokenEngine(data_file)
+    engine.login("a", "1", "0170")
+    with pytest.raises(TradeError, match="already registered to 'a'"):
+        engine.login("b", "2", "0170")
+    engine.close()
+
+    engine = TokenEngine(data_file)
+    with pytest.raises(TradeError):
+        engine.login("b", "2", "0170")
+    assert engine.login("b", "2", "0180") == "registered"
+    engine.close()
+
+
+def test_roll_and_mobile_numbers_are_compared_as_text(data_file):
+    engine = TokenEngine(data_file)
+    assert engine.login("b", 2, 2) == "registered"
+    with pytest.raises(TradeError, match="roll number 2"):
+        engine.login("c", " 2 ", "3")
+    with pytest.raises(TradeError):
+        engine.login("d", "4", None)
+    assert engine.user("b")["roll"] == "2"
+    engine.close()
+
+
+def test_orders_dated_for_a_later_day_are_refused(data_file):
+    engine = TokenEngine(data_file)
+    engine.login("a", "1", "1")
+    tomorrow = MORNING + timedelta(days=1)
+    with pytest.raises(TradeError, match="later day"):
+        engine.list_tokens("a", "Zia Hall", "Lunch", 2, at=tomorrow)
+    with pytest.raises(TradeError, match="later day"):
+        engine.bid("a", "Zia Hall", "Lunch", 2, 5, at=tomorrow.strftime("%Y-%m-%d %H:%M:%S"))
+    with pytest.raises(TradeError, match="Order 1: Cannot trade"):
+        engine.list_batch([{"username": "a", "hall": "Zia Hall", "meal_type": "Lunch", "tokens": 1}], at=tomorrow)
+    assert engine.snapshot("Zia Hall")["Zia Hall"] == []
+    engine.close()
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from engine import TokenEngine, TradeError
+from server import TokenServer
+
+MORNING = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
+
+
+@pytest.fixture(params=["data.json", "data.db"])
+def engine(request):
+    engine = TokenEngine(request.param)
+    engine.login("a", "1", "1")
+    engine.login("b", "2", "2")
+    yield engine
+    engine.close()
+
+
+def stored_listings(data_file):
+    # What another process would see on disk right now.
+    if data_file.endswith(".db"):
+        db = sqlite3.connect(data_file)
+        ids = {listing_id for listing_id, in db.execute("SELECT id FROM listings")}
+        db.close()
+        return ids
+    with open(data_file + ".log", "rb") as file:
+        return {record["listing"]["id"] for record in map(json.loads, file) if record["op"] == "list"}
+
+
+def test_subscribers_only_get_their_hall_and_meal(engine):
+    everything, zia, zia_dinner = [], [], []
+    engine.subscribe(everything.append)
+    engine.subscribe(zia.append, hall="Zia Hall")
+    engine.subscribe(zia_dinner.append, hall="Zia Hall", meal_type="dinner")
+    engine.list_tokens("a", "Zia Hall", "Lunch", 2, at=MORNING)
+    engine.list_tokens("a", "Zia Hall", "Dinner", 2, at=MORNING)
+    engine.list_tokens("a", "Selim Hall", "Dinner", 2, at=MORNING)
+    engine.remove_user("b")
+
+    assert [(event["type"], event["hall"], event["meal_type"]) for event in everything] == [
+        ("listed", "Zia Hall", "Lunch"), ("listed", "Zia Hall", "Dinner"), ("listed", "Selim Hall", "Dinner"),
+        ("user_removed", None, None)]
+    assert [event["hall"] for event in zia] == ["Zia Hall", "Zia Hall", None]
+    assert [(event["type"], event["meal_type"]) for event in zia_dinner] == [("listed", "Dinner"), ("user_removed", None)]
+
+
+def test_events_arrive_after_the_commit_and_never_for_a_failed_call(engine, monkeypatch):
+    seen = []
+    engine.subscribe(lambda event: seen.append((event["type"], event["listing"]["id"] in stored_listings(
+        engine.data_file))))
+    listing = engine.list_tokens("a", "Zia Hall", "Lunch", 2, at=MORNING)
+    assert seen == [("listed", True)]
+
+    def fail(records):
+        raise OSError("disk full")
+
+    seen.clear()
+    with pytest.raises(TradeError):
+        engine.buy("b", "Zia Hall", "Lunch", 5)
+    monkeypatch.setattr(engine, "save_batch", fail)
+    with pytest.raises(OSError):
+        engine.buy("b", "Zia Hall", "Lunch", 1)
+    assert seen == []
+    assert engine.snapshot("Zia Hall")["Zia Hall"][0]["id"] == listing["id"]
+
+
+def test_refresh_publishes_another_engines_writes(engine):
+    seen = []
+    engine.subscribe(seen.append)
+    other = TokenEngine(engine.data_file)
+    other.list_tokens("a", "Zia Hall", "Lunch", 2, at=MORNING)
+    other.buy("b", "Zia Hall", "Lunch", 1)
+    other.close()
+    engine.poll()
+    if engine.data_file.endswith(".db"):
+        # SQLite has no log to replay, so an outside write reloads and tells subscribers to start over.
+        assert [event["type"] for event in seen] == ["reset"]
+    else:
+        assert [(event["type"], event.get("quantity")) for event in seen] == [("listed", None), ("filled", 1)]
+
+
+def test_a_reload_sends_reset():
+    engine = TokenEngine("data.json")
+    engine.login("a", "1", "1")
+    seen = []
+    engine.subscribe(seen.append)
+    other = TokenEngine("data.json")
+    other.login("b", "2", "2")
+    # Compacting starts a new log, so the first engine has to reload instead of catching up.
+    other.store.compact(other._state())
+    other.close()
+    engine.poll()
+    assert seen == [{"type": "reset", "hall": None, "meal_type": None}]
+    assert engine.user("b") is not None
+    engine.close()
+
+
+def test_the_events_endpoint_streams_matching_events():
+    engine = TokenEngine("data.json")
+    engine.login("a", "1", "1")
+
+    async def stream():
+        server = TokenServer(engine, port=0, heartbeat=0.05)
+        await server.start()
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        writer.write(b"GET /events?hall=Zia%20Hall HTTP/1.1\r\nHost: x\r\n\r\n")
+        await writer.drain()
+        head = await reader.readuntil(b"\r\n\r\n")
+        assert await reader.readline() == b": ping\n"
+        await reader.readline()
+        engine.list_tokens("a", "Selim Hall", "Lunch", 1, at=MORNING)
+        engine.list_tokens("a", "Zia Hall", "Lunch", 3, at=MORNING)
+        line = await reader.readline()
+        while line == b": ping\n" or line == b"\n":
+            line = await reader.readline()
+        writer.close()
+        server.server.close()
+        for task in server.writer_tasks:
+            task.cancel()
+        return head, line
+
+    head, line = asyncio.run(stream())
+    assert head.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert b"Content-Type: text/event-stream" in head
+    event = json.loads(line[len(b"data: "):])
+    assert (event["type"], event["hall"], event["listing"]["tokens"]) == ("listed", "Zia Hall", 3)
+    engine.close()
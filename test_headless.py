@@ -0,0 +1,26 @@
+from datetime import datetime
+
+import pytest
+
+import metrics
+from headless import build_parser
+
+
+def test_at_is_parsed_into_a_datetime():
+    args = build_parser().parse_args(["sell", "a", "Zia Hall", "Lunch", "2", "--at", "2024-01-31 09:00:00"])
+    assert args.at == datetime(2024, 1, 31, 9)
+
+
+def test_a_bad_at_is_a_usage_error():
+    with pytest.raises(SystemExit):
+        build_parser().parse_args(["bid", "a", "Zia Hall", "Lunch", "2", "5", "--at", "noon"])
+
+
+@pytest.mark.parametrize("argv, interval", [([], 12.0), (["--metrics-interval", "3"], 3.0)])
+def test_the_metrics_interval_flag_beats_the_environment(monkeypatch, argv, interval):
+    started = []
+    monkeypatch.setenv("TOKEN_METRICS_INTERVAL", "12")
+    monkeypatch.setattr(metrics, "start_dump", lambda path, seconds: started.append(seconds))
+    monkeypatch.setattr(metrics.REGISTRY, "enabled", False)
+    metrics.configure(build_parser().parse_args(argv + ["--metrics-dump", "dump.json", "halls"]))
+    assert started == [interval]
@@ -0,0 +1,80 @@
+import os
+from datetime import date, datetime, timedelta
+
+from history import ARCHIVE_SUFFIX, LIVE_FILE, TradeHistory, read_columns
+
+TODAY = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+
+
+def days_ago(days):
+    return TODAY - timedelta(days=days)
+
+
+def record(history, *events):
+    for kind, hall, qty, seller, buyer, price, at in events:
+        history.add(kind, hall, "Lunch", qty, seller, buyer, price, at - timedelta(hours=3), at)
+    history.commit()
+
+
+def test_roll_archives_finished_days_and_keeps_today_live():
+    history = TradeHistory("history")
+    record(history, ("fill", "Zia Hall", 2, "a", "b", 5, days_ago(2)),
+           ("fill", "Zia Hall", 1, "a", "c", 5, days_ago(1)),
+           ("fill", "Selim Hall", 3, "d", "b", 1, TODAY))
+
+    assert history.roll() == [days_ago(2).date(), days_ago(1).date()]
+    assert sorted(os.listdir("history")) == sorted([days_ago(2).date().isoformat() + ARCHIVE_SUFFIX,
+                                                    days_ago(1).date().isoformat() + ARCHIVE_SUFFIX, LIVE_FILE])
+    assert [event["hall"] for event in history._live_events()] == ["Selim Hall"]
+    # Nothing is left to move.
+    assert history.roll() == []
+
+
+def test_archives_give_back_every_column():
+    history = TradeHistory("history")
+    record(history, ("fill", "Zia Hall", 2, "a", "b", 2.5, days_ago(1)),
+           ("expire", "Zia Hall", 4, "a", None, 3, days_ago(1)),
+           ("expire", "Hamid Hall", 1, None, "b", 0, days_ago(1)))
+    live = list(history._live_events())
+    history.roll()
+
+    path = history.archive_path(days_ago(1).date())
+    assert list(history._archive_events(path)) == live
+    strings, count, columns = read_columns(path, ("qty", "buyer"))
+    assert count == 3
+    assert sorted(columns) == ["buyer", "qty"]
+    assert list(columns["qty"]) == [2, 4, 1]
+    assert [strings[index] if index >= 0 else None for index in columns["buyer"]] == ["b", None, "b"]
+
+
+def test_rolling_into_an_existing_archive_keeps_both_parts():
+    history = TradeHistory("history")
+    record(history, ("fill", "Zia Hall", 2, "a", "b", 5, days_ago(1)))
+    history.roll()
+    record(history, ("fill", "Zia Hall", 3, "c", "d", 1.5, days_ago(1)))
+    history.roll()
+
+    events = list(history._archive_events(history.archive_path(days_ago(1).date())))
+    assert [(event["seller"], event["qty"], event["price"]) for event in events] == [("a", 2, 5), ("c", 3, 1.5)]
+
+
+def test_reports_cover_archived_and_live_days():
+    history = TradeHistory("history")
+    record(history, ("fill", "Zia Hall", 2, "a", "b", 5, days_ago(3)),
+           ("fill", "Selim Hall", 1, "a", "b", 5, days_ago(3)),
+           ("expire", "Zia Hall", 9, "a", None, 5, days_ago(3)),
+           ("fill", "Zia Hall", 4, "a", "b", 5, days_ago(1)),
+           ("fill", "Zia Hall", 1, "a", "b", 5, days_ago(1)))
+    history.roll(days_ago(2).date())
+    record(history, ("fill", "Selim Hall", 6, "a", "b", 5, TODAY))
+
+    assert list(history.traded_per_hall_per_day()) == [
+        (days_ago(3).date(), "Selim Hall", 1), (days_ago(3).date(), "Zia Hall", 2),
+        (days_ago(1).date(), "Zia Hall", 5), (TODAY.date(), "Selim Hall", 6)]
+    assert list(history.traded_per_hall_per_day(start=days_ago(1).date(), end=days_ago(1).date())) == [
+        (days_ago(1).date(), "Zia Hall", 5)]
+
+    zia = list(history.events(hall="Zia Hall"))
+    assert [(event["kind"], event["qty"]) for event in zia] == [("fill", 2), ("expire", 9), ("fill", 4), ("fill", 1)]
+    assert [event["qty"] for event in history.events(start=days_ago(1).date())] == [4, 1, 6]
+    assert list(history.events(end=date(2000, 1, 1))) == []
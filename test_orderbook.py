@@ -0,0 +1,40 @@
+from orderbook import OrderBook
+from records import Listing
+
+HALLS = ["Zia Hall", "Hamid Hall"]
+
+
+def book_with(*prices):
+    book = OrderBook(HALLS)
+    seller = book.names.id("seller")
+    for order_id, price in enumerate(prices, start=1):
+        book.add(Listing(order_id, "Zia Hall", "Lunch", seller, 2, price, 1700000000 + order_id))
+    return book
+
+
+def test_fills_go_cheapest_first_then_oldest_first():
+    book = book_with(5, 3, 5, 3)
+    fills = book.fill("Zia Hall", "Lunch", 8)
+    assert [(listing.id, taken) for listing, taken in fills] == [(2, 2), (4, 2), (1, 2), (3, 2)]
+    assert book.available("Zia Hall", "Lunch") == 0
+
+
+def test_a_partial_fill_leaves_the_rest_at_the_front():
+    book = book_with(3, 4)
+    assert [(listing.id, taken) for listing, taken in book.fill("Zia Hall", "Lunch", 1)] == [(1, 1)]
+    assert book.get(1).tokens == 1
+    assert book.available("Zia Hall", "Lunch") == 3
+    assert [(listing.id, taken) for listing, taken in book.fill("Zia Hall", "Lunch", 2)] == [(1, 1), (2, 1)]
+
+
+def test_a_limit_stops_at_the_first_dearer_listing():
+    book = book_with(3, 6, 4)
+    fills = book.fill("Zia Hall", "Lunch", 10, limit=4)
+    assert [(listing.id, taken) for listing, taken in fills] == [(1, 2), (3, 2)]
+    assert book.available("Zia Hall", "Lunch") == 2
+
+
+def test_removed_listings_are_skipped():
+    book = book_with(3, 4)
+    book.remove(1)
+    assert [(listing.id, taken) for listing, taken in book.fill("Zia Hall", "Lunch", 5)] == [(2, 2)]
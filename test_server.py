@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionControl
+from engine import TokenEngine
+from server import TokenServer
+
+
+@pytest.fixture
+def engine():
+    engine = TokenEngine("data.json")
+    engine.login("a", "1", "1")
+    yield engine
+    engine.close()
+
+
+def post(engine, method, body):
+    async def run():
+        server = TokenServer(engine, port=0)
+        await server.start()
+        try:
+            return await server.dispatch("POST", f"/{method}", body, "127.0.0.1")
+        finally:
+            server.server.close()
+            for task in server.writer_tasks:
+                task.cancel()
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("method, body", [
+    ("list_tokens", b'{"username": "a", "hall": "Zia Hall", "meal_type": "Lunch", "tokens": 1, "at": 5}'),
+    ("list_tokens", b'{"username": "a", "hall": "Zia Hall", "meal_type": 5, "tokens": 1}'),
+    ("list_tokens", b'{"username": ["a"], "hall": "Zia Hall", "meal_type": "Lunch", "tokens": 1}'),
+    ("buy", b'{"username": "a", "hall": "Zia Hall", "meal_type": null, "quantity": 1}'),
+    ("list_batch", b'{"orders": [{"username": "a", "hall": "Zia Hall", "meal_type": "Lunch", "tokens": 1, "at": 5}]}'),
+    ("buy_batch", b'{"username": "a", "orders": [{"hall": "Zia Hall", "id": {"x": 1}}]}'),
+    ("buy_batch", b'{"username": "a", "orders": [{"hall": "Zia Hall", "meal_type": 3, "quantity": 1}]}'),
+    ("take", b'{"username": "a", "hall": "Zia Hall", "listing_id": [1]}'),
+    ("expire", b'{"now": "tomorrow"}'),
+    ("buy_batch", b'{"orders": [1]}'),
+    ("list_batch", b'{"orders": {"hall": "Zia Hall"}}'),
+    ("login", b'[1, 2]'),
+])
+def test_malformed_bodies_are_bad_requests(engine, method, body):
+    status, reply = post(engine, method, body)
+    assert status == 400
+    assert reply["error"]
+
+
+def test_a_bad_request_leaves_the_engine_serving(engine):
+    post(engine, "list_tokens", b'{"username": "a", "hall": "Zia Hall", "meal_type": 5, "tokens": 1}')
+    status, reply = post(engine, "list_tokens", b'{"username": "a", "hall": "Zia Hall", "meal_type": "Lunch", '
+                                                b'"tokens": 2, "at": "2024-01-31 09:00:00"}')
+    assert status == 200
+    assert reply["result"]["tokens"] == 2
+
+
+def test_anonymous_reads_take_from_the_address_bucket(engine):
+    server = TokenServer(engine, admission=AdmissionControl(user_rate=0, global_rate=0, peer_rate=0.01, peer_burst=5))
+
+    async def read_book():
+        return [(await server.dispatch("GET", "/book", b"", "127.0.0.1"))[0] for _ in range(50)]
+
+    statuses = asyncio.run(read_book())
+    assert statuses.count(200) == 5
+    assert statuses.count(429) == 45
+    # Another address has its own bucket.
+    assert asyncio.run(server.dispatch("GET", "/halls", b"", "127.0.0.2"))[0] == 200
@@ -0,0 +1,65 @@
+from datetime import datetime
+
+import pytest
+
+from engine import TokenEngine, TradeError
+from sharded import ID_STEP, ShardedEngine
+
+HALLS = ["Zia Hall", "Hamid Hall", "Selim Hall"]
+MORNING = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
+
+
+@pytest.fixture
+def sharded():
+    engine = ShardedEngine("data.json", halls=HALLS, workers=2)
+    engine.login("a", "1", "1")
+    engine.login("b", "2", "2")
+    yield engine
+    engine.close()
+
+
+def test_each_hall_hands_out_ids_in_its_own_residue(sharded):
+    for _ in range(2):
+        for index, hall in enumerate(HALLS):
+            listing = sharded.list_tokens("a", hall, "Lunch", 1, at=MORNING)
+            assert listing["id"] % ID_STEP == index
+
+
+def test_cancel_bid_finds_the_hall_from_the_bid_id(sharded):
+    resting = sharded.bid("b", "Selim Hall", "Dinner", 2, 5, at=MORNING)["bid"]
+    assert sharded.cancel_bid("b", resting["id"])["id"] == resting["id"]
+    assert sharded.bids("Selim Hall") == {"Selim Hall": []}
+    with pytest.raises(TradeError):
+        sharded.cancel_bid("b", resting["id"])
+
+
+def test_users_registered_once_can_trade_in_every_hall(sharded):
+    assert sharded.usernames() == ["a", "b"]
+    for hall in HALLS:
+        sharded.list_tokens("a", hall, "Lunch", 1, at=MORNING)
+        assert sharded.buy("b", hall, "Lunch", 1)[0]["username"] == "a"
+    # The first hall decides registrations, so a clash never reaches the replicas.
+    with pytest.raises(TradeError, match="roll number 1"):
+        sharded.login("c", "1", "3")
+    assert sharded.user("c") is None
+
+
+def test_list_batch_answers_in_order_and_rejects_as_a_whole(sharded):
+    orders = [{"username": "a", "hall": hall, "meal_type": "Lunch", "tokens": tokens}
+              for hall, tokens in (("Selim Hall", 1), ("Zia Hall", 2), ("Selim Hall", 3), ("Hamid Hall", 4))]
+    listings = sharded.list_batch(orders, at=MORNING)
+    assert [listing["tokens"] for listing in listings] == [1, 2, 3, 4]
+    assert [listing["id"] % ID_STEP for listing in listings] == [2, 0, 2, 1]
+
+    before = sharded.snapshot()
+    with pytest.raises(TradeError, match="Hamid Hall"):
+        sharded.list_batch(orders[:3] + [dict(orders[3], tokens=0)], at=MORNING)
+    assert sharded.snapshot() == before
+
+
+def test_an_unsharded_data_file_with_data_is_not_ignored():
+    engine = TokenEngine("data.json")
+    engine.login("a", "1", "1")
+    engine.close()
+    with pytest.raises(ValueError, match="data.json holds data"):
+        ShardedEngine("data.json", halls=HALLS, workers=2)
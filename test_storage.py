@@ -0,0 +1,213 @@
+import multiprocessing
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+from engine import TokenEngine, TradeError
+
+MORNING = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
+
+
+def listings(engine):
+    return [(listing["username"], listing["tokens"]) for listing in engine.snapshot("Zia Hall")["Zia Hall"]]
+
+
+def test_writes_after_a_torn_record_survive_a_restart():
+    engine = TokenEngine("data.json")
+    engine.login("a", "1", "1")
+    engine.list_tokens("a", "Zia Hall", "Lunch", 2, at=MORNING)
+    engine.close()
+    # A crash in the middle of an append leaves half a record at the end of the log.
+    with open("data.json.log", "ab") as file:
+        file.write(b'{"seq":3,"op":"list","hall":"Zia')
+
+    engine = TokenEngine("data.json")
+    engine.list_tokens("a", "Zia Hall", "Lunch", 3, at=MORNING)
+    engine.login("t", "2", "2")
+    engine.close()
+
+    engine = TokenEngine("data.json")
+    assert listings(engine) == [("a", 2), ("a", 3)]
+    assert engine.user("t") is not None
+    engine.close()
+
+
+def test_a_torn_record_from_another_process_is_cut_off():
+    reader = TokenEngine("data.json")
+    writer = TokenEngine("data.json")
+    writer.login("a", "1", "1")
+    with open("data.json.log", "ab") as file:
+        file.write(b'{"seq":2,"op":"list"')
+
+    assert reader.user("a") is not None
+    assert reader.store.stale() is None
+    writer.list_tokens("a", "Zia Hall", "Lunch", 4, at=MORNING)
+    assert listings(reader) == [("a", 4)]
+    writer.close()
+    reader.close()
+
+
+def test_an_unreadable_last_record_is_cut_off():
+    engine = TokenEngine("data.json")
+    engine.login("a", "1", "1")
+    engine.close()
+    with open("data.json.log", "ab") as file:
+        file.write(b"\0\0\0\0\n")
+
+    engine = TokenEngine("data.json")
+    engine.list_tokens("a", "Zia Hall", "Lunch", 3, at=MORNING)
+    engine.close()
+    engine = TokenEngine("data.json")
+    assert listings(engine) == [("a", 3)]
+    engine.close()
+
+
+def test_an_unreadable_record_before_others_stops_the_load():
+    engine = TokenEngine("data.json")
+    engine.login("a", "1", "1")
+    engine.close()
+    with open("data.json.log", "rb") as file:
+        good = file.read()
+    with open("data.json.log", "wb") as file:
+        file.write(b'{"seq":1,"op"\n' + good)
+
+    with pytest.raises(ValueError, match="unreadable record at byte 0"):
+        TokenEngine("data.json")
+
+def test_sqlite_closed_totals_survive_a_reopen_and_an_upgrade():
+    engine = TokenEngine("data.db")
+    engine.login("a", "1", "1")
+    engine.login("b", "2", "2")
+    for price in (3, 5, 7):
+        engine.list_tokens("a", "Zia Hall", "Lunch", 4, at=MORNING, price=price)
+    engine.buy("b", "Zia Hall", "Lunch", 6)
+    engine.expire(now=MORNING + timedelta(hours=20))
+    summary = engine.summary()
+    engine.close()
+
+    engine = TokenEngine("data.db")
+    assert engine.summary() == summary
+    engine.close()
+
+    # A database written before the totals were kept is filled in once from its fills and expired listings.
+    db = sqlite3.connect("data.db")
+    db.execute("DROP TABLE closed_buckets")
+    db.execute("DROP TABLE closed_sellers")
+    db.commit()
+    db.close()
+    engine = TokenEngine("data.db")
+    assert engine.summary() == summary
+    engine.close()
+
+
+def test_sqlite_refuses_a_second_user_with_the_same_roll():
+    engine = TokenEngine("data.db")
+    engine.login("b", "2", "2")
+    with pytest.raises(sqlite3.IntegrityError):
+        with engine.store.transaction():
+            engine.store.append("register", username="c", roll="2", mobile="3")
+    engine.close()
+
+    engine = TokenEngine("data.db")
+    assert engine.usernames() == ["b"]
+    engine.close()
+
+def trade(engine):
+    for name in ("a", "b", "c", "d"):
+        engine.login(name, f"roll-{name}", f"mobile-{name}")
+    first = engine.list_tokens("a", "Zia Hall", "Lunch", 4, at=MORNING, price=5)
+    engine.list_tokens("b", "Zia Hall", "Lunch", 3, at=MORNING, price=3)
+    engine.list_tokens("a", "Hamid Hall", "Dinner", 2, at=MORNING - timedelta(days=1))
+    engine.list_batch([{"username": "c", "hall": "Selim Hall", "meal_type": "Dinner", "tokens": 2, "price": 1.5},
+                       {"username": "c", "hall": "Zia Hall", "meal_type": "Lunch", "tokens": 1}], at=MORNING)
+    engine.buy("d", "Zia Hall", "Lunch", 2)
+    engine.take("d", "Zia Hall", first["id"])
+    resting = engine.bid("d", "Selim Hall", "Dinner", 5, 2, at=MORNING)["bid"]
+    engine.bid("c", "Zia Hall", "Lunch", 2, 1, at=MORNING)
+    engine.cancel_bid("d", resting["id"])
+    engine.list_tokens("b", "Zia Hall", "Lunch", 1, at=MORNING, price=1)
+    engine.expire(now=MORNING)
+    engine.remove_user("b")
+
+
+def state(engine):
+    return {
+        "book": engine.snapshot(),
+        "bids": engine.bids(),
+        "summary": engine.summary(),
+        "users": sorted(engine.usernames()),
+        "user": engine.user("a"),
+    }
+
+
+@pytest.mark.parametrize("data_file", ["data.json", "data.bin", "data.db"])
+@pytest.mark.parametrize("compacted", [False, True])
+def test_reopening_replays_to_the_same_state(data_file, compacted):
+    engine = TokenEngine(data_file)
+    trade(engine)
+    before = state(engine)
+    if compacted:
+        engine.store.compact(engine._state())
+    engine.close()
+
+    engine = TokenEngine(data_file)
+    assert state(engine) == before
+    # New ids carry on after the old ones instead of reusing them.
+    assert engine.list_tokens("a", "Zia Hall", "Lunch", 1, at=MORNING)["id"] > max(
+        order["id"] for orders in list(before["book"].values()) + list(before["bids"].values()) for order in orders)
+    engine.close()
+
+
+def buy_until_sold_out(data_file, username, results):
+    engine = TokenEngine(data_file)
+    # Compact often, so other processes keep finding a new log under them.
+    engine.store.compact_every = 25
+    bought = 0
+    while True:
+        try:
+            bought += sum(seller["tokens_sold"] for seller in engine.buy(username, "Zia Hall", "Lunch", 1))
+        except TradeError:
+            break
+    engine.close()
+    results.put((username, bought))
+
+
+def test_processes_sharing_a_data_file_sell_every_token_once():
+    engine = TokenEngine("data.json")
+    engine.login("seller", "0", "0")
+    buyers = [f"buyer{i}" for i in range(6)]
+    for number, name in enumerate(buyers, start=1):
+        engine.login(name, str(number), str(number))
+    for price in range(40):
+        engine.list_tokens("seller", "Zia Hall", "Lunch", 5, at=MORNING, price=price % 7)
+    engine.close()
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [context.Process(target=buy_until_sold_out, args=("data.json", name, results)) for name in buyers]
+    for process in processes:
+        process.start()
+    bought = dict(results.get(timeout=120) for _ in processes)
+    for process in processes:
+        process.join(10)
+
+    assert sum(bought.values()) == 200
+    assert os.path.exists("data.json")
+    engine = TokenEngine("data.json")
+    assert engine.snapshot("Zia Hall")["Zia Hall"] == []
+    fills = [event for event in engine.history.events() if event["kind"] == "fill"]
+    assert sum(event["qty"] for event in fills) == 200
+    assert {name: sum(event["qty"] for event in fills if event["buyer"] == name) for name in buyers} == bought
+    engine.close()
+
+
+def test_a_compaction_is_noticed_by_an_engine_that_never_saw_a_log():
+    engine = TokenEngine("data.json")
+    other = TokenEngine("data.json")
+    other.login("a", "1", "1")
+    other.store.compact(other._state())
+    other.close()
+    assert engine.user("a") is not None
+    engine.close()
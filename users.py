@@ -0,0 +1,105 @@
+class User:
+    __slots__ = ("roll", "mobile")
+
+    def __init__(self, roll, mobile):
+        self.roll = roll
+        self.mobile = mobile
+
+    def to_dict(self):
+        return {"roll": self.roll, "mobile": self.mobile}
+
+
+class UserDirectory:
+    # Users are kept as two-slot records rather than nested dicts; to_json gives back the stored layout.
+    def __init__(self, users=None, indexes=None, source=None):
+        # A binary snapshot passes a source instead of users; they are decoded the first time they are needed.
+        self.source = source
+        self._users = None
+        # Set by register, remove and reset, like OrderBook.dirty.
+        self.dirty = False
+        if source is None:
+            self._users = {username: User(info["roll"], info["mobile"]) for username, info in (users or {}).items()}
+        indexes = indexes or {}
+        # A persisted index is only trusted if it covers every user; otherwise it is rebuilt on first use.
+        self._by_roll = indexes.get("roll") if "roll" in indexes and len(indexes["roll"]) == len(self.users) else None
+        self._by_mobile = indexes.get("mobile") if self._by_roll is not None and "mobile" in indexes else None
+
+    @property
+    def users(self):
+        if self._users is None:
+            self.load_all()
+        return self._users
+
+    def load_all(self):
+        if self._users is None:
+            self._users = self.source()
+            self.source = None
+
+    def __contains__(self, username):
+        return username in self.users
+
+    def __getitem__(self, username):
+        return self.users[username]
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __len__(self):
+        return len(self.users)
+
+    def get(self, username):
+        return self.users.get(username)
+
+    def items(self):
+        return self.users.items()
+
+    def to_json(self):
+        return {username: user.to_dict() for username, user in self.users.items()}
+
+    def _build_indexes(self):
+        self._by_roll = {}
+        self._by_mobile = {}
+        for username, info in self.users.items():
+            self._by_roll[info.roll] = username
+            self._by_mobile[info.mobile] = username
+
+    def by_roll(self, roll):
+        if self._by_roll is None or self._by_mobile is None:
+            self._build_indexes()
+        return self._by_roll.get(roll)
+
+    def by_mobile(self, mobile):
+        if self._by_roll is None or self._by_mobile is None:
+            self._build_indexes()
+        return self._by_mobile.get(mobile)
+
+    def register(self, username, roll, mobile):
+        self.dirty = True
+        self.remove(username)
+        self.users[username] = User(roll, mobile)
+        if self._by_roll is not None:
+            self._by_roll[roll] = username
+        if self._by_mobile is not None:
+            self._by_mobile[mobile] = username
+
+    def remove(self, username):
+        info = self.users.pop(username, None)
+        if info is None:
+            return None
+        self.dirty = True
+        if self._by_roll is not None and self._by_roll.get(info.roll) == username:
+            del self._by_roll[info.roll]
+        if self._by_mobile is not None and self._by_mobile.get(info.mobile) == username:
+            del self._by_mobile[info.mobile]
+        return info
+
+    def reset(self):
+        self.dirty = True
+        self.users.clear()
+        self._by_roll = {}
+        self._by_mobile = {}
+
+    def indexes(self):
+        if self._by_roll is None or self._by_mobile is None:
+            self._build_indexes()
+        return {"roll": self._by_roll, "mobile": self._by_mobile}
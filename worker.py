@@ -0,0 +1,87 @@
+import queue
+import threading
+import time
+import tkinter as tk
+
+from metrics import REGISTRY
+
+
+class EngineWorker:
+    POLL_MS = 16
+    IDLE_POLL_SECONDS = 0.5
+
+    def __init__(self, root, factory):
+        self.root = root
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.ready = threading.Event()
+        self.engine = None
+        self.error = None
+        self.subscribed = False
+        self.thread = threading.Thread(target=self.run, args=(factory,), name="engine-worker", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        self.root.after(self.POLL_MS, self.poll)
+
+    def run(self, factory):
+        # The engine is created and used only on this thread; Tk callbacks never touch it directly.
+        try:
+            self.engine = factory()
+        except Exception as e:
+            self.error = e
+        self.ready.set()
+        if self.error is not None:
+            return
+        while True:
+            try:
+                job, on_success, on_error, widgets, submitted = self.jobs.get(
+                    timeout=self.IDLE_POLL_SECONDS if self.subscribed else None)
+            except queue.Empty:
+                # While idle, look for other processes' writes so their events reach the subscribers.
+                try:
+                    self.engine.poll()
+                except Exception:
+                    REGISTRY.inc("gui_poll_errors_total")
+                continue
+            if job is None:
+                break
+            try:
+                with REGISTRY.time("gui_job_seconds"):
+                    result = job(self.engine)
+            except Exception as e:
+                self.results.put((on_error, e, widgets, submitted))
+            else:
+                self.results.put((on_success, result, widgets, submitted))
+
+    def submit(self, job, on_success=None, on_error=None, widgets=()):
+        for widget in widgets:
+            widget.config(state=tk.DISABLED)
+        self.jobs.put((job, on_success, on_error, widgets, time.perf_counter()))
+
+    def subscribe(self, callback, hall=None, meal_type=None):
+        # Events are raised on the engine's thread and handed to Tk through the same results queue as job results.
+        def deliver(event):
+            self.results.put((callback, event, (), None))
+
+        self.subscribed = True
+        self.submit(lambda engine: engine.subscribe(deliver, hall, meal_type))
+
+    def poll(self):
+        while True:
+            try:
+                callback, value, widgets, submitted = self.results.get_nowait()
+            except queue.Empty:
+                break
+            for widget in widgets:
+                widget.config(state=tk.NORMAL)
+            if callback is not None:
+                with REGISTRY.time("gui_callback_seconds"):
+                    callback(value)
+            if submitted is not None:
+                REGISTRY.observe("gui_click_to_result_seconds", time.perf_counter() - submitted)
+        self.root.after(self.POLL_MS, self.poll)
+
+    def stop(self):
+        self.jobs.put((None, None, None, (), None))